@@ -13,6 +13,39 @@ AWS_REGION = "eu-west-2"
 CHARSET = "UTF-8"
 SENDER = "ecointel.alerts@gmail.com"
 EMAIL_TIME_DELAY = 1  # Can only send 1 email per second.
+
+# The summaries cover the last 24 hours. The hourly rollups are read from the start
+# of the hour 24 hours ago, since a bucket is stored under the start of its hour
+WEATHER_SUMMARY_QUERY = (
+    "SELECT "
+    "l.location_id, "
+    "l.location_name, "
+    "MAX(wh.max_temperature) AS max_temp, "
+    "MIN(wh.min_temperature) AS min_temp, "
+    "SUM(wh.wind_speed_sum) / SUM(wh.reading_count) AS avg_wind_speed, "
+    "MAX(wh.max_wind_gust_speed) AS max_wind_gust, "
+    "SUM(wh.total_snowfall) AS total_snowfall, "
+    "SUM(wh.total_rainfall) AS total_rainfall "
+    "FROM weather_readings_hourly AS wh "
+    "JOIN locations AS l USING (location_id) "
+    "WHERE l.location_id IN %s "
+    "AND wh.hour >= date_trunc('hour', CURRENT_TIMESTAMP - interval '24 hours') "
+    "GROUP BY l.location_id, l.location_name;")
+AIR_QUALITY_SUMMARY_QUERY = (
+    "SELECT "
+    "l.location_id, "
+    "l.location_name, "
+    "AVG(ozone) AS ozone, "
+    "AVG(nitrogen_dioxide) AS nitrogen_dioxide, "
+    "AVG(sulphur_dioxide) AS sulphur_dioxide, "
+    "AVG(pm2_5) AS pm2_5, "
+    "AVG(pm10) AS pm10 "
+    "FROM air_quality_readings AS a "
+    "JOIN locations AS l USING (location_id) "
+    "WHERE l.location_id IN %s "
+    "AND timestamp > CURRENT_TIMESTAMP - interval '24 hours' "
+    "GROUP BY l.location_id, l.location_name;")
+
 load_dotenv()
 
 logging.basicConfig(
@@ -31,26 +64,11 @@ def get_conn():
 
 
 def get_weather_summary(location_ids: tuple[int]) -> dict[int, dict]:
-    """Get summary statistics for the day."""
+    """Get summary statistics for the day from the hourly weather rollups."""
     conn = get_conn()
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(
-            ("SELECT "
-             "l.location_id, "
-             "l.location_name, "
-             "MAX(wr.current_temperature) AS max_temp, "
-             "MIN(wr.current_temperature) AS min_temp, "
-             "AVG(wr.wind_speed) AS avg_wind_speed, "
-             "MAX(wr.wind_gust_speed) AS max_wind_gust, "
-             "SUM(wr.snowfall_last_15_mins) AS total_snowfall, "
-             "SUM(wr.rainfall_last_15_mins) AS total_rainfall "
-             "FROM weather_readings AS wr "
-             "JOIN locations AS l USING (location_id) "
-             "WHERE l.location_id IN %s "
-             "AND timestamp > CURRENT_TIMESTAMP - interval '24 hours' "
-             "GROUP BY l.location_id, l.location_name;"),
-            (location_ids,))
+        cur.execute(WEATHER_SUMMARY_QUERY, (location_ids,))
         data = cur.fetchall()
         summary_stats = {}
         for location in data:
@@ -68,21 +86,7 @@ def get_air_quality_summary(location_ids: tuple[int]) -> dict[int, dict]:
     conn = get_conn()
     try:
         cur = conn.cursor(cursor_factory=RealDictCursor)
-        cur.execute(
-            ("SELECT "
-             "l.location_id, "
-             "l.location_name, "
-             "AVG(ozone) AS ozone, "
-             "AVG(nitrogen_dioxide) AS nitrogen_dioxide, "
-             "AVG(sulphur_dioxide) AS sulphur_dioxide, "
-             "AVG(pm2_5) AS pm2_5, "
-             "AVG(pm10) AS pm10 "
-             "FROM air_quality_readings AS a "
-             "JOIN locations AS l USING (location_id) "
-             "WHERE l.location_id IN %s "
-             "AND timestamp > CURRENT_TIMESTAMP - interval '24 hours' "
-             "GROUP BY l.location_id, l.location_name;"),
-            (location_ids,))
+        cur.execute(AIR_QUALITY_SUMMARY_QUERY, (location_ids,))
         data = cur.fetchall()
         summary_stats = {}
         for location in data:
@@ -0,0 +1,35 @@
+"""Module for the database connection and location registry shared by the dashboard pages."""
+import os
+import psycopg2
+import streamlit as st
+from dotenv import load_dotenv
+
+# Seconds a page may show the old list of locations after one is added
+REGISTRY_VERSION_TTL = 30
+
+
+def get_connection() -> psycopg2.extensions.connection:
+    """Returns connection to RDS."""
+    load_dotenv()
+    return psycopg2.connect(
+        dbname=os.environ["DB_NAME"],
+        user=os.environ["DB_USERNAME"],
+        password=os.environ["DB_PASSWORD"],
+        host=os.environ["DB_HOST"],
+        port=os.environ.get("DB_PORT", 5432)
+    )
+
+
+@st.cache_data(ttl=REGISTRY_VERSION_TTL)
+def get_location_registry_version() -> int:
+    """
+    Returns the version of the locations, which changes whenever a location is added.
+    Cached briefly, so page reruns do not each open a connection to check it.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM location_registry")
+            return cur.fetchone()[0]
+    finally:
+        conn.close()
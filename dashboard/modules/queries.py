@@ -0,0 +1,54 @@
+"""
+Queries of the dashboard pages. They are kept out of the pages, which run as
+soon as they are imported, so db/test_query_plans.py can check their plans.
+"""
+
+RECENT_DAILY_WEATHER_QUERY = """select date,
+    temperature_sum / reading_count AS temperature,
+    total_rainfall AS rainfall,
+    wind_speed_sum / reading_count AS wind_speed
+    from weather_readings_daily WHERE location_id = %s ORDER BY date"""
+
+# Plain timestamp ranges let postgres skip the partitions of other years
+BASELINE_WEATHER_QUERY = """select * from historical_weather_readings WHERE location_id = %s
+    AND timestamp >= %s AND timestamp < %s;"""
+BASELINE_AND_RANGE_WEATHER_QUERY = """select * from historical_weather_readings
+    WHERE location_id = %s
+    AND ((timestamp >= %s AND timestamp < %s)
+    OR (timestamp >= %s AND timestamp < %s));"""
+
+FUTURE_PROJECTION_QUERY = """select day_of_year, mean_temperature, total_rainfall, mean_wind_speed
+    from future_day_of_year_projection
+    WHERE location_id = %s AND target_year = %s ORDER BY day_of_year"""
+
+HISTORICAL_AIR_QUALITY_QUERY = """
+    SELECT
+        timestamp,
+        hourly_air_quality_index AS air_quality_index,
+        hourly_carbon_monoxide AS carbon_monoxide,
+        hourly_nitrogen_dioxide AS nitrogen_dioxide,
+        hourly_nitrogen_monoxide AS nitrogen_monoxide,
+        hourly_ammonia AS ammonia,
+        hourly_ozone AS ozone,
+        hourly_sulphur_dioxide AS sulphur_dioxide,
+        hourly_pm2_5 AS pm2_5,
+        hourly_pm10 AS pm10
+    FROM historical_air_quality
+    WHERE location_id = %s;
+"""
+
+LIVE_AIR_QUALITY_QUERY = """
+    SELECT
+        timestamp,
+        air_quality_index,
+        carbon_monoxide,
+        nitrogen_dioxide,
+        nitrogen_monoxide,
+        ammonia,
+        ozone,
+        sulphur_dioxide,
+        pm2_5,
+        pm10
+    FROM air_quality_readings
+    WHERE location_id = %s;
+"""
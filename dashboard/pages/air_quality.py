@@ -1,16 +1,16 @@
 """Air quality page of the climate monitor dashboard"""
 
-import os
 import logging
 from datetime import date
 from dateutil.relativedelta import relativedelta
 
 import pandas as pd
 import streamlit as st
-import psycopg2
 from dotenv import load_dotenv
 import altair as alt
 from modules.nav import navbar
+from modules.locations import get_connection, get_location_registry_version
+from modules.queries import HISTORICAL_AIR_QUALITY_QUERY, LIVE_AIR_QUALITY_QUERY
 
 READINGS_IN_A_DAY = -96
 
@@ -22,20 +22,9 @@ logging.basicConfig(level=logging.INFO,
 HISTORIC_DATA_START_DATE = date(2020, 11, 27)
 
 
-def get_connection() -> psycopg2.extensions.connection:
-    """Returns connection to RDS."""
-    return psycopg2.connect(
-        dbname=os.environ["DB_NAME"],
-        user=os.environ["DB_USERNAME"],
-        password=os.environ["DB_PASSWORD"],
-        host=os.environ["DB_HOST"],
-        port=os.environ["DB_PORT"]
-    )
-
-
 @st.cache_data
-def get_locations() -> pd.DataFrame:
-    """Returns all locations"""
+def get_locations(version: int) -> pd.DataFrame:  # pylint: disable=unused-argument
+    """Returns all locations, cached until the location registry version changes"""
     try:
         with get_connection() as conn:
             logging.info("Connected to database.")
@@ -54,22 +43,8 @@ def get_historical_readings(location_id: int) -> pd.DataFrame:
     try:
         with get_connection() as conn:
             logging.info("Connected to database.")
-            query = f"""
-                SELECT
-                    timestamp,
-                    hourly_air_quality_index AS air_quality_index,
-                    hourly_carbon_monoxide AS carbon_monoxide,
-                    hourly_nitrogen_dioxide AS nitrogen_dioxide,
-                    hourly_nitrogen_monoxide AS nitrogen_monoxide,
-                    hourly_ammonia AS ammonia,
-                    hourly_ozone AS ozone,
-                    hourly_sulphur_dioxide AS sulphur_dioxide,
-                    hourly_pm2_5 AS pm2_5,
-                    hourly_pm10 AS pm10
-                FROM historical_air_quality
-                WHERE location_id = {location_id};
-            """
-        return pd.read_sql_query(query, conn)
+            return pd.read_sql_query(HISTORICAL_AIR_QUALITY_QUERY, conn,
+                                     params=(location_id,))
     except:
         logging.error("Unable to extract historical data from database")
         raise RuntimeError("Unable to connect to RDS")
@@ -81,22 +56,7 @@ def get_live_readings(location_id: int) -> pd.DataFrame:
     try:
         with get_connection() as conn:
             logging.info("Connected to database.")
-            query = """
-                SELECT
-                    timestamp,
-                    air_quality_index,
-                    carbon_monoxide,
-                    nitrogen_dioxide,
-                    nitrogen_monoxide,
-                    ammonia,
-                    ozone,
-                    sulphur_dioxide,
-                    pm2_5,
-                    pm10
-                FROM air_quality_readings
-                WHERE location_id = %s;
-            """
-        return pd.read_sql_query(query, conn, params=(location_id,))
+            return pd.read_sql_query(LIVE_AIR_QUALITY_QUERY, conn, params=(location_id,))
     except:
         logging.error("Unable to extract live data from database")
         raise RuntimeError("Unable to connect to RDS")
@@ -290,7 +250,7 @@ if __name__ == "__main__":
         layout="wide"
     )
 
-    locations = get_locations()
+    locations = get_locations(get_location_registry_version())
     chosen_location_id, location_name = locations_sidebar(locations)
 
     st.title(f"🫁 Air Quality for {location_name}")
@@ -1,39 +1,30 @@
 # pylint: disable=import-error
 """Weather Dashboard"""
-import os
 import datetime as dt
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 
-import psycopg2
-from dotenv import load_dotenv
 import altair as alt
 import streamlit as st
 from modules.nav import navbar
+from modules.locations import get_connection, get_location_registry_version
+from modules.queries import (BASELINE_AND_RANGE_WEATHER_QUERY, BASELINE_WEATHER_QUERY,
+                             FUTURE_PROJECTION_QUERY, RECENT_DAILY_WEATHER_QUERY)
 HISTORIC_DATA_START_DATE = dt.date(2020, 1, 1)
-
-
-def get_connection():
-    """get rds connection"""
-    load_dotenv()
-    conn = psycopg2.connect(
-        host=os.environ["DB_HOST"],
-        user=os.environ["DB_USERNAME"],
-        password=os.environ["DB_PASSWORD"],
-        dbname=os.environ["DB_NAME"],
-        port=5432)
-    return conn
+# The 1940-1960 baseline period, as a half-open date range
+BASELINE_START_DATE = dt.date(1940, 1, 1)
+BASELINE_END_DATE = dt.date(1961, 1, 1)
+# The year of predictions drawn over the charts
+FUTURE_TARGET_YEAR = 2045
 
 
 @st.cache_data(ttl="300")
-def load_recent_weather(location_id):
-    """loads recent weather from rds"""
+def load_recent_daily_weather(location_id):
+    """loads the daily rollups of recent weather from rds, one row per day"""
     conn = get_connection()
     cur = conn.cursor()
     try:
-        query = "select * from weather_readings WHERE location_id = %s"
-        parameter = (location_id,)
-        cur.execute(query, parameter)
+        cur.execute(RECENT_DAILY_WEATHER_QUERY, (location_id,))
         rows = cur.fetchall()
         columns = [desc[0] for desc in cur.description]
         df = pd.DataFrame(rows, columns=columns)
@@ -50,14 +41,13 @@ def load_past_weather(location_id, start_year=None, end_year=None):
     cur = conn.cursor()
     try:
         if start_year and end_year:
-            query = """select * from historical_weather_readings WHERE location_id = %s
-            AND (EXTRACT(YEAR FROM timestamp) BETWEEN 1940 AND 1960 
-            OR EXTRACT(YEAR FROM timestamp) BETWEEN %s AND %s);"""
-            parameters = (location_id, start_year, end_year)
+            query = BASELINE_AND_RANGE_WEATHER_QUERY
+            parameters = (location_id,
+                          BASELINE_START_DATE, BASELINE_END_DATE,
+                          dt.date(start_year, 1, 1), dt.date(end_year + 1, 1, 1))
         else:
-            query = """select * from historical_weather_readings WHERE location_id = %s
-            AND EXTRACT(YEAR FROM timestamp) BETWEEN 1940 AND 1960;"""
-            parameters = (location_id,)
+            query = BASELINE_WEATHER_QUERY
+            parameters = (location_id, BASELINE_START_DATE, BASELINE_END_DATE)
 
         cur.execute(query, parameters)
         rows = cur.fetchall()
@@ -70,15 +60,12 @@ def load_past_weather(location_id, start_year=None, end_year=None):
 
 
 @st.cache_data()
-def load_future_weather(location_id):
-    """loads future weather from rds"""
+def load_future_projection(location_id, target_year=FUTURE_TARGET_YEAR):
+    """loads the predictions of the target year by day of year from rds"""
     conn = get_connection()
     cur = conn.cursor()
     try:
-        query = "select * from future_weather_prediction WHERE location_id = %s AND EXTRACT(YEAR FROM date)=2045"
-        parameter = (location_id,)
-
-        cur.execute(query, parameter)
+        cur.execute(FUTURE_PROJECTION_QUERY, (location_id, target_year))
         rows = cur.fetchall()
         columns = [desc[0] for desc in cur.description]
         df = pd.DataFrame(rows, columns=columns)
@@ -89,8 +76,8 @@ def load_future_weather(location_id):
 
 
 @st.cache_data()
-def load_locations():
-    """loads locations from rds"""
+def load_locations(version: int):  # pylint: disable=unused-argument
+    """loads locations from rds, cached until the location registry version changes"""
     conn = get_connection()
     cur = conn.cursor()
     try:
@@ -115,14 +102,13 @@ def prepare_temperature_data(selected_location_id: int, date_range: tuple) -> pd
     start_year = start_date.year
     end_year = end_date.year
 
-    recent_filtered = load_recent_weather(selected_location_id)
+    recent_daily = load_recent_daily_weather(selected_location_id)
     historical_filtered = load_past_weather(
         selected_location_id, start_year, end_year)
-    future_filtered = load_future_weather(selected_location_id)
+    future_projection = load_future_projection(selected_location_id)
 
-    if not recent_filtered.empty:
-        recent_filtered['timestamp'] = pd.to_datetime(
-            recent_filtered['timestamp'])
+    if not recent_daily.empty:
+        recent_daily['date'] = pd.to_datetime(recent_daily['date'])
 
     if not historical_filtered.empty:
         historical_filtered['timestamp'] = pd.to_datetime(
@@ -130,10 +116,6 @@ def prepare_temperature_data(selected_location_id: int, date_range: tuple) -> pd
         historical_filtered['year'] = historical_filtered['timestamp'].dt.year
         historical_filtered['day_of_year'] = historical_filtered['timestamp'].dt.dayofyear
 
-    if not future_filtered.empty:
-        future_filtered['date'] = pd.to_datetime(future_filtered['date'])
-        future_filtered['day_of_year'] = future_filtered['date'].dt.dayofyear
-
     date_range_df = pd.DataFrame({
         'date': pd.date_range(start=start_date, end=end_date, freq='D')
     })
@@ -144,19 +126,14 @@ def prepare_temperature_data(selected_location_id: int, date_range: tuple) -> pd
 
     all_selected_data = []
 
-    if not recent_filtered.empty:
-        recent_in_range = recent_filtered[
-            (recent_filtered['timestamp'] >= start_date) &
-            (recent_filtered['timestamp'] <= end_date)
-        ].copy()
+    if not recent_daily.empty:
+        recent_in_range = recent_daily[
+            (recent_daily['date'] >= start_date) &
+            (recent_daily['date'] <= end_date)
+        ]
 
         if not recent_in_range.empty:
-            recent_daily = recent_in_range.groupby(
-                recent_in_range['timestamp'].dt.date
-            )['current_temperature'].mean().reset_index()
-            recent_daily.columns = ['date', 'temperature']
-            recent_daily['date'] = pd.to_datetime(recent_daily['date'])
-            all_selected_data.append(recent_daily)
+            all_selected_data.append(recent_in_range[['date', 'temperature']])
 
     if not historical_filtered.empty:
         historical_in_range = historical_filtered[
@@ -200,22 +177,16 @@ def prepare_temperature_data(selected_location_id: int, date_range: tuple) -> pd
                 'date', 'value', 'type']].dropna()
             datasets.append(baseline_mapped)
 
-    if not future_filtered.empty:
-        future_2045 = future_filtered[future_filtered['date'].dt.year == 2045].copy(
-        )
-
-        if not future_2045.empty:
-            future_temp = future_2045.groupby(
-                'day_of_year')['mean_temperature'].mean().reset_index()
-            future_temp.rename(
-                columns={'mean_temperature': 'future_value'}, inplace=True)
+    if not future_projection.empty:
+        future_temp = future_projection[['day_of_year', 'mean_temperature']].rename(
+            columns={'mean_temperature': 'future_value'})
 
-            future_mapped = date_range_df.merge(
-                future_temp, on='day_of_year', how='left')
-            future_mapped['type'] = '2045 Prediction'
-            future_mapped['value'] = future_mapped['future_value']
-            future_mapped = future_mapped[['date', 'value', 'type']].dropna()
-            datasets.append(future_mapped)
+        future_mapped = date_range_df.merge(
+            future_temp, on='day_of_year', how='left')
+        future_mapped['type'] = f'{FUTURE_TARGET_YEAR} Prediction'
+        future_mapped['value'] = future_mapped['future_value']
+        future_mapped = future_mapped[['date', 'value', 'type']].dropna()
+        datasets.append(future_mapped)
 
     if datasets:
         combined_data = pd.concat(datasets, ignore_index=True)
@@ -234,14 +205,13 @@ def prepare_rainfall_data(selected_location_id: int, date_range: tuple) -> pd.Da
     start_year = start_date.year
     end_year = end_date.year
 
-    recent_filtered = load_recent_weather(selected_location_id)
+    recent_daily = load_recent_daily_weather(selected_location_id)
     historical_filtered = load_past_weather(
         selected_location_id, start_year, end_year)
-    future_filtered = load_future_weather(selected_location_id)
+    future_projection = load_future_projection(selected_location_id)
 
-    if not recent_filtered.empty:
-        recent_filtered['timestamp'] = pd.to_datetime(
-            recent_filtered['timestamp'])
+    if not recent_daily.empty:
+        recent_daily['date'] = pd.to_datetime(recent_daily['date'])
 
     if not historical_filtered.empty:
         historical_filtered['timestamp'] = pd.to_datetime(
@@ -249,10 +219,6 @@ def prepare_rainfall_data(selected_location_id: int, date_range: tuple) -> pd.Da
         historical_filtered['year'] = historical_filtered['timestamp'].dt.year
         historical_filtered['day_of_year'] = historical_filtered['timestamp'].dt.dayofyear
 
-    if not future_filtered.empty:
-        future_filtered['date'] = pd.to_datetime(future_filtered['date'])
-        future_filtered['day_of_year'] = future_filtered['date'].dt.dayofyear
-
     date_range_df = pd.DataFrame({
         'date': pd.date_range(start=start_date, end=end_date, freq='D')
     })
@@ -263,19 +229,14 @@ def prepare_rainfall_data(selected_location_id: int, date_range: tuple) -> pd.Da
 
     all_selected_data = []
 
-    if not recent_filtered.empty:
-        recent_in_range = recent_filtered[
-            (recent_filtered['timestamp'] >= start_date) &
-            (recent_filtered['timestamp'] <= end_date)
-        ].copy()
+    if not recent_daily.empty:
+        recent_in_range = recent_daily[
+            (recent_daily['date'] >= start_date) &
+            (recent_daily['date'] <= end_date)
+        ]
 
         if not recent_in_range.empty:
-            recent_daily = recent_in_range.groupby(
-                recent_in_range['timestamp'].dt.date
-            )['rainfall_last_15_mins'].sum().reset_index()
-            recent_daily.columns = ['date', 'rainfall']
-            recent_daily['date'] = pd.to_datetime(recent_daily['date'])
-            all_selected_data.append(recent_daily)
+            all_selected_data.append(recent_in_range[['date', 'rainfall']])
 
     if not historical_filtered.empty:
         historical_in_range = historical_filtered[
@@ -320,22 +281,16 @@ def prepare_rainfall_data(selected_location_id: int, date_range: tuple) -> pd.Da
                 'date', 'value', 'type']].dropna()
             datasets.append(baseline_mapped)
 
-    if not future_filtered.empty:
-        future_2045 = future_filtered[future_filtered['date'].dt.year == 2045].copy(
-        )
+    if not future_projection.empty:
+        future_rain = future_projection[['day_of_year', 'total_rainfall']].rename(
+            columns={'total_rainfall': 'future_value'})
 
-        if not future_2045.empty:
-            future_rain = future_2045.groupby(
-                'day_of_year')['total_rainfall'].sum().reset_index()
-            future_rain.rename(
-                columns={'total_rainfall': 'future_value'}, inplace=True)
-
-            future_mapped = date_range_df.merge(
-                future_rain, on='day_of_year', how='left')
-            future_mapped['type'] = '2045 Prediction'
-            future_mapped['value'] = future_mapped['future_value']
-            future_mapped = future_mapped[['date', 'value', 'type']].dropna()
-            datasets.append(future_mapped)
+        future_mapped = date_range_df.merge(
+            future_rain, on='day_of_year', how='left')
+        future_mapped['type'] = f'{FUTURE_TARGET_YEAR} Prediction'
+        future_mapped['value'] = future_mapped['future_value']
+        future_mapped = future_mapped[['date', 'value', 'type']].dropna()
+        datasets.append(future_mapped)
 
     if datasets:
         combined_data = pd.concat(datasets, ignore_index=True)
@@ -354,14 +309,13 @@ def prepare_wind_speed_data(selected_location_id: int, date_range: tuple) -> pd.
     start_year = start_date.year
     end_year = end_date.year
 
-    recent_filtered = load_recent_weather(selected_location_id)
+    recent_daily = load_recent_daily_weather(selected_location_id)
     historical_filtered = load_past_weather(
         selected_location_id, start_year, end_year)
-    future_filtered = load_future_weather(selected_location_id)
+    future_projection = load_future_projection(selected_location_id)
 
-    if not recent_filtered.empty:
-        recent_filtered['timestamp'] = pd.to_datetime(
-            recent_filtered['timestamp'])
+    if not recent_daily.empty:
+        recent_daily['date'] = pd.to_datetime(recent_daily['date'])
 
     if not historical_filtered.empty:
         historical_filtered['timestamp'] = pd.to_datetime(
@@ -369,10 +323,6 @@ def prepare_wind_speed_data(selected_location_id: int, date_range: tuple) -> pd.
         historical_filtered['year'] = historical_filtered['timestamp'].dt.year
         historical_filtered['day_of_year'] = historical_filtered['timestamp'].dt.dayofyear
 
-    if not future_filtered.empty:
-        future_filtered['date'] = pd.to_datetime(future_filtered['date'])
-        future_filtered['day_of_year'] = future_filtered['date'].dt.dayofyear
-
     date_range_df = pd.DataFrame({
         'date': pd.date_range(start=start_date, end=end_date, freq='D')
     })
@@ -383,19 +333,14 @@ def prepare_wind_speed_data(selected_location_id: int, date_range: tuple) -> pd.
 
     all_selected_data = []
 
-    if not recent_filtered.empty:
-        recent_in_range = recent_filtered[
-            (recent_filtered['timestamp'] >= start_date) &
-            (recent_filtered['timestamp'] <= end_date)
-        ].copy()
+    if not recent_daily.empty:
+        recent_in_range = recent_daily[
+            (recent_daily['date'] >= start_date) &
+            (recent_daily['date'] <= end_date)
+        ]
 
         if not recent_in_range.empty:
-            recent_daily = recent_in_range.groupby(
-                recent_in_range['timestamp'].dt.date
-            )['wind_speed'].mean().reset_index()
-            recent_daily.columns = ['date', 'wind_speed']
-            recent_daily['date'] = pd.to_datetime(recent_daily['date'])
-            all_selected_data.append(recent_daily)
+            all_selected_data.append(recent_in_range[['date', 'wind_speed']])
 
     if not historical_filtered.empty:
         historical_in_range = historical_filtered[
@@ -439,22 +384,16 @@ def prepare_wind_speed_data(selected_location_id: int, date_range: tuple) -> pd.
                 'date', 'value', 'type']].dropna()
             datasets.append(baseline_mapped)
 
-    if not future_filtered.empty:
-        future_2045 = future_filtered[future_filtered['date'].dt.year == 2045].copy(
-        )
-
-        if not future_2045.empty:
-            future_wind = future_2045.groupby(
-                'day_of_year')['mean_wind_speed'].mean().reset_index()
-            future_wind.rename(
-                columns={'mean_wind_speed': 'future_value'}, inplace=True)
+    if not future_projection.empty:
+        future_wind = future_projection[['day_of_year', 'mean_wind_speed']].rename(
+            columns={'mean_wind_speed': 'future_value'})
 
-            future_mapped = date_range_df.merge(
-                future_wind, on='day_of_year', how='left')
-            future_mapped['type'] = '2045 Prediction'
-            future_mapped['value'] = future_mapped['future_value']
-            future_mapped = future_mapped[['date', 'value', 'type']].dropna()
-            datasets.append(future_mapped)
+        future_mapped = date_range_df.merge(
+            future_wind, on='day_of_year', how='left')
+        future_mapped['type'] = f'{FUTURE_TARGET_YEAR} Prediction'
+        future_mapped['value'] = future_mapped['future_value']
+        future_mapped = future_mapped[['date', 'value', 'type']].dropna()
+        datasets.append(future_mapped)
 
     if datasets:
         combined_data = pd.concat(datasets, ignore_index=True)
@@ -581,7 +520,7 @@ def main():
     st.title("🌦️ Weather Dashboard")
     st.divider()
 
-    locations_df = load_locations()
+    locations_df = load_locations(get_location_registry_version())
 
     if locations_df.empty:
         st.error("No locations found in the database")
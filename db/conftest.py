@@ -0,0 +1,2 @@
+# Folders with their own requirements are tested on their own
+collect_ignore = ["insert-location-data", "partition-maintenance"]
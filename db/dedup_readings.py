@@ -0,0 +1,121 @@
+"""
+Removes duplicate readings from the reading tables, compacts them and adds the
+natural key unique constraints used by the ON CONFLICT upserts in the extractors.
+Reports how many rows and bytes were reclaimed from each table.
+"""
+import logging
+from psycopg2 import connect, sql
+from psycopg2.extras import RealDictCursor
+from dotenv import dotenv_values
+
+logging.basicConfig(
+    format="%(levelname)s | %(asctime)s | %(message)s", level=logging.INFO)
+
+# Table name: (surrogate key column, natural key columns)
+READING_TABLES = {
+    "weather_readings": ("weather_reading_id", ("location_id", "timestamp")),
+    "air_quality_readings": ("air_quality_reading_id", ("location_id", "timestamp")),
+    "historical_weather_readings": ("historical_reading_id", ("location_id", "timestamp")),
+    "historical_air_quality": ("historical_air_quality_id", ("location_id", "timestamp")),
+    "future_weather_prediction": ("prediction_id", ("location_id", "date"))
+}
+
+
+def get_connection(config_values):
+    """connects to db"""
+    return connect(user=config_values['USER'],
+                   password=config_values['DBPASSWORD'],
+                   dbname=config_values['DBNAME'],
+                   port=config_values['PORT'],
+                   host=config_values['HOST'],
+                   sslmode="require",
+                   cursor_factory=RealDictCursor)
+
+
+def get_table_size(cur, table: str) -> int:
+    """returns the size on disk of a table and all its partitions, indexes and toast in bytes"""
+    cur.execute(("SELECT COALESCE(SUM(pg_total_relation_size(relid)), 0) AS size "
+                 "FROM pg_partition_tree(%s);"), (table,))
+    return cur.fetchone()["size"]
+
+
+def delete_duplicates(cur, table: str, id_column: str, key_columns: tuple) -> int:
+    """deletes all but the first stored row for each natural key and returns the count"""
+    query = sql.SQL("""
+        DELETE FROM {table}
+        WHERE {id_column} IN (
+            SELECT {id_column}
+            FROM (
+                SELECT {id_column},
+                       ROW_NUMBER() OVER (PARTITION BY {keys} ORDER BY {id_column}) AS row_number
+                FROM {table}
+            ) AS numbered
+            WHERE row_number > 1
+        );""").format(table=sql.Identifier(table),
+                      id_column=sql.Identifier(id_column),
+                      keys=sql.SQL(", ").join(map(sql.Identifier, key_columns)))
+    cur.execute(query)
+    return cur.rowcount
+
+
+def add_unique_constraint(cur, table: str, key_columns: tuple) -> None:
+    """adds the natural key unique constraint to a table if it does not have one"""
+    constraint = f"{table}_{'_'.join(key_columns)}_key"
+    cur.execute("SELECT 1 FROM pg_constraint WHERE conname = %s;", (constraint,))
+    if cur.fetchone():
+        return
+    cur.execute(sql.SQL("ALTER TABLE {table} ADD CONSTRAINT {constraint} UNIQUE ({keys});").format(
+        table=sql.Identifier(table),
+        constraint=sql.Identifier(constraint),
+        keys=sql.SQL(", ").join(map(sql.Identifier, key_columns))))
+    logging.info("Added unique constraint %s", constraint)
+
+
+def dedup_table(conn, table: str, id_column: str, key_columns: tuple) -> dict:
+    """
+    Removes duplicates from `table`, then runs VACUUM FULL to give the space back
+    to the operating system and adds the natural key constraint.
+    Returns a dict of the rows deleted and bytes reclaimed.
+    """
+    with conn.cursor() as cur:
+        size_before = get_table_size(cur, table)
+        rows_deleted = delete_duplicates(cur, table, id_column, key_columns)
+        add_unique_constraint(cur, table, key_columns)
+    conn.commit()
+
+    # VACUUM cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("VACUUM (FULL, ANALYZE) {table};").format(
+                table=sql.Identifier(table)))
+            size_after = get_table_size(cur, table)
+    finally:
+        conn.autocommit = False
+
+    result = {"table": table,
+              "rows_deleted": rows_deleted,
+              "bytes_reclaimed": size_before - size_after}
+    logging.info("%s: deleted %d duplicate rows, reclaimed %d bytes",
+                 table, rows_deleted, size_before - size_after)
+    return result
+
+
+def dedup_all(config) -> list[dict]:
+    """Runs the dedup and compaction for every reading table"""
+    conn = get_connection(config)
+    try:
+        return [dedup_table(conn, table, id_column, key_columns)
+                for table, (id_column, key_columns) in READING_TABLES.items()]
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    results = dedup_all(dotenv_values())
+    print(f"{'table':<30}{'rows deleted':>15}{'MB reclaimed':>15}")
+    for row in results:
+        print(f"{row['table']:<30}{row['rows_deleted']:>15}"
+              f"{row['bytes_reclaimed'] / 1024 ** 2:>15.1f}")
+    print(f"{'total':<30}{sum(row['rows_deleted'] for row in results):>15}"
+          f"{sum(row['bytes_reclaimed'] for row in results) / 1024 ** 2:>15.1f}")
@@ -1,12 +1,25 @@
 """Script to populate the tables in the database."""
 import os
-from time import sleep
+import sys
+import time
 import logging
 import json
+from collections import deque
+from datetime import timedelta
+from pathlib import Path
 from dotenv import load_dotenv
 import psycopg2
 import boto3  # pylint: disable=import-error
 
+# The API budget is shared with the new location orchestrator
+sys.path.append(str(Path(__file__).resolve().parents[2] / "shared"))
+# pylint: disable=wrong-import-position
+from open_meteo_budget import (API_LIMIT_HEADROOM, API_LIMITS, DAYS_PER_CALL,
+                               FUTURE_PREDICTIONS_FIRST_DATE, FUTURE_PREDICTIONS_LAST_DATE,
+                               FUTURE_PREDICTIONS_VARIABLES, HISTORIC_WEATHER_FIRST_DATE,
+                               HISTORIC_WEATHER_LAST_DATE, HISTORIC_WEATHER_VARIABLES,
+                               HOURS_PER_DAY, VARIABLES_PER_CALL)
+
 LAMBDA_NAME = "c18-climate-monitor-new-location-orchestrator-lambda"
 
 logging.basicConfig(
@@ -27,18 +40,116 @@ def get_connection() -> psycopg2.extensions.connection:
 
 
 def get_locations() -> list:
-    """Get locations from RDS."""
+    """
+    Get locations from RDS with the number of days of historical weather
+    already stored for each, since the orchestrator only requests missing days.
+    """
     conn = get_connection()
     try:
         with conn.cursor() as cur:
             cur.execute(
-                "SELECT location_id, latitude, longitude FROM locations")
+                """SELECT l.location_id, l.latitude, l.longitude,
+                   (SELECT COUNT(*) FROM historical_weather_readings AS h
+                    WHERE h.location_id = l.location_id
+                    AND h.timestamp >= %s AND h.timestamp < %s) / %s
+                   FROM locations AS l ORDER BY l.location_id;""",
+                (HISTORIC_WEATHER_FIRST_DATE, HISTORIC_WEATHER_LAST_DATE + timedelta(days=1),
+                 HOURS_PER_DAY))
             locations = cur.fetchall()
         return locations
     finally:
         conn.close()
 
 
+def get_request_weight(days: int, variables: int) -> float:
+    """The number of API calls Open-Meteo counts for one location over `days` days."""
+    if days <= 0:
+        return 0
+    return max(1, days / DAYS_PER_CALL) * max(1, variables / VARIABLES_PER_CALL)
+
+
+def get_location_weight(stored_days: int) -> float:
+    """The API calls used by the orchestrator to load a location."""
+    historic_days = (HISTORIC_WEATHER_LAST_DATE - HISTORIC_WEATHER_FIRST_DATE).days + 1
+    future_days = (FUTURE_PREDICTIONS_LAST_DATE - FUTURE_PREDICTIONS_FIRST_DATE).days + 1
+    return (get_request_weight(historic_days - stored_days, HISTORIC_WEATHER_VARIABLES)
+            + get_request_weight(future_days, FUTURE_PREDICTIONS_VARIABLES))
+
+
+class ApiQuota:
+    """Tracks the API calls used over rolling windows of time against their limits."""
+
+    def __init__(self, limits: dict[int, float], clock=time.monotonic):
+        self.limits = limits
+        self.clock = clock
+        self.usage = deque()
+
+    def wait_time(self, weight: float) -> float:
+        """
+        Seconds until `weight` calls fit within every limit. A weight larger than
+        a limit fits once nothing else is counted in that window.
+        """
+        now = self.clock()
+        wait = 0
+        for window, limit in self.limits.items():
+            recent = [(at, used) for at, used in self.usage if at > now - window]
+            excess = sum(used for _, used in recent) + weight - limit
+            for at, used in recent:
+                if excess <= 0:
+                    break
+                wait = max(wait, at + window - now)
+                excess -= used
+        return wait
+
+    def record(self, weight: float) -> None:
+        """Count `weight` calls as used now, forgetting usage older than every window."""
+        now = self.clock()
+        self.usage.append((now, weight))
+        while self.usage and self.usage[0][0] <= now - max(self.limits):
+            self.usage.popleft()
+
+    def get_eta(self, weight: float) -> float:
+        """Rough seconds needed to use `weight` more calls at the most restrictive limit."""
+        return max(weight / limit * window for window, limit in self.limits.items())
+
+
+def invoke(client, location: tuple) -> None:
+    """Invoke the new location orchestrator for a location."""
+    payload = {
+        "location_id": location[0],
+        "latitude": location[1],
+        "longitude": location[2]
+    }
+    logging.info("Invoking with payload: %s", str(payload))
+    response = client.invoke(
+        FunctionName=LAMBDA_NAME,
+        InvocationType="Event",
+        Payload=json.dumps(payload)
+    )
+    logging.info("Status code: %s",
+                 response['ResponseMetadata']['HTTPStatusCode'])
+
+
+def schedule(locations: list, client, quota: ApiQuota, sleep=time.sleep) -> None:
+    """
+    Invoke the orchestrator for every location in turn, each as soon as its
+    API calls fit within the quota.
+    """
+    weights = [get_location_weight(location[3]) for location in locations]
+    remaining = sum(weights)
+    for done, (location, weight) in enumerate(zip(locations, weights), start=1):
+        wait = quota.wait_time(weight)
+        if wait > 0:
+            logging.info("Waiting %s for API quota.", timedelta(seconds=round(wait)))
+            sleep(wait)
+        invoke(client, location)
+        quota.record(weight)
+        remaining -= weight
+        logging.info("Invoked %d/%d locations. About %.0f API calls left, ETA %s.",
+                     done, len(locations), remaining,
+                     timedelta(seconds=round(quota.get_eta(remaining))))
+
+
 if __name__ == "__main__":
     all_locations = get_locations()
     boto3.setup_default_session(
@@ -47,21 +158,6 @@ if __name__ == "__main__":
         region_name=os.getenv("MY_AWS_REGION")
     )
     lambda_client = boto3.client('lambda')
-    for location in all_locations:
-        payload = {
-            "location_id": location[0],
-            "latitude": location[1],
-            "longitude": location[2]
-        }
-        logging.info("Invoking with payload: %s", str(payload))
-        response = lambda_client.invoke(
-            FunctionName=LAMBDA_NAME,
-            InvocationType="Event",
-            Payload=json.dumps(payload)
-        )
-        logging.info("Status code: %s",
-                     response['ResponseMetadata']['HTTPStatusCode'])
-        # Respect API limit
-        # Each invocation uses 1500 calls and there is a 5000/hour limit
-        # so call every 20 minutes for 4500 calls per hour
-        sleep(20*60)
+    schedule(all_locations, lambda_client,
+             ApiQuota({window: limit * API_LIMIT_HEADROOM
+                       for window, limit in API_LIMITS.items()}))
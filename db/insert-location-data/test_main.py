@@ -0,0 +1,53 @@
+from unittest.mock import MagicMock
+import pytest
+import main
+from main import ApiQuota, get_request_weight, schedule
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_get_request_weight_counts_fractional_calls():
+    assert get_request_weight(28, 6) == 2
+    assert get_request_weight(7, 15) == 1.5
+    assert get_request_weight(140, 20) == 20
+    assert get_request_weight(0, 6) == 0
+
+
+def test_quota_waits_for_oldest_usage_to_expire():
+    clock = FakeClock()
+    quota = ApiQuota({3600: 100}, clock=clock)
+    quota.record(60)
+    clock.now = 600
+    quota.record(30)
+    assert quota.wait_time(10) == 0
+    assert quota.wait_time(20) == 3000
+    assert quota.wait_time(80) == 3600
+    # Larger than the limit, so it waits for the window to empty
+    assert quota.wait_time(500) == 3600
+
+
+def test_schedule_invokes_each_location_when_quota_allows(monkeypatch):
+    monkeypatch.setattr(main, "get_location_weight", lambda stored_days: 40)
+    clock = FakeClock()
+    quota = ApiQuota({3600: 100}, clock=clock)
+    client = MagicMock()
+    invoked_at = []
+
+    def record_invoke(**kwargs):
+        invoked_at.append((main.json.loads(kwargs["Payload"])["location_id"], clock.now))
+        return {"ResponseMetadata": {"HTTPStatusCode": 202}}
+
+    client.invoke.side_effect = record_invoke
+    locations = [(i, 50.0, -1.0, 0) for i in range(1, 5)]
+    schedule(locations, client, quota, sleep=clock.sleep)
+
+    assert invoked_at == [(1, 0), (2, 0), (3, 3600), (4, 3600)]
@@ -0,0 +1,59 @@
+"""Lambda handler to create the reading table partitions for the coming years."""
+import os
+from typing import Any
+import logging
+from dotenv import load_dotenv
+import psycopg2
+
+logging.basicConfig(
+    format="%(levelname)s | %(asctime)s | %(message)s", level=logging.INFO)
+
+load_dotenv()
+
+# Number of years ahead of the current year to create partitions for
+PARTITION_YEARS_AHEAD = int(os.getenv("PARTITION_YEARS_AHEAD", "1"))
+
+
+def get_connection() -> psycopg2.extensions.connection:
+    """Get connection to RDS."""
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        dbname=os.getenv("DB_NAME"),
+        port=os.getenv("DB_PORT")
+    )
+
+
+def create_future_partitions(years_ahead: int) -> None:
+    """Create any missing yearly partitions of the reading tables up to `years_ahead`."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT create_future_reading_partitions(%s)",
+                        (years_ahead,))
+        conn.commit()
+        logging.info("Reading partitions exist up to %d years ahead.", years_ahead)
+    finally:
+        conn.close()
+
+
+def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused-argument
+    """
+    Creates the yearly reading table partitions ahead of time.
+    Parameters:
+        event: Dict optionally containing the number of years ahead
+            e.g. {"years_ahead": 2}
+        context: Lambda runtime context
+    Returns:
+        Dict containing status message
+    """
+    create_future_partitions(event.get("years_ahead", PARTITION_YEARS_AHEAD))
+    return {
+        "statusCode": 200,
+        "message": "Reading partitions successfully created."
+    }
+
+
+if __name__ == "__main__":
+    print(lambda_handler({}, "context"))
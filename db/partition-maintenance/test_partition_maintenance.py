@@ -0,0 +1,119 @@
+# pylint: skip-file
+"""
+Tests for the partition maintenance lambda. The tests of create_yearly_partitions
+itself need TEST_DATABASE_URL, see db/test_query_plans.py.
+"""
+import os
+from datetime import date
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+import pytest
+from psycopg2 import connect
+import partition_maintenance
+from partition_maintenance import PARTITION_YEARS_AHEAD, lambda_handler
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+SCHEMA_NAME = "partition_test"
+DB_DIR = Path(__file__).parent.parent
+THIS_YEAR = date.today().year
+
+requires_database = pytest.mark.skipif(not TEST_DATABASE_URL,
+                                       reason="TEST_DATABASE_URL is not set")
+
+INSERT_READING = ("INSERT INTO weather_readings (timestamp, location_id, rainfall_last_15_mins, "
+                  "snowfall_last_15_mins, current_temperature, wind_speed, wind_gust_speed, "
+                  "wind_direction) VALUES (%s, 1, 0.0, 0.0, 15.0, 10.0, 20.0, 90);")
+
+
+@pytest.fixture
+def mock_conn():
+    conn = MagicMock()
+    with patch.object(partition_maintenance, "get_connection", return_value=conn):
+        yield conn
+
+
+def test_handler_creates_partitions_for_the_default_years(mock_conn):
+    response = lambda_handler({}, None)
+
+    cur = mock_conn.cursor.return_value.__enter__.return_value
+    cur.execute.assert_called_once_with("SELECT create_future_reading_partitions(%s)",
+                                        (PARTITION_YEARS_AHEAD,))
+    mock_conn.commit.assert_called_once()
+    mock_conn.close.assert_called_once()
+    assert response["statusCode"] == 200
+
+
+def test_handler_uses_years_ahead_from_the_event(mock_conn):
+    lambda_handler({"years_ahead": 3}, None)
+
+    cur = mock_conn.cursor.return_value.__enter__.return_value
+    cur.execute.assert_called_once_with("SELECT create_future_reading_partitions(%s)", (3,))
+
+
+def test_handler_closes_the_connection_on_failure(mock_conn):
+    cur = mock_conn.cursor.return_value.__enter__.return_value
+    cur.execute.side_effect = RuntimeError("permission denied")
+
+    with pytest.raises(RuntimeError):
+        lambda_handler({}, None)
+
+    mock_conn.commit.assert_not_called()
+    mock_conn.close.assert_called_once()
+
+
+@pytest.fixture
+def cur():
+    conn = connect(TEST_DATABASE_URL)
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA_NAME};")
+        cursor.execute(f"SET search_path TO {SCHEMA_NAME};")
+        cursor.execute((DB_DIR / "schema.sql").read_text())
+        cursor.execute((DB_DIR / "seed.sql").read_text())
+        yield cursor
+    # The schema was created in the same transaction, so rolling back drops it
+    conn.rollback()
+    conn.close()
+
+
+def get_partition(cur, timestamp: str) -> str:
+    cur.execute("SELECT tableoid::regclass::TEXT FROM weather_readings WHERE timestamp = %s;",
+                (timestamp,))
+    return cur.fetchone()[0]
+
+
+@requires_database
+def test_schema_creates_partitions_up_to_next_year(cur):
+    cur.execute("""SELECT to_regclass('weather_readings_' || %(year)s) IS NOT NULL,
+                   to_regclass('weather_readings_' || %(year)s + 1) IS NOT NULL,
+                   to_regclass('historical_weather_readings_' || %(year)s - 1) IS NOT NULL,
+                   to_regclass('historical_air_quality_' || %(year)s) IS NOT NULL;""",
+                {"year": THIS_YEAR})
+    assert cur.fetchone() == (True, True, True, True)
+
+
+@requires_database
+def test_new_partition_takes_readings_from_the_default_partition(cur):
+    later_year = THIS_YEAR + 3
+    cur.execute(INSERT_READING, (f"{later_year}-03-01 12:00:00",))
+    cur.execute(INSERT_READING, (f"{later_year + 1}-03-01 12:00:00",))
+    assert get_partition(cur, f"{later_year}-03-01 12:00:00") == "weather_readings_default"
+
+    cur.execute("SELECT create_future_reading_partitions(3);")
+
+    assert get_partition(cur, f"{later_year}-03-01 12:00:00") == f"weather_readings_{later_year}"
+    assert get_partition(cur, f"{later_year + 1}-03-01 12:00:00") == "weather_readings_default"
+    cur.execute("SELECT COUNT(*) FROM weather_readings;")
+    assert cur.fetchone()[0] == 2
+    # Moving the readings does not count them in the rollups again
+    cur.execute("SELECT SUM(reading_count) FROM weather_readings_daily;")
+    assert cur.fetchone()[0] == 2
+
+
+@requires_database
+def test_creating_existing_partitions_again_is_a_no_op(cur):
+    cur.execute(INSERT_READING, (f"{THIS_YEAR}-03-01 12:00:00",))
+
+    cur.execute("SELECT create_future_reading_partitions();")
+
+    assert get_partition(cur, f"{THIS_YEAR}-03-01 12:00:00") == f"weather_readings_{THIS_YEAR}"
@@ -1,8 +1,13 @@
+DROP TABLE IF EXISTS future_day_of_year_projection;
 DROP TABLE IF EXISTS future_weather_prediction;
 DROP TABLE IF EXISTS historical_weather_readings;
 DROP TABLE IF EXISTS historical_air_quality;
+DROP TABLE IF EXISTS weather_readings_hourly;
+DROP TABLE IF EXISTS weather_readings_daily;
 DROP TABLE IF EXISTS weather_readings;
 DROP TABLE IF EXISTS air_quality_readings;
+DROP TABLE IF EXISTS air_quality_last_seen;
+DROP TABLE IF EXISTS backfill_coverage;
 DROP TABLE IF EXISTS location_assignment;
 DROP TABLE IF EXISTS users;
 DROP TABLE IF EXISTS flood_area_assignment;
@@ -11,6 +16,11 @@ DROP TABLE IF EXISTS flood_warnings;
 DROP TABLE IF EXISTS historical_floods;
 DROP TABLE IF EXISTS flood_severity;
 DROP TABLE IF EXISTS flood_areas;
+DROP TABLE IF EXISTS location_registry;
+DROP FUNCTION IF EXISTS bump_location_registry_version;
+DROP FUNCTION IF EXISTS roll_up_weather_readings;
+DROP FUNCTION IF EXISTS create_future_reading_partitions;
+DROP FUNCTION IF EXISTS create_yearly_partitions;
 
 
 CREATE TABLE "users"(
@@ -32,6 +42,26 @@ CREATE TABLE "locations"(
     PRIMARY KEY (location_id)
 );
 
+-- Single row holding a version number which is bumped on every change to
+-- locations, so callers can cache the locations until the version changes
+CREATE TABLE "location_registry"(
+    "location_registry_id" BOOLEAN NOT NULL DEFAULT TRUE CHECK (location_registry_id),
+    "version" BIGINT NOT NULL DEFAULT 1,
+    PRIMARY KEY (location_registry_id)
+);
+INSERT INTO location_registry DEFAULT VALUES;
+
+CREATE FUNCTION bump_location_registry_version() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE location_registry SET version = version + 1;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER locations_bump_registry_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON locations
+    FOR EACH STATEMENT EXECUTE FUNCTION bump_location_registry_version();
+
 CREATE TABLE "location_assignment"(
     "location_assignment_id" INTEGER GENERATED ALWAYS AS IDENTITY,
     "user_id" INTEGER NOT NULL,
@@ -67,9 +97,10 @@ CREATE TABLE "weather_readings"(
     "wind_speed" FLOAT NOT NULL,
     "wind_gust_speed" FLOAT NOT NULL,
     "wind_direction" SMALLINT NOT NULL,
-    PRIMARY KEY (weather_reading_id),
+    PRIMARY KEY (weather_reading_id, timestamp),
+    UNIQUE (location_id, timestamp),
     FOREIGN KEY (location_id) REFERENCES locations(location_id)
-);
+) PARTITION BY RANGE (timestamp);
 CREATE TABLE "air_quality_readings"(
     "air_quality_reading_id" INTEGER GENERATED ALWAYS AS IDENTITY,
     "timestamp" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
@@ -83,7 +114,16 @@ CREATE TABLE "air_quality_readings"(
     "sulphur_dioxide" FLOAT NOT NULL,
     "pm2_5" FLOAT NOT NULL,
     "pm10" FLOAT NOT NULL,
-    PRIMARY KEY (air_quality_reading_id),
+    PRIMARY KEY (air_quality_reading_id, timestamp),
+    UNIQUE (location_id, timestamp),
+    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+) PARTITION BY RANGE (timestamp);
+-- Timestamp of the newest live air quality reading stored for each location,
+-- used by the live extractor to skip readings which have not changed
+CREATE TABLE "air_quality_last_seen"(
+    "location_id" INTEGER NOT NULL,
+    "last_timestamp" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    PRIMARY KEY (location_id),
     FOREIGN KEY (location_id) REFERENCES locations(location_id)
 );
 CREATE TABLE "flood_severity"(
@@ -118,10 +158,10 @@ CREATE TABLE "historical_weather_readings"(
     "hourly_wind_speed" FLOAT,
     "hourly_wind_gust_speed" FLOAT,
     "hourly_wind_direction" SMALLINT,
-    PRIMARY KEY (historical_reading_id),
+    PRIMARY KEY (historical_reading_id, timestamp),
+    UNIQUE (location_id, timestamp),
     FOREIGN KEY (location_id) REFERENCES locations(location_id)
-
-);
+) PARTITION BY RANGE (timestamp);
 CREATE TABLE "historical_air_quality"(
     "historical_air_quality_id" INTEGER GENERATED ALWAYS AS IDENTITY,
     "timestamp" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
@@ -135,7 +175,23 @@ CREATE TABLE "historical_air_quality"(
     "hourly_sulphur_dioxide" FLOAT,
     "hourly_pm2_5" FLOAT,
     "hourly_pm10" FLOAT,
-    PRIMARY KEY (historical_air_quality_id),
+    PRIMARY KEY (historical_air_quality_id, timestamp),
+    UNIQUE (location_id, timestamp),
+    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+) PARTITION BY RANGE (timestamp);
+
+-- Ledger of the date ranges each historical extractor has loaded per location
+-- and table, with the number of rows inserted for the range
+CREATE TABLE "backfill_coverage"(
+    "backfill_coverage_id" INTEGER GENERATED ALWAYS AS IDENTITY,
+    "location_id" INTEGER NOT NULL,
+    "table_name" TEXT NOT NULL,
+    "start_date" DATE NOT NULL,
+    "end_date" DATE NOT NULL,
+    "row_count" INTEGER NOT NULL,
+    "loaded_at" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (backfill_coverage_id),
+    UNIQUE (location_id, table_name, start_date, end_date),
     FOREIGN KEY (location_id) REFERENCES locations(location_id)
 );
 
@@ -162,11 +218,191 @@ CREATE TABLE "future_weather_prediction"(
     "mean_wind_speed" FLOAT,
     "max_wind_speed" FLOAT,
     PRIMARY KEY (prediction_id),
+    UNIQUE (location_id, date),
+    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+);
+
+-- Future predictions of each location by target year and day of year, as drawn
+-- over the weather charts of the dashboard. Maintained by the future predictions
+-- lambda whenever it loads predictions.
+CREATE TABLE "future_day_of_year_projection"(
+    "location_id" INTEGER NOT NULL,
+    "target_year" SMALLINT NOT NULL,
+    "day_of_year" SMALLINT NOT NULL,
+    "mean_temperature" FLOAT NOT NULL,
+    "total_rainfall" FLOAT NOT NULL,
+    "mean_wind_speed" FLOAT NOT NULL,
+    PRIMARY KEY (location_id, target_year, day_of_year),
     FOREIGN KEY (location_id) REFERENCES locations(location_id)
 );
 
-CREATE INDEX future_weather_prediction_location_id_index ON future_weather_prediction (location_id);
-CREATE INDEX historical_air_quality_location_id_index ON historical_air_quality (location_id);
-CREATE INDEX historical_weather_readings_location_id_index ON historical_weather_readings (location_id);
-CREATE INDEX air_quality_readings_location_id_index ON air_quality_readings (location_id);
-CREATE INDEX weather_readings_location_id_index ON weather_readings (location_id);
\ No newline at end of file
+-- Hourly and daily rollups of weather_readings, kept up to date by the
+-- roll_up_weather_readings trigger. Sums and counts are stored rather than
+-- averages so that rollups of separate inserts merge correctly.
+CREATE TABLE "weather_readings_hourly"(
+    "location_id" INTEGER NOT NULL,
+    "hour" TIMESTAMP(0) WITHOUT TIME ZONE NOT NULL,
+    "reading_count" INTEGER NOT NULL,
+    "temperature_sum" FLOAT NOT NULL,
+    "min_temperature" FLOAT NOT NULL,
+    "max_temperature" FLOAT NOT NULL,
+    "wind_speed_sum" FLOAT NOT NULL,
+    "max_wind_speed" FLOAT NOT NULL,
+    "max_wind_gust_speed" FLOAT NOT NULL,
+    "total_rainfall" FLOAT NOT NULL,
+    "total_snowfall" FLOAT NOT NULL,
+    PRIMARY KEY (location_id, hour),
+    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+);
+CREATE TABLE "weather_readings_daily"(
+    "location_id" INTEGER NOT NULL,
+    "date" DATE NOT NULL,
+    "reading_count" INTEGER NOT NULL,
+    "temperature_sum" FLOAT NOT NULL,
+    "min_temperature" FLOAT NOT NULL,
+    "max_temperature" FLOAT NOT NULL,
+    "wind_speed_sum" FLOAT NOT NULL,
+    "max_wind_speed" FLOAT NOT NULL,
+    "max_wind_gust_speed" FLOAT NOT NULL,
+    "total_rainfall" FLOAT NOT NULL,
+    "total_snowfall" FLOAT NOT NULL,
+    PRIMARY KEY (location_id, date),
+    FOREIGN KEY (location_id) REFERENCES locations(location_id)
+);
+
+-- The reading tables are partitioned by calendar year of their timestamp, so
+-- queries over a time range only scan the partitions for those years.
+-- Readings already caught by the default partition for a missing year are moved
+-- into the new partition, since Postgres refuses to create a partition while the
+-- default partition holds rows belonging to it.
+CREATE FUNCTION create_yearly_partitions(parent_table TEXT, first_year INTEGER, last_year INTEGER)
+RETURNS VOID AS $$
+DECLARE
+    partition_table TEXT;
+    default_table TEXT := parent_table || '_default';
+    year_start DATE;
+    year_end DATE;
+BEGIN
+    FOR partition_year IN first_year..last_year LOOP
+        partition_table := parent_table || '_' || partition_year;
+        year_start := make_date(partition_year, 1, 1);
+        year_end := make_date(partition_year + 1, 1, 1);
+        IF to_regclass(quote_ident(partition_table)) IS NOT NULL THEN
+            CONTINUE;
+        END IF;
+        IF to_regclass(quote_ident(default_table)) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                partition_table, parent_table, year_start, year_end);
+        ELSE
+            EXECUTE format(
+                'CREATE TABLE %I (LIKE %I INCLUDING DEFAULTS INCLUDING CONSTRAINTS)',
+                partition_table, parent_table);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM %I WHERE timestamp >= %L AND timestamp < %L RETURNING *) '
+                'INSERT INTO %I SELECT * FROM moved',
+                default_table, year_start, year_end, partition_table);
+            EXECUTE format(
+                'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                parent_table, partition_table, year_start, year_end);
+        END IF;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the partitions of every reading table up to `years_ahead` years from now,
+-- run on a schedule by db/partition-maintenance
+CREATE FUNCTION create_future_reading_partitions(years_ahead INTEGER DEFAULT 1)
+RETURNS VOID AS $$
+DECLARE
+    this_year INTEGER := EXTRACT(YEAR FROM CURRENT_DATE);
+BEGIN
+    PERFORM create_yearly_partitions('weather_readings', this_year, this_year + years_ahead);
+    PERFORM create_yearly_partitions('air_quality_readings', this_year, this_year + years_ahead);
+    PERFORM create_yearly_partitions('historical_weather_readings', this_year, this_year + years_ahead);
+    PERFORM create_yearly_partitions('historical_air_quality', this_year, this_year + years_ahead);
+END;
+$$ LANGUAGE plpgsql;
+
+-- Past years of the historical tables, from the first date each extractor loads
+SELECT create_yearly_partitions('historical_weather_readings', 1940,
+                                EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER - 1);
+SELECT create_yearly_partitions('historical_air_quality', 2020,
+                                EXTRACT(YEAR FROM CURRENT_DATE)::INTEGER - 1);
+SELECT create_future_reading_partitions();
+
+-- Catch any reading outside the yearly partitions rather than rejecting it
+CREATE TABLE weather_readings_default PARTITION OF weather_readings DEFAULT;
+CREATE TABLE air_quality_readings_default PARTITION OF air_quality_readings DEFAULT;
+CREATE TABLE historical_weather_readings_default PARTITION OF historical_weather_readings DEFAULT;
+CREATE TABLE historical_air_quality_default PARTITION OF historical_air_quality DEFAULT;
+
+-- Merges each batch of new weather readings into the hourly and daily rollups.
+-- The transition table only holds rows which were actually inserted, so
+-- readings skipped by ON CONFLICT DO NOTHING are not counted twice.
+CREATE FUNCTION roll_up_weather_readings() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO weather_readings_hourly AS rollup (location_id, hour, reading_count,
+        temperature_sum, min_temperature, max_temperature, wind_speed_sum, max_wind_speed,
+        max_wind_gust_speed, total_rainfall, total_snowfall)
+    SELECT location_id, date_trunc('hour', timestamp), COUNT(*),
+        SUM(current_temperature), MIN(current_temperature), MAX(current_temperature),
+        SUM(wind_speed), MAX(wind_speed), MAX(wind_gust_speed),
+        SUM(rainfall_last_15_mins), SUM(snowfall_last_15_mins)
+    FROM new_readings
+    GROUP BY 1, 2
+    ON CONFLICT (location_id, hour) DO UPDATE SET
+        reading_count = rollup.reading_count + EXCLUDED.reading_count,
+        temperature_sum = rollup.temperature_sum + EXCLUDED.temperature_sum,
+        min_temperature = LEAST(rollup.min_temperature, EXCLUDED.min_temperature),
+        max_temperature = GREATEST(rollup.max_temperature, EXCLUDED.max_temperature),
+        wind_speed_sum = rollup.wind_speed_sum + EXCLUDED.wind_speed_sum,
+        max_wind_speed = GREATEST(rollup.max_wind_speed, EXCLUDED.max_wind_speed),
+        max_wind_gust_speed = GREATEST(rollup.max_wind_gust_speed, EXCLUDED.max_wind_gust_speed),
+        total_rainfall = rollup.total_rainfall + EXCLUDED.total_rainfall,
+        total_snowfall = rollup.total_snowfall + EXCLUDED.total_snowfall;
+
+    INSERT INTO weather_readings_daily AS rollup (location_id, date, reading_count,
+        temperature_sum, min_temperature, max_temperature, wind_speed_sum, max_wind_speed,
+        max_wind_gust_speed, total_rainfall, total_snowfall)
+    SELECT location_id, timestamp::DATE, COUNT(*),
+        SUM(current_temperature), MIN(current_temperature), MAX(current_temperature),
+        SUM(wind_speed), MAX(wind_speed), MAX(wind_gust_speed),
+        SUM(rainfall_last_15_mins), SUM(snowfall_last_15_mins)
+    FROM new_readings
+    GROUP BY 1, 2
+    ON CONFLICT (location_id, date) DO UPDATE SET
+        reading_count = rollup.reading_count + EXCLUDED.reading_count,
+        temperature_sum = rollup.temperature_sum + EXCLUDED.temperature_sum,
+        min_temperature = LEAST(rollup.min_temperature, EXCLUDED.min_temperature),
+        max_temperature = GREATEST(rollup.max_temperature, EXCLUDED.max_temperature),
+        wind_speed_sum = rollup.wind_speed_sum + EXCLUDED.wind_speed_sum,
+        max_wind_speed = GREATEST(rollup.max_wind_speed, EXCLUDED.max_wind_speed),
+        max_wind_gust_speed = GREATEST(rollup.max_wind_gust_speed, EXCLUDED.max_wind_gust_speed),
+        total_rainfall = rollup.total_rainfall + EXCLUDED.total_rainfall,
+        total_snowfall = rollup.total_snowfall + EXCLUDED.total_snowfall;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER weather_readings_roll_up
+    AFTER INSERT ON weather_readings
+    REFERENCING NEW TABLE AS new_readings
+    FOR EACH STATEMENT EXECUTE FUNCTION roll_up_weather_readings();
+
+-- Lookups by location and time use the B-tree behind the UNIQUE (location_id, timestamp)
+-- and (location_id, date) constraints. BRIN indexes cover time-only filters across
+-- every location, such as the last 15 minutes or 24 hours of readings.
+CREATE INDEX weather_readings_timestamp_brin_index ON weather_readings USING BRIN (timestamp);
+CREATE INDEX air_quality_readings_timestamp_brin_index ON air_quality_readings USING BRIN (timestamp);
+CREATE INDEX historical_weather_readings_timestamp_brin_index ON historical_weather_readings USING BRIN (timestamp);
+CREATE INDEX historical_air_quality_timestamp_brin_index ON historical_air_quality USING BRIN (timestamp);
+
+-- Join paths between locations, users and flood areas
+CREATE INDEX location_assignment_location_id_index ON location_assignment (location_id);
+CREATE INDEX location_assignment_user_id_index ON location_assignment (user_id);
+CREATE INDEX flood_area_assignment_location_id_index ON flood_area_assignment (location_id);
+CREATE INDEX flood_area_assignment_flood_area_id_index ON flood_area_assignment (flood_area_id);
+CREATE INDEX flood_warnings_flood_area_id_index ON flood_warnings (flood_area_id);
+CREATE INDEX flood_warnings_unsent_index ON flood_warnings (flood_area_id) WHERE notifications_sent = FALSE;
+CREATE INDEX historical_floods_flood_area_id_index ON historical_floods (flood_area_id);
\ No newline at end of file
@@ -0,0 +1,28 @@
+# pylint: skip-file
+from unittest.mock import MagicMock
+from dedup_readings import add_unique_constraint, dedup_table
+
+
+def test_dedup_table_reports_rows_and_bytes():
+    conn = MagicMock()
+    cur = conn.cursor.return_value.__enter__.return_value
+    cur.fetchone.side_effect = [{"size": 5000}, (1,), {"size": 3000}]
+    cur.rowcount = 12
+
+    result = dedup_table(conn, "weather_readings", "weather_reading_id",
+                         ("location_id", "timestamp"))
+
+    assert result == {"table": "weather_readings",
+                      "rows_deleted": 12,
+                      "bytes_reclaimed": 2000}
+    conn.commit.assert_called_once()
+    assert conn.autocommit is False
+
+
+def test_add_unique_constraint_skips_existing_constraint():
+    cur = MagicMock()
+    cur.fetchone.return_value = (1,)
+    add_unique_constraint(cur, "weather_readings", ("location_id", "timestamp"))
+    cur.execute.assert_called_once_with(
+        "SELECT 1 FROM pg_constraint WHERE conname = %s;",
+        ("weather_readings_location_id_timestamp_key",))
@@ -0,0 +1,57 @@
+# pylint: skip-file
+"""
+Checks the hourly and daily weather rollups kept by the roll_up_weather_readings
+trigger match aggregates over the raw readings. Needs TEST_DATABASE_URL, see
+test_query_plans.py.
+"""
+import os
+from pathlib import Path
+import pytest
+from psycopg2 import connect
+from psycopg2.extras import execute_values
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+SCHEMA_NAME = "rollup_test"
+DB_DIR = Path(__file__).parent
+
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL,
+                                reason="TEST_DATABASE_URL is not set")
+
+INSERT_READINGS = ("INSERT INTO weather_readings (timestamp, location_id, rainfall_last_15_mins, "
+                   "snowfall_last_15_mins, current_temperature, wind_speed, wind_gust_speed, "
+                   "wind_direction) VALUES %s ON CONFLICT (location_id, timestamp) DO NOTHING;")
+
+
+@pytest.fixture
+def cur():
+    conn = connect(TEST_DATABASE_URL)
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP SCHEMA IF EXISTS {SCHEMA_NAME} CASCADE;")
+        cursor.execute(f"CREATE SCHEMA {SCHEMA_NAME};")
+        cursor.execute(f"SET search_path TO {SCHEMA_NAME};")
+        cursor.execute((DB_DIR / "schema.sql").read_text())
+        cursor.execute((DB_DIR / "seed.sql").read_text())
+        yield cursor
+    # The schema was created in the same transaction, so rolling back drops it
+    conn.rollback()
+    conn.close()
+
+
+def test_rollups_merge_separate_inserts(cur):
+    execute_values(cur, INSERT_READINGS, [
+        ("2025-06-01 10:00:00", 1, 1.0, 0.0, 14.0, 10.0, 20.0, 90),
+        ("2025-06-01 10:15:00", 1, 0.5, 0.0, 16.0, 20.0, 30.0, 90),
+        ("2025-06-01 11:00:00", 1, 0.0, 0.0, 18.0, 30.0, 25.0, 90)])
+    execute_values(cur, INSERT_READINGS, [
+        ("2025-06-01 10:30:00", 1, 2.0, 0.0, 12.0, 30.0, 40.0, 90),
+        ("2025-06-01 10:00:00", 1, 9.0, 9.0, 99.0, 99.0, 99.0, 90)])
+
+    cur.execute("""SELECT reading_count, temperature_sum / reading_count, min_temperature,
+                   max_temperature, wind_speed_sum / reading_count, max_wind_gust_speed,
+                   total_rainfall
+                   FROM weather_readings_hourly WHERE location_id = 1 AND hour = '2025-06-01 10:00';""")
+    assert cur.fetchone() == (3, 14.0, 12.0, 16.0, 20.0, 40.0, 3.5)
+
+    cur.execute("""SELECT reading_count, temperature_sum / reading_count, max_temperature, total_rainfall
+                   FROM weather_readings_daily WHERE location_id = 1 AND date = '2025-06-01';""")
+    assert cur.fetchone() == (4, 15.0, 18.0, 3.5)
@@ -0,0 +1,139 @@
+"""
+Compares turning a climate API response into rows with the previous per-row loop
+against the vectorised to_columns path, over a recorded response.
+No response is committed with the repository. Record one from the API once
+(for London by default, or --latitude and --longitude):
+    python benchmark_ingest.py --fixture climate_response.json --record --years 25
+and later runs replay it without network access:
+    python benchmark_ingest.py --fixture climate_response.json
+Without --fixture a synthetic response of `--years` is used. With `--location-id`
+the rows are also loaded into the database in .env, comparing execute_values with COPY;
+run that against a test database.
+"""
+import argparse
+import json
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import numpy as np
+from psycopg2.extras import execute_values
+from extract_future import (API_ENDPOINT, DAILY_VARIABLES, fetch_climate_data, get_conn,
+                            insert_rows, to_columns)
+
+REPEATS = 5
+
+
+def record_fixture(path: Path, years: int, lat: float, lon: float) -> None:
+    """Save a real API response for `years` years from 2025 to replay later."""
+    url = API_ENDPOINT.format(lat=lat, lon=lon, start="2025-01-01",
+                              end=f"{2025 + years - 1}-12-31")
+    path.write_text(json.dumps(fetch_climate_data(url)))
+
+
+def make_response(years: int) -> dict:
+    """A synthetic response shaped like the climate API, with a few null values."""
+    days = [date(2025, 1, 1) + timedelta(days=i) for i in range(round(years * 365.25))]
+    rng = np.random.default_rng(0)
+    daily = {"time": [day.isoformat() for day in days]}
+    for variable in DAILY_VARIABLES:
+        values = np.round(rng.uniform(0, 30, len(days)), 1).tolist()
+        for i in range(0, len(values), 997):
+            values[i] = None
+        daily[variable] = values
+    return {"daily": daily}
+
+
+def loop_rows(location_id: int, data: dict) -> list:
+    """The previous path: parse and validate every value in a Python loop."""
+    rows = []
+    for (day, mean_temp, max_temp, min_temp, total_rain, total_snow,
+         mean_wind, max_wind) in zip(data['time'], data['temperature_2m_mean'],
+                                     data['temperature_2m_max'], data['temperature_2m_min'],
+                                     data['rain_sum'], data['snowfall_sum'],
+                                     data['wind_speed_10m_mean'], data['wind_speed_10m_max']):
+        try:
+            rows.append((datetime.strptime(day, "%Y-%m-%d").date(), location_id,
+                         float(mean_temp), float(max_temp), float(min_temp), float(total_rain),
+                         float(total_snow), float(mean_wind), float(max_wind)))
+        except (ValueError, TypeError):
+            continue
+    return rows
+
+
+def load_loop_rows(location_id: int, data: dict) -> None:
+    """The previous loader: the loop's tuples inserted with execute_values."""
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, "INSERT INTO future_weather_prediction (date, location_id, "
+                           "mean_temperature, max_temperature, min_temperature, total_rainfall, "
+                           "total_snowfall, mean_wind_speed, max_wind_speed) VALUES %s "
+                           "ON CONFLICT (location_id, date) DO NOTHING",
+                           loop_rows(location_id, data))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_columns(location_id: int, data: dict) -> None:
+    """The vectorised loader used by the lambda."""
+    insert_rows(location_id, *to_columns(data))
+
+
+def delete_rows(location_id: int, data: dict) -> None:
+    """Remove the benchmark rows so every run inserts the same data."""
+    conn = get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM future_weather_prediction "
+                        "WHERE location_id = %s AND date BETWEEN %s AND %s;",
+                        (location_id, data["time"][0], data["time"][-1]))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def rows_per_second(function, rows: int, *args, before=None) -> float:
+    """The best rows per second of REPEATS runs of function(*args)."""
+    best = float("inf")
+    for _ in range(REPEATS):
+        if before is not None:
+            before(*args)
+        start = time.perf_counter()
+        function(*args)
+        best = min(best, time.perf_counter() - start)
+    return rows / best
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--fixture", type=Path)
+    parser.add_argument("--record", action="store_true")
+    parser.add_argument("--years", type=int, default=25)
+    parser.add_argument("--latitude", type=float, default=51.507351)
+    parser.add_argument("--longitude", type=float, default=-0.127758)
+    parser.add_argument("--location-id", type=int)
+    args = parser.parse_args()
+
+    if args.fixture and args.record:
+        record_fixture(args.fixture, args.years, args.latitude, args.longitude)
+    if args.fixture:
+        if not args.fixture.exists():
+            parser.error(f"{args.fixture} does not exist, record it first with --record")
+        daily_data = json.loads(args.fixture.read_text())["daily"]
+    else:
+        daily_data = make_response(args.years)["daily"]
+
+    row_count = len(daily_data["time"])
+    print(f"{row_count} days")
+    print(f"{'stage':<20}{'loop rows/s':>14}{'vectorised rows/s':>20}")
+    print(f"{'parse':<20}{rows_per_second(loop_rows, row_count, 1, daily_data):>14.0f}"
+          f"{rows_per_second(to_columns, row_count, daily_data):>20.0f}")
+    if args.location_id is not None:
+        loop_speed = rows_per_second(load_loop_rows, row_count, args.location_id, daily_data,
+                                     before=delete_rows)
+        columns_speed = rows_per_second(load_columns, row_count, args.location_id, daily_data,
+                                        before=delete_rows)
+        print(f"{'parse and load':<20}{loop_speed:>14.0f}{columns_speed:>20.0f}")
+        delete_rows(args.location_id, daily_data)
@@ -1,9 +1,13 @@
 """Extract future modelled weather and inserts into database"""
-from datetime import datetime
+import io
 import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from psycopg2 import connect
-from psycopg2.extras import RealDictCursor, execute_values
+from psycopg2.extras import RealDictCursor
 
 from dotenv import load_dotenv
 from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
@@ -14,6 +18,67 @@ API_ENDPOINT = (
     "temperature_2m_min,wind_speed_10m_mean,wind_speed_10m_max,"
     "rain_sum,snowfall_sum"
 )
+# Open-Meteo daily variables and the columns they are stored in, in insert order
+DAILY_VARIABLES = {
+    "temperature_2m_mean": "mean_temperature",
+    "temperature_2m_max": "max_temperature",
+    "temperature_2m_min": "min_temperature",
+    "rain_sum": "total_rainfall",
+    "snowfall_sum": "total_snowfall",
+    "wind_speed_10m_mean": "mean_wind_speed",
+    "wind_speed_10m_max": "max_wind_speed"
+}
+DAILY_COLUMNS = ", ".join(DAILY_VARIABLES.values())
+# COPY cannot skip conflicting rows, so rows are copied into a staging table
+# and moved across with INSERT ... ON CONFLICT DO NOTHING
+CREATE_STAGING_TABLE = ("CREATE TEMP TABLE future_weather_staging (date DATE, "
+                        + ", ".join(f"{column} FLOAT" for column in DAILY_VARIABLES.values())
+                        + ") ON COMMIT DROP;")
+COPY_STAGING_TABLE = (f"COPY future_weather_staging (date, {DAILY_COLUMNS}) "
+                      "FROM STDIN WITH (FORMAT csv);")
+INSERT_FROM_STAGING = (f"INSERT INTO future_weather_prediction (location_id, date, {DAILY_COLUMNS}) "
+                       f"SELECT %s, date, {DAILY_COLUMNS} FROM future_weather_staging "
+                       "ON CONFLICT (location_id, date) DO NOTHING;")
+# Rebuilds the dashboard's per day of year projection of the staged days from the
+# stored predictions, so it matches them whether or not the staged rows were inserted
+UPSERT_PROJECTION = ("INSERT INTO future_day_of_year_projection (location_id, target_year, "
+                     "day_of_year, mean_temperature, total_rainfall, mean_wind_speed) "
+                     "SELECT location_id, EXTRACT(YEAR FROM date), EXTRACT(DOY FROM date), "
+                     "AVG(mean_temperature), SUM(total_rainfall), AVG(mean_wind_speed) "
+                     "FROM future_weather_prediction "
+                     "WHERE location_id = %s "
+                     "AND date IN (SELECT date FROM future_weather_staging) GROUP BY 1, 2, 3 "
+                     "ON CONFLICT (location_id, target_year, day_of_year) DO UPDATE SET "
+                     "mean_temperature = EXCLUDED.mean_temperature, "
+                     "total_rainfall = EXCLUDED.total_rainfall, "
+                     "mean_wind_speed = EXCLUDED.mean_wind_speed;")
+
+# A full range is requested in windows of WINDOW_YEARS, FETCH_CONCURRENCY at a time
+# over the shared session, and committed through one connection
+WINDOW_YEARS = int(os.getenv("WINDOW_YEARS", "5"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "5"))
+# Last day of the EC_Earth3P_HR projections loaded
+LAST_PREDICTION_DATE = "2049-12-31"
+
+# Connection pool size and request timeout of the shared climate API session
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_TIMEOUT = int(os.getenv("HTTP_TIMEOUT", "10"))
+# Attempts tenacity makes at each climate API request, the session itself never retries
+FETCH_ATTEMPTS = int(os.getenv("FETCH_ATTEMPTS", "5"))
+
+_session = None
+
+
+def get_session() -> requests.Session:
+    """gets the shared keep-alive session, creating it on first use"""
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE,
+                              pool_maxsize=HTTP_POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
 
 
 def get_conn():
@@ -35,80 +100,159 @@ def get_conn():
 
 
 @retry(
-    stop=stop_after_attempt(5),
+    stop=stop_after_attempt(FETCH_ATTEMPTS),
     wait=wait_random_exponential(multiplier=1, max=60),
     retry=retry_if_exception_type(
         (requests.exceptions.RequestException, KeyError, ValueError))
 )
 def fetch_climate_data(url: str) -> dict:
     """get request to endpoint with backoff-retry"""
-    response = requests.get(url, timeout=10)
+    response = get_session().get(url, timeout=HTTP_TIMEOUT)
     json_data = response.json()
     if 'daily' not in json_data:
         raise KeyError("Missing 'daily' in response")
     return json_data
 
 
-def extract_future_data(location_id: int, lat: float, lon: float, start: str, end: str) -> list:
-    """extracts the future climate data and returns a list of tuples"""
+def to_date_array(values: list) -> np.ndarray:
+    """
+    Convert ISO date strings to a datetime64 array in one pass,
+    with NaT for any value which is not a valid date.
+    """
+    try:
+        return np.array(values, dtype="datetime64[D]")
+    except (ValueError, TypeError):
+        # Only malformed responses take the slow path
+        return np.array([to_date(value) for value in values], dtype="datetime64[D]")
+
+
+def to_date(value) -> np.datetime64:
+    """Convert one ISO date string to datetime64, or NaT if it is not valid."""
+    try:
+        return np.datetime64(value, "D")
+    except (ValueError, TypeError):
+        return np.datetime64("NaT")
+
+
+def to_float_array(values: list) -> np.ndarray:
+    """
+    Convert numbers to a float array in one pass,
+    with NaN for nulls and any value which is not a number.
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        # Only malformed responses take the slow path
+        return np.array([to_float(value) for value in values], dtype=np.float64)
+
+
+def to_float(value) -> float:
+    """Convert one value to float, or NaN if it is not a number."""
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return np.nan
+
+
+def to_columns(data: dict) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Turn the daily arrays of a response into a date array and a dict of
+    column name: float array, dropping every row with a missing or invalid value.
+    """
+    dates = to_date_array(data['time'])
+    columns = {column: to_float_array(data[variable])
+               for variable, column in DAILY_VARIABLES.items()}
+    valid = ~np.isnat(dates)
+    for values in columns.values():
+        valid &= ~np.isnan(values)
+    return dates[valid], {column: values[valid] for column, values in columns.items()}
+
+
+def extract_future_data(lat: float, lon: float,
+                        start: str, end: str) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """extracts the future climate data and returns the valid rows as columns"""
     url = API_ENDPOINT.format(lat=lat, lon=lon, start=start, end=end)
     response = fetch_climate_data(url)
-    data = response['daily']
-    rows = []
-    for (date,
-         mean_temp,
-         max_temp,
-         min_temp,
-         total_rain,
-         total_snow,
-         mean_wind,
-         max_wind) in zip(data['time'], data['temperature_2m_mean'], data['temperature_2m_max'],
-                          data['temperature_2m_min'], data['rain_sum'], data['snowfall_sum'],
-                          data['wind_speed_10m_mean'], data['wind_speed_10m_max']):
-        try:
-            date = datetime.strptime(date, "%Y-%m-%d").date()
-            mean_temp = float(mean_temp)
-            max_temp = float(max_temp)
-            min_temp = float(min_temp)
-            total_rain = float(total_rain)
-            total_snow = float(total_snow)
-            mean_wind = float(mean_wind)
-            max_wind = float(max_wind)
-            rows.append((date, location_id, mean_temp, max_temp,
-                        min_temp, total_rain, total_snow, mean_wind, max_wind))
-        except (ValueError, TypeError):
-            continue
-    return rows
-
-
-def insert_rows(data: list):
-    """Inserts data into database"""
-    query = 'INSERT INTO future_weather_prediction (date, location_id, mean_temperature, max_temperature, min_temperature, total_rainfall, total_snowfall, mean_wind_speed, max_wind_speed) ' \
-        'VALUES %s'
+    return to_columns(response['daily'])
+
+
+def iter_windows(start: str, end: str, years: int = WINDOW_YEARS) -> list[tuple[str, str]]:
+    """splits an inclusive date range into windows of at most `years` calendar years"""
+    windows = []
+    start_date, end_date = date.fromisoformat(start), date.fromisoformat(end)
+    while start_date <= end_date:
+        window_end = min(end_date, date(start_date.year + years - 1, 12, 31))
+        windows.append((start_date.isoformat(), window_end.isoformat()))
+        start_date = date(window_end.year + 1, 1, 1)
+    return windows
+
+
+def extract_future_range(lat: float, lon: float,
+                         start: str, end: str) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    extracts the windows of a date range concurrently and joins their columns in order,
+    raising the first window failure once every window has finished
+    """
+    windows = iter_windows(start, end)
+    if not windows:
+        # The range is empty, e.g. a start date after LAST_PREDICTION_DATE
+        return (np.array([], dtype="datetime64[D]"),
+                {column: np.array([], dtype=np.float64) for column in DAILY_VARIABLES.values()})
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        results = list(executor.map(
+            lambda window: extract_future_data(lat, lon, *window), windows))
+    dates = np.concatenate([window_dates for window_dates, _ in results])
+    columns = {column: np.concatenate([window_columns[column] for _, window_columns in results])
+               for column in DAILY_VARIABLES.values()}
+    return dates, columns
+
+
+def format_csv(dates: np.ndarray, columns: dict[str, np.ndarray]) -> str:
+    """Format daily columns as CSV rows for COPY"""
+    rows = dates.astype(str)
+    for values in columns.values():
+        rows = np.char.add(np.char.add(rows, ","), values.astype(str))
+    return "\n".join(rows) + "\n"
+
+
+def insert_rows(location_id: int, dates: np.ndarray, columns: dict[str, np.ndarray]) -> int:
+    """
+    Inserts data into database with COPY, refreshing the day of year projection
+    of the same days, and returns the number of new rows
+    """
+    if len(dates) == 0:
+        # COPY rejects the empty CSV of no rows, and there is nothing to insert
+        return 0
     conn = get_conn()
-    cur = conn.cursor()
     try:
-        execute_values(cur, query, data)
+        with conn.cursor() as cur:
+            cur.execute(CREATE_STAGING_TABLE)
+            cur.copy_expert(COPY_STAGING_TABLE, io.StringIO(format_csv(dates, columns)))
+            cur.execute(INSERT_FROM_STAGING, (location_id,))
+            inserted = cur.rowcount
+            cur.execute(UPSERT_PROJECTION, (location_id,))
         conn.commit()
     finally:
-        cur.close()
         conn.close()
+    return inserted
 
 
 def lambda_handler(event: dict, context) -> dict:  # pylint: disable=unused-argument
     """
-    Uploads future weather predictions weather data for given location_id and date range.
+    Uploads future weather predictions weather data for given location_id and date range,
+    by default from tomorrow until LAST_PREDICTION_DATE.
     Parameters:
-        event: Dict containing the location_id, start_date and end_date 
+        event: Dict containing the location_id, and optionally start_date and end_date 
             e.g. {"location_id": 1, "latitude": 51.507351, "longitude": -0.127758,
                   "start_date": "2040-01-01", "end_date": "2041-01-01"}
         context: Lambda runtime context
     Returns:
         Dict containing status message
     """
-    rows = extract_future_data(event['location_id'], event['latitude'],
-                               event['longitude'], event['start_date'], event['end_date'])
-    insert_rows(rows)
+    start = event.get('start_date', (date.today() + timedelta(days=1)).isoformat())
+    end = event.get('end_date', LAST_PREDICTION_DATE)
+    dates, columns = extract_future_range(event['latitude'], event['longitude'], start, end)
+    insert_rows(event['location_id'], dates, columns)
     return {
         "statusCode": 200,
         "message": "Future weather data successfully inserted."
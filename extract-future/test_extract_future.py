@@ -1,7 +1,17 @@
 # pylint: skip-file
+import time
 from datetime import date
+from unittest.mock import patch
+import numpy as np
+import pytest
 
-from extract_future import extract_future_data
+from extract_future import (API_ENDPOINT, extract_future_data, extract_future_range,
+                            format_csv, insert_rows, iter_windows, lambda_handler, to_columns)
+
+
+def first_row(result):
+    dates, columns = result
+    return (dates[0].item(), *(values[0] for values in columns.values()))
 
 MOCK_RESPONSE = {
     'daily': {
@@ -35,11 +45,11 @@ def test_extract_valid_data(requests_mock):
     requests_mock.get(MOCK_ENDPOINT,
                       json=MOCK_RESPONSE)
     result = extract_future_data(
-        location_id=1, lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
+        lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
 
-    assert len(result) == 2
-    assert result[0] == (
-        date(2025, 8, 1), 1, 22.5, 28.0, 17.5, 1.2, 0.0, 5.2, 12.5
+    assert len(result[0]) == 2
+    assert first_row(result) == (
+        date(2025, 8, 1), 22.5, 28.0, 17.5, 1.2, 0.0, 5.2, 12.5
     )
 
 
@@ -52,9 +62,9 @@ def test_extract_with_invalid_numbers(requests_mock):
                       json=bad_data)
 
     result = extract_future_data(
-        location_id=1, lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
-    assert len(result) == 1
-    assert result[0][0] == date(2025, 8, 1)
+        lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
+    assert len(result[0]) == 1
+    assert first_row(result)[0] == date(2025, 8, 1)
 
 
 def test_extract_with_bad_date(requests_mock):
@@ -63,6 +73,96 @@ def test_extract_with_bad_date(requests_mock):
                       json=BAD_MOCK)
 
     result = extract_future_data(
-        location_id=1, lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
-    assert len(result) == 1
-    assert result[0][0] == date(2025, 8, 2)
+        lat=10.0, lon=20.0, start="2025-08-01", end="2025-08-02")
+    assert len(result[0]) == 1
+    assert first_row(result)[0] == date(2025, 8, 2)
+
+
+def test_to_columns_drops_null_values():
+    daily = {key: list(values) for key, values in MOCK_RESPONSE['daily'].items()}
+    daily['time'] = ["2025-08-01", "2025-08-02", "2025-08-03"]
+    for key in daily:
+        if key != 'time':
+            daily[key] = daily[key][:2] + [1.0]
+    daily['rain_sum'][1] = None
+    dates, columns = to_columns(daily)
+    assert dates.tolist() == [date(2025, 8, 1), date(2025, 8, 3)]
+    assert columns['total_rainfall'].tolist() == [1.2, 1.0]
+
+
+def test_format_csv():
+    dates = np.array(["2025-08-01", "2025-08-02"], dtype="datetime64[D]")
+    columns = {"mean_temperature": np.array([22.5, 23.0]),
+               "total_rainfall": np.array([1.2, 0.0])}
+    assert format_csv(dates, columns) == "2025-08-01,22.5,1.2\n2025-08-02,23.0,0.0\n"
+
+
+def test_iter_windows_splits_range_by_years():
+    assert iter_windows("2025-08-02", "2036-03-01", years=5) == [
+        ("2025-08-02", "2029-12-31"), ("2030-01-01", "2034-12-31"), ("2035-01-01", "2036-03-01")]
+
+
+def make_daily(days):
+    return {'daily': {'time': days, **{variable: [1.0] * len(days) for variable in
+                                       MOCK_RESPONSE['daily'] if variable != 'time'}}}
+
+
+@patch("extract_future.insert_rows")
+def test_lambda_handler_fetches_windows_and_inserts_once(mock_insert_rows, requests_mock):
+    for start, end in [("2025-12-31", "2029-12-31"), ("2030-01-01", "2030-01-02")]:
+        requests_mock.get(API_ENDPOINT.format(lat=10.0, lon=20.0, start=start, end=end),
+                          json=make_daily([start, end]))
+    lambda_handler({"location_id": 1, "latitude": 10.0, "longitude": 20.0,
+                    "start_date": "2025-12-31", "end_date": "2030-01-02"}, None)
+    assert requests_mock.call_count == 2
+    location_id, dates, columns = mock_insert_rows.call_args.args
+    assert location_id == 1
+    assert dates.astype(str).tolist() == ["2025-12-31", "2029-12-31", "2030-01-01", "2030-01-02"]
+    assert len(columns["max_wind_speed"]) == 4
+
+
+@patch("extract_future.get_conn")
+def test_insert_rows_refreshes_projection(mock_get_conn):
+    cursor = mock_get_conn.return_value.cursor.return_value.__enter__.return_value
+    cursor.rowcount = 1
+    dates = np.array(["2045-08-01"], dtype="datetime64[D]")
+    insert_rows(1, dates, {"mean_temperature": np.array([22.5])})
+    statements = [c.args[0] for c in cursor.execute.call_args_list]
+    assert statements[1].startswith("INSERT INTO future_weather_prediction")
+    assert statements[2].startswith("INSERT INTO future_day_of_year_projection")
+    # Built from the stored rows, which conflicting staged rows do not replace
+    assert "FROM future_weather_prediction" in statements[2]
+    assert cursor.execute.call_args_list[2].args[1] == (1,)
+    mock_get_conn.return_value.commit.assert_called_once()
+
+
+@patch("extract_future.get_conn")
+def test_insert_rows_skips_empty_ranges(mock_get_conn):
+    dates = np.array([], dtype="datetime64[D]")
+    assert insert_rows(1, dates, {"mean_temperature": np.array([])}) == 0
+    mock_get_conn.assert_not_called()
+
+
+@patch("extract_future.insert_rows")
+def test_empty_range_inserts_nothing(mock_insert_rows, requests_mock):
+    lambda_handler({"location_id": 1, "latitude": 10.0, "longitude": 20.0,
+                    "start_date": "2050-01-01", "end_date": "2049-12-31"}, None)
+    assert requests_mock.call_count == 0
+    location_id, dates, columns = mock_insert_rows.call_args.args
+    assert len(dates) == 0 and len(columns["max_wind_speed"]) == 0
+
+
+def test_window_failure_is_raised_after_the_other_windows_finish():
+    finished = []
+
+    def extract_window(lat, lon, start, end):
+        if start == "2025-01-01":
+            raise RuntimeError("climate API unavailable")
+        time.sleep(0.05)
+        finished.append(start)
+        return to_columns(make_daily([start])["daily"])
+
+    with patch("extract_future.extract_future_data", side_effect=extract_window):
+        with pytest.raises(RuntimeError, match="climate API unavailable"):
+            extract_future_range(10.0, 20.0, "2025-01-01", "2039-12-31")
+    assert sorted(finished) == ["2030-01-01", "2035-01-01"]
@@ -0,0 +1,6 @@
+# pylint: skip-file
+import sys
+from pathlib import Path
+
+# The rate limiter is shared with the live air quality lambda
+sys.path.append(str(Path(__file__).resolve().parents[2] / "shared"))
@@ -4,16 +4,21 @@ The data is inserted into the historical_air_quality table in the RDS
 """
 
 import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import Any
+from typing import Any, Iterator
 import logging
-import random
 
 from dotenv import load_dotenv
+import ijson
 import psycopg2
 from psycopg2.extras import execute_values
 import requests as req
-from retry_requests import retry
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import HTTPError
+from owm_rate_limit import TokenBucket, get_retry_after, make_bucket
 
 
 load_dotenv()
@@ -22,9 +27,48 @@ logging.basicConfig(level=logging.INFO,
                     format='%(levelname)s: %(message)s')
 
 HISTORIC_DATA_START_DATE = int(datetime(2020, 11, 27, 0, 0, 0).timestamp())
+HOUR_SECONDS = 3600
+
+# In incremental mode every location is refreshed with the hours after its latest
+# stored reading, so the run is cheap enough to schedule daily
+INCREMENTAL_MODE = "incremental"
+LATEST_READINGS_QUERY = """
+    SELECT l.location_id, l.latitude, l.longitude, latest.timestamp
+    FROM locations AS l
+    LEFT JOIN LATERAL (
+        SELECT h.timestamp
+        FROM historical_air_quality AS h
+        WHERE h.location_id = l.location_id
+        ORDER BY h.timestamp DESC
+        LIMIT 1
+    ) AS latest ON TRUE
+    {where}
+    ORDER BY l.location_id;
+"""
 
 API_ENDPOINT = "http://api.openweathermap.org/data/2.5/air_pollution/history"
 
+# Connection pool size of the shared OpenWeatherMap session, and the retry policy
+# of each time slice, which waits HTTP_BACKOFF_FACTOR seconds doubled on each attempt.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "6"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "2"))
+RETRY_STATUSES = (500, 502, 503, 504)
+
+# Readings are inserted in batches of this many, as soon as their slice has arrived
+INSERT_BATCH_SIZE = int(os.getenv("INSERT_BATCH_SIZE", "2000"))
+
+# The history is split into slices of SLICE_DAYS which are fetched concurrently,
+# FETCH_CONCURRENCY at a time, and retried on their own if they fail. All requests
+# share one limit of OWM_REQUESTS_PER_MINUTE, this lambda's part of the API key's limit.
+SLICE_DAYS = int(os.getenv("SLICE_DAYS", "180"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+OWM_REQUESTS_PER_MINUTE = float(os.getenv("OWM_REQUESTS_PER_MINUTE", "60"))
+THROTTLED_STATUS = 429
+
+_session = None
+_bucket = None
+
 
 def get_connection() -> psycopg2.extensions.connection:
     """Get connection to RDS."""
@@ -37,36 +81,70 @@ def get_connection() -> psycopg2.extensions.connection:
     )
 
 
-def get_air_quality(location_id: int, lat: float, lon: float) -> list[tuple]:
+def get_session() -> req.Session:
     """
-    Make a request to the OpenWeather API and retrieve the historic air pollution data.
-    Return the data as a list of tuples.
+    Get the shared OpenWeatherMap session, creating it on first use.
+    The keep-alive session is reused between warm invocations. Failed requests
+    are retried by fetch_slice, not the session.
     """
-    retry_session = retry(req.Session(),
-                          retries=6,
-                          backoff_factor=random.uniform(1, 3))
-    api_response = retry_session.get(
-        API_ENDPOINT + (
-            f"?lat={lat}&lon={lon}"
-            f"&start={HISTORIC_DATA_START_DATE}&end={int(datetime.now().timestamp())}"
-            f"&appid={os.getenv("api_key")}"
-        )
-    )
-    if api_response.status_code != 200:
-        print(api_response.content)
-        raise RuntimeError(
-            f"Error reaching the API for location ID {location_id}. "
-            f"Error code: {api_response.status_code}. "
-            f"Message: {api_response.json()["message"]}")
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        _session = req.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE)
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
 
-    aq_data = api_response.json()["list"]
 
-    logging.info("Data retrieved from API for location ID %d", location_id)
+def get_latest_readings(conn: psycopg2.extensions.connection,
+                        location_id: int | None = None) -> list[tuple]:
+    """
+    Get the location_id, latitude, longitude and latest stored reading time,
+    or None, of every location, or of only `location_id` if given.
+    """
+    with conn.cursor() as cur:
+        if location_id is None:
+            cur.execute(LATEST_READINGS_QUERY.format(where=""))
+        else:
+            cur.execute(LATEST_READINGS_QUERY.format(where="WHERE l.location_id = %s"),
+                        (location_id,))
+        return cur.fetchall()
+
 
-    data_to_insert = []
+def get_start_time(latest_timestamp: datetime | None) -> int:
+    """The unix time of the first hour which is not stored yet."""
+    if latest_timestamp is None:
+        return HISTORIC_DATA_START_DATE
+    # Readings are stored in local time by datetime.fromtimestamp
+    return int(latest_timestamp.timestamp()) + HOUR_SECONDS
 
-    for reading in aq_data:
-        row = (
+
+def get_bucket() -> TokenBucket:
+    """Get the rate limiter shared by every request, creating it on first use."""
+    global _bucket  # pylint: disable=global-statement
+    if _bucket is None:
+        _bucket = make_bucket(OWM_REQUESTS_PER_MINUTE, FETCH_CONCURRENCY)
+    return _bucket
+
+
+def get_time_slices(start: int, end: int, slice_days: int) -> list[tuple[int, int]]:
+    """
+    Split the unix time range from start to end into consecutive,
+    non overlapping slices of slice_days.
+    """
+    slice_seconds = slice_days * 24 * HOUR_SECONDS
+    return [(slice_start, min(slice_start + slice_seconds - 1, end))
+            for slice_start in range(start, end, slice_seconds)]
+
+
+def parse_readings(api_response: req.Response, location_id: int) -> list[tuple]:
+    """Parse the readings of a streamed response into a list of tuples as it is read."""
+    # Let urllib3 decompress the body, since ijson reads the raw stream
+    api_response.raw.decode_content = True
+    with api_response:
+        return [(
             datetime.fromtimestamp(reading["dt"]),
             location_id,
             reading["main"]["aqi"],
@@ -78,54 +156,180 @@ def get_air_quality(location_id: int, lat: float, lon: float) -> list[tuple]:
             reading["components"]["so2"],
             reading["components"]["pm2_5"],
             reading["components"]["pm10"]
-        )
-        data_to_insert.append(row)
+        ) for reading in ijson.items(api_response.raw, "list.item", use_float=True)]
 
-    return data_to_insert
 
+def fetch_slice(location_id: int, lat: float, lon: float, start: int, end: int) -> list[tuple]:
+    """
+    Retrieve the historic air pollution data of one time slice as a list of tuples.
+    Throttled requests, server errors, connection errors and responses cut off while
+    streaming are retried for this slice alone, up to HTTP_RETRIES attempts in all.
+    """
+    for attempt in range(1, HTTP_RETRIES + 1):
+        get_bucket().acquire()
+        try:
+            api_response = get_session().get(
+                API_ENDPOINT + (
+                    f"?lat={lat}&lon={lon}"
+                    f"&start={start}&end={end}"
+                    f"&appid={os.getenv("api_key")}"
+                ),
+                stream=True
+            )
+            if api_response.status_code == THROTTLED_STATUS:
+                logging.warning("Throttled fetching location ID %d, attempt %d.",
+                                location_id, attempt)
+                retry_after = get_retry_after(api_response, get_bucket())
+                # Release the pooled connection of the unread streamed body
+                api_response.close()
+                time.sleep(retry_after)
+                continue
+            if api_response.status_code in RETRY_STATUSES:
+                logging.warning("Server error %d fetching location ID %d, attempt %d.",
+                                api_response.status_code, location_id, attempt)
+                api_response.close()
+                time.sleep(HTTP_BACKOFF_FACTOR * 2 ** (attempt - 1))
+                continue
+            if api_response.status_code != 200:
+                with api_response:
+                    logging.error("Error code %d fetching location ID %d: %s",
+                                  api_response.status_code, location_id, api_response.text)
+                    raise RuntimeError(
+                        f"Error reaching the API for location ID {location_id}. "
+                        f"Error code: {api_response.status_code}. "
+                        f"Message: {api_response.json()["message"]}")
+            return parse_readings(api_response, location_id)
+        except (req.exceptions.RequestException, HTTPError, ijson.JSONError) as e:
+            logging.warning("Error fetching location ID %d from %d to %d, attempt %d: %s",
+                            location_id, start, end, attempt, str(e))
+            time.sleep(HTTP_BACKOFF_FACTOR * 2 ** (attempt - 1))
+    raise RuntimeError(f"Failed to fetch location ID {location_id} from {start} to {end} "
+                       f"after {HTTP_RETRIES} attempts.")
+
+
+def get_air_quality(location_id: int, lat: float, lon: float,
+                    start: int = HISTORIC_DATA_START_DATE,
+                    batch_size: int = INSERT_BATCH_SIZE) -> Iterator[list[tuple]]:
+    """
+    Make requests to the OpenWeather API and retrieve the historic air pollution data
+    from the unix time `start` until now, fetching its time slices concurrently.
+    Yield the data in time order as lists of up to `batch_size` tuples, as soon as
+    each slice has arrived.
+    """
+    slices = get_time_slices(start, int(datetime.now().timestamp()), SLICE_DAYS)
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        # Only a few slices are fetched ahead of the one being inserted,
+        # so memory use does not grow with the length of the history
+        pending = deque()
+        for time_slice in slices:
+            pending.append(executor.submit(fetch_slice, location_id, lat, lon, *time_slice))
+            if len(pending) > FETCH_CONCURRENCY:
+                yield from iter_batches(pending.popleft().result(), batch_size)
+        while pending:
+            yield from iter_batches(pending.popleft().result(), batch_size)
+
+    logging.info("Data retrieved from API for location ID %d", location_id)
+
+
+def iter_batches(rows: list[tuple], batch_size: int) -> Iterator[list[tuple]]:
+    """Split rows into lists of up to batch_size."""
+    for i in range(0, len(rows), batch_size):
+        yield rows[i:i + batch_size]
+
+
+def insert_aq_data(conn: psycopg2.extensions.connection,
+                   data_to_insert: list[tuple]) -> None:
+    """Insert a batch of historical air quality data into RDS"""
+    with conn.cursor() as cur:
+        execute_values(
+            cur,
+            """INSERT INTO historical_air_quality (
+                    timestamp,
+                    location_id,
+                    hourly_air_quality_index,
+                    hourly_carbon_monoxide,
+                    hourly_nitrogen_dioxide,
+                    hourly_nitrogen_monoxide,
+                    hourly_ammonia,
+                    hourly_ozone,
+                    hourly_sulphur_dioxide,
+                    hourly_pm2_5,
+                    hourly_pm10
+                ) VALUES %s
+                ON CONFLICT (location_id, timestamp) DO NOTHING
+            """,
+            data_to_insert,
+            page_size=len(data_to_insert))
+    conn.commit()
+    logging.info("%d rows inserted into database for location ID %d",
+                 len(data_to_insert), data_to_insert[0][1])
 
-def insert_aq_data(data_to_insert: list[tuple]) -> None:
-    """Insert historical air quality data into RDS"""
-    try:
-        conn = get_connection()
-        with conn.cursor() as cur:
-            execute_values(
-                cur,
-                """INSERT INTO historical_air_quality (
-                        timestamp,
-                        location_id,
-                        hourly_air_quality_index,
-                        hourly_carbon_monoxide,
-                        hourly_nitrogen_dioxide,
-                        hourly_nitrogen_monoxide,
-                        hourly_ammonia,
-                        hourly_ozone,
-                        hourly_sulphur_dioxide,
-                        hourly_pm2_5,
-                        hourly_pm10
-                    ) VALUES %s
-                """,
-                data_to_insert)
-        conn.commit()
-        logging.info(
-            "Data inserted into database for location ID %d", data_to_insert[0][1])
-    finally:
-        conn.close()
+
+def load_location(conn: psycopg2.extensions.connection, location_id: int,
+                  lat: float, lon: float, latest_timestamp: datetime | None) -> int:
+    """
+    Load the hours of air quality after `latest_timestamp` for a location,
+    inserting each batch as soon as it is parsed. Returns the rows fetched.
+    """
+    start = get_start_time(latest_timestamp)
+    if start > datetime.now().timestamp():
+        return 0
+    rows = 0
+    for data_to_insert in get_air_quality(location_id, lat, lon, start):
+        insert_aq_data(conn, data_to_insert)
+        rows += len(data_to_insert)
+    return rows
+
+
+def load_locations(conn: psycopg2.extensions.connection,
+                   locations: list[tuple]) -> tuple[int, list[int]]:
+    """
+    Load every location in turn. A location which fails is logged and its
+    uncommitted batch rolled back, so the rest are still loaded.
+    Returns the rows fetched and the IDs of the failed locations.
+    """
+    rows = 0
+    failed_locations = []
+    for location in locations:
+        try:
+            rows += load_location(conn, *location)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Error loading location ID %d: %s", location[0], str(e))
+            failed_locations.append(location[0])
+            # A lost connection fails every later location too
+            if conn.closed:
+                raise
+            conn.rollback()
+    return rows, failed_locations
 
 
 def lambda_handler(event: dict, context: Any = None):  # pylint: disable=unused-argument
     """
     Run the functions to retrieve the data and insert it into the RDS
-    Takes in an event dictionary with an ID, lat, and lon 
+    Takes in an event dictionary with an ID, lat, and lon, or {"mode": "incremental"}
+    to refresh every location. Only the hours after a location's latest stored
+    reading are requested. The IDs of locations which failed are returned
+    in "failed_locations".
     """
+    conn = get_connection()
+    try:
+        if event.get("mode") == INCREMENTAL_MODE:
+            locations = get_latest_readings(conn)
+        else:
+            latest_readings = get_latest_readings(conn, event["location_id"])
+            latest_timestamp = latest_readings[0][3] if latest_readings else None
+            locations = [(event["location_id"], event["latitude"], event["longitude"],
+                          latest_timestamp)]
+        rows, failed_locations = load_locations(conn, locations)
+    finally:
+        conn.close()
 
-    data_to_insert = get_air_quality(
-        event["location_id"], event["latitude"], event["longitude"])
-    insert_aq_data(data_to_insert)
-
+    logging.info("%d readings fetched for %d locations, %d failed.",
+                 rows, len(locations), len(failed_locations))
     return {
         "statusCode": 200,
-        "message": "Historical data successfully inserted."
+        "message": "Historical data successfully inserted.",
+        "failed_locations": failed_locations
     }
 
 
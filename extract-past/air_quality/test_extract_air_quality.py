@@ -1,13 +1,29 @@
 import os
+import threading
 from datetime import datetime
+from unittest.mock import MagicMock, patch
 import pytest
+import requests
 from dotenv import load_dotenv
 
-from extract_air_quality import HISTORIC_DATA_START_DATE, get_air_quality
+import extract_air_quality
+from extract_air_quality import (API_ENDPOINT, HISTORIC_DATA_START_DATE, get_air_quality,
+                                 get_start_time, lambda_handler, fetch_slice, get_time_slices)
 
 load_dotenv()
 
 
+@pytest.fixture(autouse=True)
+def single_slice(monkeypatch):
+    """
+    Fetch the whole history in one slice unless a test sets SLICE_DAYS,
+    without rate limit or waiting between retries
+    """
+    monkeypatch.setattr(extract_air_quality, "SLICE_DAYS", 10000)
+    monkeypatch.setattr(extract_air_quality, "HTTP_BACKOFF_FACTOR", 0)
+    monkeypatch.setattr(extract_air_quality, "_bucket", extract_air_quality.TokenBucket(1000, 10))
+
+
 @pytest.fixture
 def api_response():
     return {
@@ -63,20 +79,138 @@ def api_error():
 def test_returns_valid_data_from_api(requests_mock, api_response):
     mock = requests_mock.get(
         f"http://api.openweathermap.org/data/2.5/air_pollution/history?lat=51.507351&lon=-0.127758&start={HISTORIC_DATA_START_DATE}&end={int(datetime.now().timestamp())}&appid={os.getenv("api_key")}", json=api_response, status_code=200)
-    mocked_response = get_air_quality(1, 51.507351, -0.127758)
+    mocked_response = list(get_air_quality(1, 51.507351, -0.127758))
     assert mock.call_count == 1
-    assert mocked_response == [
+    assert mocked_response == [[
         (datetime(2020, 11, 27, 0, 0), 1, 2, 347.14, 41.13,
          33.53, 0.25, 0.01, 7.51, 18.81, 21.35),
         (datetime(2020, 11, 27, 1, 0), 1, 2, 293.73, 42.16,
          11.18, 0.01, 0.21, 7.27, 15.68, 18.17)
-    ]
+    ]]
+
+
+def test_yields_readings_in_batches(requests_mock, api_response):
+    api_response["list"].append(dict(api_response["list"][0], dt=1606442400))
+    requests_mock.get(API_ENDPOINT, json=api_response, status_code=200)
+    batches = list(get_air_quality(1, 51.507351, -0.127758, batch_size=2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[1][0][0] == datetime.fromtimestamp(1606442400)
+    assert isinstance(batches[1][0][3], float)
 
 
 def test_invalid_api_key_raises_error(requests_mock, api_error):
     mock = requests_mock.get(
         f"http://api.openweathermap.org/data/2.5/air_pollution/history?lat=51.507351&lon=-0.127758&start={HISTORIC_DATA_START_DATE}&end={int(datetime.now().timestamp())}&appid={os.getenv("api_key")}", json=api_error, status_code=401)
     with pytest.raises(RuntimeError) as err:
-        get_air_quality(1, 51.507351, -0.127758)
+        next(get_air_quality(1, 51.507351, -0.127758))
     assert mock.call_count == 1
     assert str(err.value) == "Error reaching the API for location ID 1. Error code: 401. Message: Invalid API key. Please see https://openweathermap.org/faq#error401 for more info."
+
+
+def test_start_time_is_the_hour_after_the_latest_reading():
+    assert get_start_time(None) == HISTORIC_DATA_START_DATE
+    assert get_start_time(datetime.fromtimestamp(1606435200)) == 1606438800
+
+
+@patch("extract_air_quality.insert_aq_data")
+@patch("extract_air_quality.get_air_quality")
+@patch("extract_air_quality.get_connection")
+def test_incremental_mode_requests_only_new_hours(mock_get_connection, mock_get_air_quality,
+                                                  mock_insert_aq_data):
+    conn = MagicMock()
+    mock_get_connection.return_value = conn
+    conn.cursor.return_value.__enter__.return_value.fetchall.return_value = [
+        (1, 51.5, -0.1, datetime.fromtimestamp(1606435200)),
+        (2, 50.4, -4.2, None),
+        (3, 52.5, -1.9, datetime.now())]
+    mock_get_air_quality.side_effect = lambda *_: iter([[("row",)]])
+    ret = lambda_handler({"mode": "incremental"})
+    assert [c.args for c in mock_get_air_quality.call_args_list] == [
+        (1, 51.5, -0.1, 1606438800),
+        (2, 50.4, -4.2, HISTORIC_DATA_START_DATE)]
+    assert mock_insert_aq_data.call_count == 2
+    conn.close.assert_called_once()
+    assert ret["statusCode"] == 200
+
+
+@patch("extract_air_quality.insert_aq_data")
+@patch("extract_air_quality.get_air_quality")
+@patch("extract_air_quality.get_connection")
+def test_incremental_mode_carries_on_past_a_failed_location(mock_get_connection,
+                                                            mock_get_air_quality,
+                                                            mock_insert_aq_data):
+    conn = MagicMock(closed=0)
+    mock_get_connection.return_value = conn
+    conn.cursor.return_value.__enter__.return_value.fetchall.return_value = [
+        (1, 51.5, -0.1, None), (2, 50.4, -4.2, None), (3, 52.5, -1.9, None)]
+    mock_get_air_quality.side_effect = lambda location_id, *_: iter([[("row", location_id)]])
+    mock_insert_aq_data.side_effect = [None, RuntimeError("deadlock detected"), None]
+    ret = lambda_handler({"mode": "incremental"})
+    assert mock_insert_aq_data.call_count == 3
+    conn.rollback.assert_called_once()
+    conn.close.assert_called_once()
+    assert ret["failed_locations"] == [2]
+
+
+def test_time_slices_cover_range_without_overlap():
+    day = 24 * 3600
+    assert get_time_slices(0, 5 * day, 2) == [
+        (0, 2 * day - 1), (2 * day, 4 * day - 1), (4 * day, 5 * day)]
+
+
+def test_slices_are_fetched_concurrently_and_yielded_in_order(monkeypatch):
+    monkeypatch.setattr(extract_air_quality, "SLICE_DAYS", 1)
+    now = int(datetime.now().timestamp())
+    # Every slice has to be in flight before any can return
+    in_flight = threading.Barrier(3, timeout=5)
+    last_slice_done = threading.Event()
+    slice_order = []
+
+    def fetch_slice(location_id, lat, lon, start, end):
+        in_flight.wait()
+        # The last slice arrives first
+        if start == now - 24 * 3600:
+            slice_order.append(start)
+            last_slice_done.set()
+        else:
+            assert last_slice_done.wait(timeout=5)
+            slice_order.append(start)
+        return [(start, location_id)]
+
+    with patch("extract_air_quality.fetch_slice", side_effect=fetch_slice):
+        with patch("extract_air_quality.datetime") as mock_datetime:
+            mock_datetime.now.return_value.timestamp.return_value = now
+            batches = list(get_air_quality(1, 51.5, -0.1, start=now - 3 * 24 * 3600))
+    starts = [batch[0][0] for batch in batches]
+    assert starts == sorted(starts) and len(starts) == 3
+    assert slice_order[0] == starts[-1]
+
+
+def test_failed_slice_is_retried_alone(requests_mock, api_response):
+    mock = requests_mock.get(API_ENDPOINT, [
+        {"exc": requests.exceptions.ConnectionError},
+        {"status_code": 429, "headers": {"Retry-After": "0"}},
+        {"status_code": 502},
+        {"json": api_response, "status_code": 200}])
+    rows = fetch_slice(1, 51.5, -0.1, 1606435200, 1606438800)
+    assert mock.call_count == 4
+    assert "start=1606435200&end=1606438800" in mock.last_request.url
+    assert [row[0] for row in rows] == [datetime(2020, 11, 27, 0, 0),
+                                        datetime(2020, 11, 27, 1, 0)]
+
+
+def test_retried_responses_are_closed(requests_mock, api_response):
+    requests_mock.get(API_ENDPOINT, [
+        {"status_code": 429, "headers": {"Retry-After": "0"}},
+        {"status_code": 502},
+        {"json": api_response, "status_code": 200}])
+    with patch.object(requests.Response, "close", autospec=True) as mock_close:
+        fetch_slice(1, 51.5, -0.1, 1606435200, 1606438800)
+    assert [c.args[0].status_code for c in mock_close.call_args_list] == [429, 502, 200]
+
+
+def test_slice_retries_are_not_multiplied_by_the_session(requests_mock):
+    mock = requests_mock.get(API_ENDPOINT, status_code=500)
+    with pytest.raises(RuntimeError):
+        fetch_slice(1, 51.5, -0.1, 1606435200, 1606438800)
+    assert mock.call_count == extract_air_quality.HTTP_RETRIES
@@ -0,0 +1,120 @@
+"""
+Compares the original DataFrame.to_sql loader of the lambda against the COPY loader,
+reporting rows per second and peak Python memory (tracemalloc) for each.
+Uses synthetic hourly arrays, so no API requests are made, and writes them for
+`--location-id` into the database in .env; run it against a test database.
+The to_sql loader needs pandas and SQLAlchemy, which the lambda no longer does:
+    pip install pandas SQLAlchemy
+    python benchmark_loader.py --location-id 1 --years 35
+"""
+import os
+import argparse
+import time
+import tracemalloc
+from typing import Callable
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, URL
+from sqlalchemy.engine import Engine
+from extract import HOURLY_VARIABLES, copy_hourly, get_connection
+
+START_TIMESTAMP = int(pd.Timestamp("1940-01-01", tz="UTC").timestamp())
+
+
+def make_hourly_arrays(rows: int) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """Synthetic float32 hourly arrays shaped like the Open-Meteo response."""
+    rng = np.random.default_rng(0)
+    timestamps = START_TIMESTAMP + np.arange(rows, dtype=np.int64) * 3600
+    columns = {column: rng.uniform(0, 360, rows).astype(np.float32)
+               for column in HOURLY_VARIABLES.values()}
+    return timestamps, columns
+
+
+def delete_rows(location_id: int, timestamps: np.ndarray) -> None:
+    """Remove the benchmark rows so every run inserts the same data."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("DELETE FROM historical_weather_readings "
+                        "WHERE location_id = %s AND timestamp >= to_timestamp(%s) AT TIME ZONE 'UTC' "
+                        "AND timestamp <= to_timestamp(%s) AT TIME ZONE 'UTC';",
+                        (location_id, int(timestamps[0]), int(timestamps[-1])))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def get_engine() -> Engine:
+    """Create SQL Alchemy engine for the RDS."""
+    url_object = URL.create(
+        drivername="postgresql+psycopg2",
+        host=os.getenv("DB_HOST"),
+        username=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        database=os.getenv("DB_NAME"),
+        port=os.getenv("DB_PORT")
+    )
+    return create_engine(url_object)
+
+
+def load_with_to_sql(location_id: int, timestamps: np.ndarray,
+                     columns: dict[str, np.ndarray]) -> None:
+    """
+    The original loader: build a DataFrame and insert it with multi-row
+    INSERT statements of 5000 rows.
+    """
+    weather_df = pd.DataFrame({"timestamp": pd.to_datetime(timestamps, unit="s", utc=True)}
+                              | columns)
+    weather_df["location_id"] = location_id
+    engine = get_engine()
+    try:
+        weather_df.to_sql("historical_weather_readings", engine, if_exists="append",
+                          index=False, chunksize=5000, method="multi")
+    finally:
+        engine.dispose()
+
+
+def load_with_copy(location_id: int, timestamps: np.ndarray,
+                   columns: dict[str, np.ndarray]) -> None:
+    """The COPY loader used by the lambda."""
+    conn = get_connection()
+    try:
+        copy_hourly(conn, location_id, timestamps, columns)
+    finally:
+        conn.close()
+
+
+def measure(loader: Callable, location_id: int, timestamps: np.ndarray,
+            columns: dict[str, np.ndarray]) -> tuple[float, int]:
+    """
+    Returns the rows per second and peak traced memory in bytes of a load.
+    tracemalloc slows allocation down, so speed and memory are measured in separate loads.
+    """
+    delete_rows(location_id, timestamps)
+    start = time.perf_counter()
+    loader(location_id, timestamps, columns)
+    elapsed = time.perf_counter() - start
+
+    delete_rows(location_id, timestamps)
+    tracemalloc.start()
+    loader(location_id, timestamps, columns)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return len(timestamps) / elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--location-id", type=int, required=True)
+    parser.add_argument("--years", type=int, default=35)
+    args = parser.parse_args()
+
+    hourly_timestamps, hourly_columns = make_hourly_arrays(args.years * 8766)
+    print(f"{len(hourly_timestamps)} rows")
+    print(f"{'loader':<10}{'rows/s':>12}{'peak MB':>12}")
+    for name, load in (("to_sql", load_with_to_sql), ("copy", load_with_copy)):
+        rows_per_second, peak_bytes = measure(load, args.location_id,
+                                              hourly_timestamps, hourly_columns)
+        print(f"{name:<10}{rows_per_second:>12.0f}{peak_bytes / 1024 ** 2:>12.1f}")
+    delete_rows(args.location_id, hourly_timestamps)
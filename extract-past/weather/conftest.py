@@ -1,22 +1,20 @@
 import pytest
-import pandas as pd
 import numpy as np
+import extract
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    extract._openmeteo = None
+    yield
+    extract._openmeteo = None
 
 
 @pytest.fixture()
 def expected_return():
-    data = {
-        "timestamp": pd.date_range(
-            start=pd.to_datetime(-946339200, unit="s", utc=True),
-            end=pd.to_datetime(-946166400, unit="s", utc=True),
-            freq=pd.Timedelta(seconds=3600),
-            inclusive="left"
-        ),
-        "hourly_temperature": np.linspace(9, 10, 48),
-        "hourly_wind_speed": np.linspace(9, 10, 48),
-        "hourly_wind_direction": np.linspace(9, 10, 48),
-        "hourly_wind_gust_speed": np.linspace(9, 10, 48),
-        "hourly_rainfall": np.linspace(9, 10, 48),
-        "hourly_snowfall": np.linspace(9, 10, 48),
-    }
-    return pd.DataFrame(data)
+    timestamps = np.arange(-946339200, -946166400, 3600, dtype=np.int64)
+    columns = {column: np.linspace(9, 10, 48)
+               for column in ["hourly_temperature", "hourly_wind_speed",
+                              "hourly_wind_direction", "hourly_wind_gust_speed",
+                              "hourly_rainfall", "hourly_snowfall"]}
+    return timestamps, columns
@@ -1,105 +1,446 @@
 """Lambda handler to extract and insert historical weather into the RDS."""
+import io
 import os
+import json
 import random
+import hashlib
 import logging
-from typing import Any
+from pathlib import Path
+from datetime import date, timedelta
+from typing import Any, Iterator
+import numpy as np
 import openmeteo_requests
-import pandas as pd
-from retry_requests import retry
+import psycopg2
 from dotenv import load_dotenv
 import requests as req
-from sqlalchemy import create_engine, URL
-from sqlalchemy.engine import Engine
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
 load_dotenv()
 
 logging.basicConfig(
     format="%(levelname)s | %(asctime)s | %(message)s", level=logging.INFO)
 
+# Connection pool size and retry policy of the shared Open-Meteo client.
+# A random backoff_factor prevents synchronized retries when run in parallel.
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "6"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", random.uniform(1, 3)))
 
-def get_engine() -> Engine:
-    """Create SQL Alchemy engine for the RDS."""
-    url_object = URL.create(
-        drivername="postgresql+psycopg2",
+# Open-Meteo hourly variables and the columns they are stored in, in request order
+HOURLY_VARIABLES = {
+    "temperature_2m": "hourly_temperature",
+    "wind_speed_10m": "hourly_wind_speed",
+    "wind_direction_10m": "hourly_wind_direction",
+    "wind_gusts_10m": "hourly_wind_gust_speed",
+    "rain": "hourly_rainfall",
+    "snowfall": "hourly_snowfall"
+}
+HOURLY_COLUMNS = ", ".join(HOURLY_VARIABLES.values())
+# Rows formatted as CSV at a time while streaming to COPY
+COPY_CHUNK_ROWS = 10000
+# Years of data requested, held in memory and committed at a time
+WINDOW_YEARS = int(os.getenv("WINDOW_YEARS", "1"))
+
+# Locations with the same date range are requested together from the archive,
+# up to this many coordinates per request
+LOCATIONS_PER_REQUEST = int(os.getenv("LOCATIONS_PER_REQUEST", "50"))
+
+# The daily top-up fetches the archive days which became available since the
+# latest stored reading of every location. The archive lags by a few days.
+TOP_UP_MODE = "top-up"
+ARCHIVE_DELAY_DAYS = int(os.getenv("ARCHIVE_DELAY_DAYS", "6"))
+LATEST_READINGS_QUERY = """
+    SELECT l.location_id, l.latitude, l.longitude, latest.timestamp
+    FROM locations AS l
+    LEFT JOIN LATERAL (
+        SELECT h.timestamp
+        FROM historical_weather_readings AS h
+        WHERE h.location_id = l.location_id
+        ORDER BY h.timestamp DESC
+        LIMIT 1
+    ) AS latest ON TRUE
+    ORDER BY l.location_id;
+"""
+
+# COPY cannot skip conflicting rows, so rows are copied into a staging table
+# and moved across with INSERT ... ON CONFLICT DO NOTHING
+CREATE_STAGING_TABLE = ("CREATE TEMP TABLE historical_weather_staging ("
+                        "timestamp TIMESTAMP, "
+                        + ", ".join(f"{column} FLOAT" for column in HOURLY_VARIABLES.values())
+                        + ") ON COMMIT DROP;")
+COPY_STAGING_TABLE = (f"COPY historical_weather_staging (timestamp, {HOURLY_COLUMNS}) "
+                      "FROM STDIN WITH (FORMAT csv);")
+INSERT_FROM_STAGING = (f"INSERT INTO historical_weather_readings (location_id, timestamp, "
+                       f"{HOURLY_COLUMNS}) "
+                       "SELECT %s, timestamp, hourly_temperature, hourly_wind_speed, "
+                       "ROUND(hourly_wind_direction)::SMALLINT, hourly_wind_gust_speed, "
+                       "hourly_rainfall, hourly_snowfall "
+                       "FROM historical_weather_staging "
+                       "ON CONFLICT (location_id, timestamp) DO NOTHING;")
+# Records each loaded window and the rows it inserted in the coverage ledger,
+# which the new location orchestrator reads to find gaps
+RECORD_COVERAGE = ("INSERT INTO backfill_coverage "
+                   "(location_id, table_name, start_date, end_date, row_count) "
+                   "VALUES (%s, 'historical_weather_readings', %s, %s, %s) "
+                   "ON CONFLICT (location_id, table_name, start_date, end_date) "
+                   "DO UPDATE SET row_count = backfill_coverage.row_count + EXCLUDED.row_count, "
+                   "loaded_at = CURRENT_TIMESTAMP;")
+
+# Decoded archive responses are cached on disk as compressed .npz files keyed by a hash
+# of the request, so a range requested again while the cache is kept is replayed
+# instead of refetched. In the lambda the cache lives in /tmp, which only lasts as long
+# as a warm container; run locally it can be kept on disk between database rebuilds.
+# The least recently used files are removed beyond ARCHIVE_CACHE_MAX_BYTES.
+# Only ranges old enough not to be revised by the archive are cached.
+ARCHIVE_CACHE_DIR = os.getenv("ARCHIVE_CACHE_DIR")
+ARCHIVE_CACHE_MAX_BYTES = int(os.getenv("ARCHIVE_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+
+_openmeteo = None
+
+
+def get_connection() -> psycopg2.extensions.connection:
+    """Get connection to RDS."""
+    return psycopg2.connect(
         host=os.getenv("DB_HOST"),
-        username=os.getenv("DB_USER"),
+        user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_NAME"),
+        dbname=os.getenv("DB_NAME"),
         port=os.getenv("DB_PORT")
     )
-    return create_engine(url_object)
-
-
-def get_weather(latitude: float, longitude: float, start_date: str,
-                end_date: str) -> pd.DataFrame:
-    """Get the weather data for the specified location and date range."""
-    # Setup the Open-Meteo API client with retry on error
-    # Random backoff_factor prevents synchronized retries when run in parallel
-    retry_session = retry(req.Session(),
-                          retries=6,
-                          backoff_factor=random.uniform(1, 3))
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    # The order of variables in hourly is important to assign them correctly below
+
+
+def get_openmeteo_client() -> openmeteo_requests.Client:
+    """
+    Get the Open-Meteo archive client, creating it on first use, so every window
+    of a range is requested over one keep-alive session which retries server errors.
+    """
+    global _openmeteo  # pylint: disable=global-statement
+    if _openmeteo is None:
+        session = req.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=HTTP_RETRIES,
+                              backoff_factor=HTTP_BACKOFF_FACTOR,
+                              status_forcelist=(500, 502, 504),
+                              allowed_methods=None))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _openmeteo = openmeteo_requests.Client(session=session)
+    return _openmeteo
+
+
+def process_hourly(api_response: Any) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Returns the timestamps in unix seconds and a dict of column name: values
+    of the hourly data of one location in an Open-Meteo response.
+    """
+    # The order of variables needs to be the same as requested.
+    hourly = api_response.Hourly()
+    timestamps = np.arange(hourly.Time(), hourly.TimeEnd(), hourly.Interval(), dtype=np.int64)
+    columns = {column: hourly.Variables(i).ValuesAsNumpy()
+               for i, column in enumerate(HOURLY_VARIABLES.values())}
+    return timestamps, columns
+
+
+def get_cache_path(latitude: float, longitude: float, start_date: str,
+                   end_date: str) -> Path:
+    """The cache file of the hourly weather of one location over a date range."""
+    request = json.dumps([latitude, longitude, start_date, end_date, list(HOURLY_VARIABLES)])
+    return Path(ARCHIVE_CACHE_DIR) / f"{hashlib.sha256(request.encode()).hexdigest()}.npz"
+
+
+def is_cacheable(end_date: str) -> bool:
+    """Whether caching is enabled and the range ends before days the archive may still revise."""
+    last_final_date = date.today() - timedelta(days=ARCHIVE_DELAY_DAYS)
+    return bool(ARCHIVE_CACHE_DIR) and date.fromisoformat(end_date) <= last_final_date
+
+
+def load_cached(path: Path) -> tuple[np.ndarray, dict[str, np.ndarray]] | None:
+    """
+    Read the arrays of a cache file, marking it as recently used.
+    Returns None if it is not cached or cannot be read.
+    """
+    try:
+        with np.load(path) as cached:
+            timestamps = cached["timestamps"]
+            columns = {column: cached[column] for column in HOURLY_VARIABLES.values()}
+        os.utime(path)
+    except (OSError, KeyError, ValueError):
+        return None
+    return timestamps, columns
+
+
+def evict_cached(max_bytes: int = ARCHIVE_CACHE_MAX_BYTES) -> None:
+    """Remove the least recently used cache files until the cache fits within max_bytes."""
+    files = []
+    for path in Path(ARCHIVE_CACHE_DIR).glob("*.npz"):
+        stat = path.stat()
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def store_cached(path: Path, timestamps: np.ndarray, columns: dict[str, np.ndarray]) -> None:
+    """Write the arrays to a cache file, then evict old files if the cache is too large."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written under a temporary name and renamed, so a reader never sees a partial file
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "wb") as file:
+        np.savez_compressed(file, timestamps=timestamps, **columns)
+    os.replace(temporary_path, path)
+    evict_cached()
+
+
+def request_hourly(latitude: float | list[float], longitude: float | list[float],
+                   start_date: str, end_date: str
+                   ) -> list[tuple[np.ndarray, dict[str, np.ndarray]]]:
+    """
+    Get the hourly weather for one location, or for several when given lists of
+    coordinates, over the date range in a single request. Returns the arrays of
+    each location in the order of the coordinates. Locations found in the archive
+    cache are read from it and only the rest are requested.
+    """
+    latitudes = latitude if isinstance(latitude, list) else [latitude]
+    longitudes = longitude if isinstance(longitude, list) else [longitude]
+    cache_paths = [None] * len(latitudes)
+    hourly_data = [None] * len(latitudes)
+    if is_cacheable(end_date):
+        cache_paths = [get_cache_path(lat, lon, start_date, end_date)
+                       for lat, lon in zip(latitudes, longitudes)]
+        hourly_data = [load_cached(path) for path in cache_paths]
+    missing = [i for i, data in enumerate(hourly_data) if data is None]
+    if not missing:
+        logging.info("Read %d locations from the archive cache.", len(hourly_data))
+        return hourly_data
+
+    openmeteo = get_openmeteo_client()
     url = "https://archive-api.open-meteo.com/v1/archive"
     params = {
-        "latitude": latitude,
-        "longitude": longitude,
+        "latitude": [latitudes[i] for i in missing] if isinstance(latitude, list) else latitude,
+        "longitude": [longitudes[i] for i in missing] if isinstance(longitude, list) else longitude,
         "start_date": start_date,
         "end_date": end_date,
-        "hourly": ["temperature_2m", "wind_speed_10m", "wind_direction_10m",
-                   "wind_gusts_10m", "rain", "snowfall"],
+        "hourly": list(HOURLY_VARIABLES),
     }
     logging.info("Sending request to API.")
     api_responses = openmeteo.weather_api(url, params=params)
-    # Process first (and only) location.
-    api_response = api_responses[0]
-    # Process hourly data. The order of variables needs to be the same as requested.
-    hourly = api_response.Hourly()
-    hourly_data = {"timestamp": pd.date_range(
-        start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-        end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-        freq=pd.Timedelta(seconds=hourly.Interval()),
-        inclusive="left"
-    )}
-    hourly_data["hourly_temperature"] = hourly.Variables(0).ValuesAsNumpy()
-    hourly_data["hourly_wind_speed"] = hourly.Variables(1).ValuesAsNumpy()
-    hourly_data["hourly_wind_direction"] = hourly.Variables(2).ValuesAsNumpy()
-    hourly_data["hourly_wind_gust_speed"] = hourly.Variables(3).ValuesAsNumpy()
-    hourly_data["hourly_rainfall"] = hourly.Variables(4).ValuesAsNumpy()
-    hourly_data["hourly_snowfall"] = hourly.Variables(5).ValuesAsNumpy()
-
-    hourly_dataframe = pd.DataFrame(data=hourly_data)
+    if len(api_responses) != len(missing):
+        raise RuntimeError(f"Expected {len(missing)} locations from the API, "
+                           f"received {len(api_responses)}.")
+    for i, api_response in zip(missing, api_responses):
+        hourly_data[i] = process_hourly(api_response)
+        if cache_paths[i] is not None:
+            store_cached(cache_paths[i], *hourly_data[i])
     logging.info("API response processed successfully.")
-    return hourly_dataframe
+    return hourly_data
+
+
+def fetch_hourly(latitude: float, longitude: float, start_date: str,
+                 end_date: str) -> tuple[np.ndarray, dict[str, np.ndarray]]:
+    """
+    Get the hourly weather for the specified location and date range as arrays.
+    Returns the timestamps in unix seconds and a dict of column name: values.
+    """
+    return request_hourly(latitude, longitude, start_date, end_date)[0]
+
+
+def iter_windows(start_date: str, end_date: str,
+                 years: int = WINDOW_YEARS) -> Iterator[tuple[str, str]]:
+    """
+    Split an inclusive date range into consecutive inclusive windows
+    of at most `years` calendar years, as ISO dates.
+    """
+    start, end = date.fromisoformat(start_date), date.fromisoformat(end_date)
+    while start <= end:
+        window_end = min(end, date(start.year + years - 1, 12, 31))
+        yield start.isoformat(), window_end.isoformat()
+        start = date(window_end.year + 1, 1, 1)
+
+
+def iter_hourly(latitude: float, longitude: float, start_date: str, end_date: str
+                ) -> Iterator[tuple[tuple[str, str], np.ndarray, dict[str, np.ndarray]]]:
+    """
+    Request the hourly weather one window at a time, yielding the window and its
+    arrays so only one window is held in memory however long the range.
+    """
+    for window in iter_windows(start_date, end_date):
+        logging.info("Fetching %s to %s.", *window)
+        yield window, *fetch_hourly(latitude, longitude, *window)
+
+
+def format_csv_rows(timestamps: np.ndarray, columns: dict[str, np.ndarray]) -> str:
+    """Format hourly arrays as CSV rows, leaving missing (NaN) values empty for NULL."""
+    rows = timestamps.astype("datetime64[s]").astype(str)
+    for values in columns.values():
+        field = np.where(np.isnan(values), "", values.astype(str))
+        rows = np.char.add(np.char.add(rows, ","), field)
+    return "\n".join(rows) + "\n"
+
+
+class HourlyCsvStream(io.TextIOBase):
+    """
+    Read only file object which formats the hourly arrays as CSV for COPY
+    one chunk of rows at a time, so the whole CSV is never held in memory.
+    """
+
+    def __init__(self, timestamps: np.ndarray, columns: dict[str, np.ndarray],
+                 chunk_rows: int = COPY_CHUNK_ROWS):
+        super().__init__()
+        self.chunks = self.iter_chunks(timestamps, columns, chunk_rows)
+        self.current = io.StringIO()
+
+    @staticmethod
+    def iter_chunks(timestamps: np.ndarray, columns: dict[str, np.ndarray],
+                    chunk_rows: int) -> Iterator[str]:
+        """Yields the CSV of each chunk of rows."""
+        for start in range(0, len(timestamps), chunk_rows):
+            end = start + chunk_rows
+            yield format_csv_rows(timestamps[start:end],
+                                  {column: values[start:end]
+                                   for column, values in columns.items()})
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> str:
+        data = self.current.read(size)
+        while size < 0 or len(data) < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            self.current = io.StringIO(chunk)
+            data += self.current.read(size - len(data) if size >= 0 else -1)
+        return data
+
+
+def copy_hourly(conn: psycopg2.extensions.connection, location_id: int,
+                timestamps: np.ndarray, columns: dict[str, np.ndarray],
+                window: tuple[str, str] | None = None) -> int:
+    """
+    Load hourly arrays into historical_weather_readings with COPY, skipping
+    readings which are already stored, and record the `window` of dates they
+    cover in the coverage ledger. Returns the number of rows inserted.
+    """
+    with conn.cursor() as cur:
+        cur.execute(CREATE_STAGING_TABLE)
+        cur.copy_expert(COPY_STAGING_TABLE, HourlyCsvStream(timestamps, columns))
+        cur.execute(INSERT_FROM_STAGING, (location_id,))
+        inserted = cur.rowcount
+        if window is not None:
+            cur.execute(RECORD_COVERAGE, (location_id, *window, inserted))
+    conn.commit()
+    return inserted
+
+
+def load_locations(conn: psycopg2.extensions.connection, locations: list[dict],
+                   start_date: str, end_date: str) -> tuple[int, int]:
+    """
+    Load the hourly weather of several locations over the same date range, one
+    window at a time, requesting up to LOCATIONS_PER_REQUEST locations at once.
+    Returns the number of rows inserted and of requests made.
+    """
+    inserted, requests = 0, 0
+    for window in iter_windows(start_date, end_date):
+        logging.info("Fetching %s to %s for %d locations.", *window, len(locations))
+        for i in range(0, len(locations), LOCATIONS_PER_REQUEST):
+            batch = locations[i:i + LOCATIONS_PER_REQUEST]
+            hourly_data = request_hourly([location["latitude"] for location in batch],
+                                         [location["longitude"] for location in batch],
+                                         *window)
+            requests += 1
+            for location, (timestamps, columns) in zip(batch, hourly_data):
+                inserted += copy_hourly(conn, location["location_id"],
+                                        timestamps, columns, window)
+    return inserted, requests
+
+
+def get_top_up_ranges(cur: Any, last_date: date) -> dict[tuple[str, str], list[dict]]:
+    """
+    Group the locations by the range of archive days, up to `last_date`,
+    which are newer than their latest stored reading.
+    """
+    cur.execute(LATEST_READINGS_QUERY)
+    ranges = {}
+    for location_id, latitude, longitude, last_timestamp in cur.fetchall():
+        if last_timestamp is None:
+            # Locations without any history are loaded by the new location orchestrator
+            continue
+        start = (last_timestamp + timedelta(hours=1)).date()
+        if start <= last_date:
+            ranges.setdefault((start.isoformat(), last_date.isoformat()), []).append(
+                {"location_id": location_id, "latitude": latitude, "longitude": longitude})
+    return ranges
+
+
+def top_up_handler(today: date | None = None) -> dict:
+    """
+    Append the newly available archive days to every location's historical weather,
+    requesting many locations with the same range at once.
+    """
+    last_date = (today or date.today()) - timedelta(days=ARCHIVE_DELAY_DAYS)
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            ranges = get_top_up_ranges(cur, last_date)
+        inserted, requests, locations_topped_up = 0, 0, 0
+        for (start_date, end_date), locations in ranges.items():
+            try:
+                range_inserted, range_requests = load_locations(conn, locations,
+                                                                start_date, end_date)
+            except Exception as e:
+                logging.error("Error topping up location_ids %s: %s",
+                              [location["location_id"] for location in locations],
+                              str(e))
+                raise e
+            inserted += range_inserted
+            requests += range_requests
+            locations_topped_up += len(locations)
+    finally:
+        conn.close()
+    logging.info("Topped up %d locations with %d readings in %d requests.",
+                 locations_topped_up, inserted, requests)
+    return {
+        "statusCode": 200,
+        "message": f"{inserted} historical weather readings successfully inserted.",
+        "locations": locations_topped_up,
+        "requests": requests
+    }
 
 
 def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused-argument
     """
-    Uploads historical weather data for given location_id and date range.
+    Uploads historical weather data for given location_id and date range, or tops up
+    every location with the newest archive days in top-up mode.
     Parameters:
         event: Dict containing the location_id, start_date and end_date 
             e.g. {"location_id": 1, "latitude": 51.507351, "longitude": -0.127758,
                   "start_date": "1940-01-01", "end_date": "1960-01-01"}
+            or {"mode": "top-up"}
         context: Lambda runtime context
     Returns:
         Dict containing status message
     """
+    if event.get("mode") == TOP_UP_MODE:
+        return top_up_handler()
     try:
-        weather_df = get_weather(event["latitude"], event["longitude"],
-                                 event["start_date"], event["end_date"])
-        weather_df["location_id"] = event["location_id"]
-        engine = get_engine()
+        conn = get_connection()
         logging.info("Connected to the database.")
         try:
-            weather_df.to_sql("historical_weather_readings",
-                              engine,
-                              if_exists="append",
-                              index=False,
-                              chunksize=5000,
-                              method="multi")
-            logging.info("Historical weather data successfully inserted.")
+            # Each window is committed as it arrives, so memory use does not
+            # grow with the length of the range
+            inserted = 0
+            for window, timestamps, columns in iter_hourly(event["latitude"], event["longitude"],
+                                                           event["start_date"], event["end_date"]):
+                inserted += copy_hourly(conn, event["location_id"], timestamps, columns, window)
+            logging.info("%d historical weather readings successfully inserted.", inserted)
         finally:
-            engine.dispose()
+            conn.close()
         return {
             "statusCode": 200,
             "message": "Historical weather data successfully inserted."
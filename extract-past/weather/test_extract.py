@@ -1,10 +1,15 @@
+import os
+from datetime import date, datetime, timedelta
 from unittest.mock import MagicMock, Mock, patch, call
 import numpy as np
-from extract import get_weather, lambda_handler
+import pytest
+import extract
+from extract import (fetch_hourly, lambda_handler, HourlyCsvStream, iter_windows,
+                     top_up_handler, request_hourly, evict_cached)
 
 
 @patch("openmeteo_requests.Client")
-def test_get_weather(api_mock, expected_return):
+def test_fetch_hourly(api_mock, expected_return):
     hourly_weather_mock = Mock()
     response_mock = Mock()
     openmeteo = Mock()
@@ -22,7 +27,7 @@ def test_get_weather(api_mock, expected_return):
     hourly_weather_mock.Interval.return_value = 3600
     api_mock.return_value = openmeteo
     openmeteo.weather_api.return_value = [response_mock]
-    ret = get_weather(51.507351, -0.127758, "1940-01-06", "1940-01-07")
+    timestamps, columns = fetch_hourly(51.507351, -0.127758, "1940-01-06", "1940-01-07")
     openmeteo.weather_api.assert_called_once_with(
         "https://archive-api.open-meteo.com/v1/archive",
         params={
@@ -33,29 +38,194 @@ def test_get_weather(api_mock, expected_return):
             "hourly": ["temperature_2m", "wind_speed_10m", "wind_direction_10m", "wind_gusts_10m", "rain", "snowfall"],
         }
     )
-    assert ret.equals(expected_return)
+    expected_timestamps, expected_columns = expected_return
+    np.testing.assert_array_equal(timestamps, expected_timestamps)
+    assert list(columns) == list(expected_columns)
+    for column, values in expected_columns.items():
+        np.testing.assert_array_equal(columns[column], values)
 
 
-@patch("extract.get_engine")
-@patch("extract.get_weather")
-def test_lambda_handler(mock_get_weather, mock_get_engine):
-    engine = Mock()
-    mock_get_engine.return_value = engine
-    mock_df = Mock()
-    mock_df.__setitem__ = Mock(return_value=False)
-    mock_get_weather.return_value = mock_df
+@patch("extract.get_connection")
+@patch("extract.fetch_hourly")
+def test_lambda_handler(mock_fetch_hourly, mock_get_connection):
+    conn = MagicMock()
+    mock_get_connection.return_value = conn
+    cursor = conn.cursor.return_value.__enter__.return_value
+    # One of the two readings is already stored
+    cursor.rowcount = 1
+    timestamps = np.array([-946339200, -946335600])
+    columns = {"hourly_temperature": np.array([9.5, 10.0], dtype=np.float32)}
+    mock_fetch_hourly.return_value = (timestamps, columns)
     ret = lambda_handler({"location_id": 1, "latitude": 51.507351, "longitude": -0.127758,
                           "start_date": "1940-01-06", "end_date": "1940-01-07"},
                          "context")
-    mock_get_engine.assert_called_once()
-    mock_df.__setitem__.assert_called_once_with("location_id", 1)
-    mock_df.to_sql.assert_called_once_with("historical_weather_readings",
-                                           engine,
-                                           if_exists="append",
-                                           index=False,
-                                           chunksize=5000,
-                                           method="multi")
+    mock_fetch_hourly.assert_called_once_with(51.507351, -0.127758, "1940-01-06", "1940-01-07")
+    mock_get_connection.assert_called_once()
+    assert cursor.execute.call_args_list[0].args[0].startswith(
+        "CREATE TEMP TABLE historical_weather_staging")
+    copy_sql, stream = cursor.copy_expert.call_args.args
+    assert copy_sql.startswith("COPY historical_weather_staging")
+    assert stream.read() == "1940-01-06T00:00:00,9.5\n1940-01-06T01:00:00,10.0\n"
+    insert_sql, parameters = cursor.execute.call_args_list[1].args
+    assert insert_sql.endswith("ON CONFLICT (location_id, timestamp) DO NOTHING;")
+    assert parameters == (1,)
+    coverage_sql, parameters = cursor.execute.call_args_list[2].args
+    assert coverage_sql.startswith("INSERT INTO backfill_coverage")
+    assert parameters == (1, "1940-01-06", "1940-01-07", 1)
+    conn.commit.assert_called_once()
+    conn.close.assert_called_once()
     assert ret == {
         "statusCode": 200,
         "message": "Historical weather data successfully inserted."
     }
+
+
+@patch("extract.get_connection")
+@patch("extract.fetch_hourly")
+def test_lambda_handler_commits_each_window(mock_fetch_hourly, mock_get_connection):
+    conn = MagicMock()
+    mock_get_connection.return_value = conn
+    conn.cursor.return_value.__enter__.return_value.rowcount = 1
+    mock_fetch_hourly.return_value = (np.array([0]), {"hourly_rainfall": np.array([0.5])})
+    lambda_handler({"location_id": 1, "latitude": 51.5, "longitude": -0.1,
+                    "start_date": "1940-03-01", "end_date": "1942-06-30"}, "context")
+    assert mock_fetch_hourly.call_args_list == [
+        call(51.5, -0.1, "1940-03-01", "1940-12-31"),
+        call(51.5, -0.1, "1941-01-01", "1941-12-31"),
+        call(51.5, -0.1, "1942-01-01", "1942-06-30")]
+    assert conn.commit.call_count == 3
+
+
+@patch("extract.copy_hourly")
+@patch("extract.request_hourly")
+@patch("extract.get_connection")
+def test_top_up_batches_locations_with_the_same_range(mock_get_connection, mock_request_hourly,
+                                                      mock_copy_hourly):
+    last_stored = datetime(2025, 6, 2, 23)
+    cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(1, 51.5, -0.1, last_stored),
+                                    (2, 50.4, -4.2, last_stored),
+                                    (3, 52.5, -1.9, None),
+                                    (4, 53.4, -2.2, datetime(2025, 6, 4, 23))]
+    arrays = (np.array([0]), {"hourly_rainfall": np.array([0.5])})
+    mock_request_hourly.return_value = [arrays, arrays]
+    mock_copy_hourly.return_value = 48
+    ret = top_up_handler(today=date(2025, 6, 10))
+    window = ("2025-06-03", "2025-06-04")
+    mock_request_hourly.assert_called_once_with([51.5, 50.4], [-0.1, -4.2], *window)
+    assert mock_copy_hourly.call_args_list == [
+        call(mock_get_connection.return_value, 1, *arrays, window),
+        call(mock_get_connection.return_value, 2, *arrays, window)]
+    assert ret == {
+        "statusCode": 200,
+        "message": "96 historical weather readings successfully inserted.",
+        "locations": 2,
+        "requests": 1
+    }
+
+
+@patch("extract.process_hourly")
+@patch("extract.get_openmeteo_client")
+def test_request_hourly_reads_through_archive_cache(mock_client, mock_process_hourly,
+                                                   tmp_path, monkeypatch):
+    monkeypatch.setattr(extract, "ARCHIVE_CACHE_DIR", str(tmp_path))
+    timestamps = np.array([0, 3600])
+    columns = {column: np.array([1.5, np.nan], dtype=np.float32)
+               for column in extract.HOURLY_VARIABLES.values()}
+    mock_process_hourly.return_value = (timestamps, columns)
+    weather_api = mock_client.return_value.weather_api
+    weather_api.return_value = [Mock()]
+
+    request_hourly([51.5], [-0.1], "1940-01-01", "1940-12-31")
+    weather_api.return_value = [Mock()]
+    cached = request_hourly([51.5, 50.4], [-0.1, -4.2], "1940-01-01", "1940-12-31")
+
+    assert weather_api.call_count == 2
+    assert weather_api.call_args.kwargs["params"]["latitude"] == [50.4]
+    cached_timestamps, cached_columns = cached[0]
+    np.testing.assert_array_equal(cached_timestamps, timestamps)
+    np.testing.assert_array_equal(cached_columns["hourly_rainfall"], columns["hourly_rainfall"])
+    assert len(list(tmp_path.glob("*.npz"))) == 2
+
+
+@patch("extract.process_hourly")
+@patch("extract.get_openmeteo_client")
+def test_request_hourly_does_not_cache_recent_days(mock_client, mock_process_hourly,
+                                                   tmp_path, monkeypatch):
+    monkeypatch.setattr(extract, "ARCHIVE_CACHE_DIR", str(tmp_path))
+    mock_process_hourly.return_value = (np.array([0]), {"hourly_rainfall": np.array([0.5])})
+    mock_client.return_value.weather_api.return_value = [Mock()]
+    request_hourly(51.5, -0.1, date.today().isoformat(), date.today().isoformat())
+    request_hourly(51.5, -0.1, date.today().isoformat(), date.today().isoformat())
+    assert mock_client.return_value.weather_api.call_count == 2
+    assert not list(tmp_path.iterdir())
+
+
+def test_evict_cached_removes_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(extract, "ARCHIVE_CACHE_DIR", str(tmp_path))
+    for age, name in enumerate(["newest", "middle", "oldest"]):
+        path = tmp_path / f"{name}.npz"
+        path.write_bytes(b"x" * 100)
+        os.utime(path, (1000 - age, 1000 - age))
+    evict_cached(max_bytes=200)
+    assert sorted(path.stem for path in tmp_path.glob("*.npz")) == ["middle", "newest"]
+
+
+@patch("extract.copy_hourly")
+@patch("extract.request_hourly")
+@patch("extract.get_connection")
+def test_top_up_requests_up_to_locations_per_request_at_once(mock_get_connection,
+                                                             mock_request_hourly,
+                                                             mock_copy_hourly, monkeypatch):
+    monkeypatch.setattr(extract, "LOCATIONS_PER_REQUEST", 2)
+    cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(i, 50 + i, -i, datetime(1940, 5, 31, 23))
+                                    for i in range(1, 4)]
+    arrays = (np.array([0]), {"hourly_rainfall": np.array([0.5])})
+    mock_request_hourly.side_effect = lambda latitudes, *_: [arrays] * len(latitudes)
+    mock_copy_hourly.return_value = 24
+    ret = top_up_handler(today=date(1941, 1, 31) + timedelta(days=extract.ARCHIVE_DELAY_DAYS))
+    assert mock_request_hourly.call_args_list == [
+        call([51, 52], [-1, -2], "1940-06-01", "1940-12-31"),
+        call([53], [-3], "1940-06-01", "1940-12-31"),
+        call([51, 52], [-1, -2], "1941-01-01", "1941-01-31"),
+        call([53], [-3], "1941-01-01", "1941-01-31")]
+    assert [c.args[1] for c in mock_copy_hourly.call_args_list] == [1, 2, 3, 1, 2, 3]
+    mock_get_connection.return_value.close.assert_called_once()
+    assert ret["requests"] == 4
+    assert ret["message"] == "144 historical weather readings successfully inserted."
+
+
+@patch("extract.load_locations", side_effect=RuntimeError("API limit reached"))
+@patch("extract.get_connection")
+def test_top_up_logs_the_locations_which_failed(mock_get_connection, mock_load_locations,
+                                                caplog):
+    cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(1, 51.5, -0.1, datetime(2025, 6, 2, 23)),
+                                    (2, 50.4, -4.2, datetime(2025, 6, 2, 23))]
+    with pytest.raises(RuntimeError):
+        top_up_handler(today=date(2025, 6, 10))
+    assert "Error topping up location_ids [1, 2]: API limit reached" in caplog.text
+    mock_get_connection.return_value.close.assert_called_once()
+
+
+def test_iter_windows_covers_range_in_year_windows():
+    assert list(iter_windows("1940-01-06", "1945-02-01", years=2)) == [
+        ("1940-01-06", "1941-12-31"),
+        ("1942-01-01", "1943-12-31"),
+        ("1944-01-01", "1945-02-01")]
+    assert list(iter_windows("1940-01-06", "1940-01-07")) == [("1940-01-06", "1940-01-07")]
+
+
+def test_hourly_csv_stream_reads_across_chunks():
+    timestamps = np.array([0, 3600, 7200])
+    columns = {"hourly_rainfall": np.array([0.5, np.nan, 1.25], dtype=np.float32),
+               "hourly_snowfall": np.array([0, 0, 0], dtype=np.float32)}
+    stream = HourlyCsvStream(timestamps, columns, chunk_rows=2)
+    data = ""
+    while chunk := stream.read(7):
+        data += chunk
+    assert data == ("1970-01-01T00:00:00,0.5,0.0\n"
+                    "1970-01-01T01:00:00,,0.0\n"
+                    "1970-01-01T02:00:00,1.25,0.0\n")
+
@@ -1,6 +1,23 @@
 # pylint: skip-file
+import sys
+from pathlib import Path
 import pytest
 
+# The rate limiter is shared with the historic air quality lambda
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+import extract
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    extract._connection = None
+    extract._session = None
+    extract._last_seen = {}
+    yield
+    extract._connection = None
+    extract._session = None
+    extract._last_seen = {}
+
 
 @pytest.fixture()
 def response_payload():
@@ -1,35 +1,126 @@
 """Lambda handler to extract and insert air quality readings into the RDS."""
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from typing import Any
 import logging
-from retry_requests import retry
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2.extras import execute_values
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
+from owm_rate_limit import TokenBucket, get_retry_after, make_bucket
 
 logging.basicConfig(
     format="%(levelname)s | %(asctime)s | %(message)s", level=logging.INFO)
 
 load_dotenv()
 
+# Connection pool size and retry policy of the shared OpenWeatherMap session
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "5"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.2"))
+
+# Requests per minute the batch fetcher may make to OpenWeatherMap unless the
+# event gives its share of the limit, and how many of them may be in flight at once
+OWM_REQUESTS_PER_MINUTE = float(os.getenv("OWM_REQUESTS_PER_MINUTE", "60"))
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", str(HTTP_POOL_SIZE)))
+THROTTLED_STATUS = 429
+
+INSERT_COLUMNS = ("INSERT INTO air_quality_readings "
+                  "(timestamp, location_id, air_quality_index,"
+                  "carbon_monoxide, nitrogen_monoxide, ammonia, "
+                  "nitrogen_dioxide, ozone, sulphur_dioxide, "
+                  "pm2_5, pm10) "
+                  "VALUES ")
+INSERT_TEMPLATE = ("(%(timestamp)s, %(location_id)s, %(air_quality_index)s,"
+                   "%(carbon_monoxide)s, %(nitrogen_monoxide)s, %(ammonia)s, "
+                   "%(nitrogen_dioxide)s, %(ozone)s, %(sulphur_dioxide)s, "
+                   "%(pm2_5)s, %(pm10)s)")
+# Readings already stored for the same location and time are skipped
+ON_CONFLICT = " ON CONFLICT (location_id, timestamp) DO NOTHING"
+
+# OpenWeatherMap only updates air quality about once an hour, so readings whose
+# timestamp has already been stored for a location are not written again
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "true").lower() == "true"
+SELECT_LAST_SEEN = ("SELECT location_id, last_timestamp FROM air_quality_last_seen "
+                    "WHERE location_id IN %s;")
+UPSERT_LAST_SEEN = ("INSERT INTO air_quality_last_seen (location_id, last_timestamp) "
+                    "VALUES %s ON CONFLICT (location_id) "
+                    "DO UPDATE SET last_timestamp = EXCLUDED.last_timestamp;")
+
+
+_connection = None
+_session = None
+# location_id: timestamp of the newest reading stored for that location
+_last_seen = {}
+
 
 def get_connection() -> psycopg2.extensions.connection:
-    """Get connection to RDS."""
-    return psycopg2.connect(
+    """
+    Get connection to RDS, reusing the connection from a previous warm
+    invocation when it is still healthy and reconnecting otherwise.
+    """
+    global _connection  # pylint: disable=global-statement
+    if _connection is not None and not _connection.closed:
+        try:
+            with _connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            logging.info("Reusing existing database connection.")
+            return _connection
+        except psycopg2.Error as e:
+            logging.warning("Cached database connection is unhealthy: %s", str(e))
+            close_connection()
+    _connection = psycopg2.connect(
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         dbname=os.getenv("DB_NAME"),
         port=os.getenv("DB_PORT")
     )
+    logging.info("Opened new database connection.")
+    return _connection
+
+
+def close_connection() -> None:
+    """Close and forget the cached connection."""
+    global _connection  # pylint: disable=global-statement
+    if _connection is not None:
+        try:
+            _connection.close()
+        except psycopg2.Error:
+            pass
+    _connection = None
+
+
+def get_session() -> req.Session:
+    """
+    Get the OpenWeatherMap session, creating it on first use. The fetch threads
+    share its pool of keep-alive connections, and server errors are retried.
+    Throttled requests are left to fetch_location, which retries and counts them.
+    """
+    global _session  # pylint: disable=global-statement
+    if _session is None:
+        _session = req.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=HTTP_RETRIES,
+                              backoff_factor=HTTP_BACKOFF_FACTOR,
+                              status_forcelist=(500, 502, 504),
+                              allowed_methods=None,
+                              respect_retry_after_header=False))
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
 
 
 def get_air_quality(latitude: float, longitude: float) -> dict:
     """Get air quality data from openweathermap.org."""
     url = "http://api.openweathermap.org/data/2.5/air_pollution"
-    retry_session = retry(req.Session(), retries=5, backoff_factor=0.2)
-    r = retry_session.get(
+    r = get_session().get(
         url + f"?lat={latitude}&lon={longitude}&appid={os.getenv("api_key")}")
     r.raise_for_status()
     logging.info("Received air quality info from API.")
@@ -49,46 +140,146 @@ def get_air_quality(latitude: float, longitude: float) -> dict:
     return processed_data
 
 
-def insert_reading(reading: dict) -> None:
-    """Insert reading into RDS."""
+def get_reading_time(reading: dict) -> datetime:
+    """The time of a reading as a naive UTC datetime, as stored in the RDS."""
+    return datetime.fromisoformat(reading["timestamp"]).replace(tzinfo=None)
+
+
+def load_last_seen(cur, location_ids: list[int]) -> None:
+    """Fill the last seen cache from the state table for locations not yet in it."""
+    missing = tuple(set(location_ids) - _last_seen.keys())
+    if missing:
+        cur.execute(SELECT_LAST_SEEN, (missing,))
+        _last_seen.update(dict(cur.fetchall()))
+
+
+def is_new_reading(reading: dict) -> bool:
+    """Whether the reading is newer than the last one cached for its location."""
+    return (reading["location_id"] not in _last_seen
+            or get_reading_time(reading) > _last_seen[reading["location_id"]])
+
+
+def get_new_readings(cur, readings: list[dict]) -> list[dict]:
+    """Returns the readings newer than the last one stored for their location."""
+    load_last_seen(cur, [reading["location_id"] for reading in readings])
+    return [reading for reading in readings if is_new_reading(reading)]
+
+
+def insert_readings(readings: list[dict]) -> int:
+    """
+    Insert several readings into the RDS with a single multi-row insert,
+    skipping readings which have not changed since the last one stored when
+    SKIP_UNCHANGED is set. Returns the number of writes skipped.
+    """
+    if SKIP_UNCHANGED and not any(map(is_new_reading, readings)):
+        # Every location is cached from a previous warm invocation, so there is
+        # nothing to look up or write
+        logging.info("%d unchanged air quality readings skipped.", len(readings))
+        return len(readings)
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                ("INSERT INTO air_quality_readings "
-                 "(timestamp, location_id, air_quality_index,"
-                 "carbon_monoxide, nitrogen_monoxide, ammonia, "
-                 "nitrogen_dioxide, ozone, sulphur_dioxide, "
-                 "pm2_5, pm10) "
-                 "VALUES "
-                 "(%(timestamp)s, %(location_id)s, %(air_quality_index)s,"
-                 "%(carbon_monoxide)s, %(nitrogen_monoxide)s, %(ammonia)s, "
-                 "%(nitrogen_dioxide)s, %(ozone)s, %(sulphur_dioxide)s, "
-                 "%(pm2_5)s, %(pm10)s)"),
-                reading
-            )
+            new_readings = get_new_readings(cur, readings) if SKIP_UNCHANGED else readings
+            if new_readings:
+                execute_values(cur, INSERT_COLUMNS + "%s" + ON_CONFLICT, new_readings,
+                               template=INSERT_TEMPLATE,
+                               page_size=len(new_readings))
+            if SKIP_UNCHANGED and new_readings:
+                execute_values(cur, UPSERT_LAST_SEEN,
+                               [(reading["location_id"], get_reading_time(reading))
+                                for reading in new_readings],
+                               page_size=len(new_readings))
             conn.commit()
-            logging.info(
-                "Air quality readings successfully inserted into RDS.")
-    finally:
-        conn.close()
+    except Exception:
+        # Discard the connection so the next invocation starts afresh
+        close_connection()
+        raise
+    if SKIP_UNCHANGED:
+        _last_seen.update((reading["location_id"], get_reading_time(reading))
+                          for reading in new_readings)
+    writes_skipped = len(readings) - len(new_readings)
+    logging.info("%d air quality readings successfully inserted into RDS, "
+                 "%d unchanged readings skipped.", len(new_readings), writes_skipped)
+    return writes_skipped
+
+
+def fetch_location(location: dict, bucket: TokenBucket) -> tuple[dict | None, int]:
+    """
+    Fetch the air quality at `location` within the rate limit of `bucket`,
+    waiting and retrying when the API throttles the request.
+    Returns the reading, or None if it failed, and the number of throttled requests.
+    """
+    throttled = 0
+    while True:
+        bucket.acquire()
+        try:
+            reading = get_air_quality(location["latitude"], location["longitude"])
+        except req.exceptions.RequestException as e:
+            response = getattr(e, "response", None)
+            if response is not None and response.status_code == THROTTLED_STATUS:
+                throttled += 1
+                if throttled <= HTTP_RETRIES:
+                    time.sleep(get_retry_after(response, bucket))
+                    continue
+            logging.error("Error processing location_id %s: %s",
+                          location["location_id"], str(e))
+            return None, throttled
+        reading["location_id"] = location["location_id"]
+        return reading, throttled
+
+
+def batch_handler(locations: list[dict],
+                  requests_per_minute: float = OWM_REQUESTS_PER_MINUTE) -> dict:
+    """
+    Fetch the current air quality for every location in `locations` concurrently,
+    within `requests_per_minute`, and insert all readings at once.
+    """
+    bucket = make_bucket(requests_per_minute, FETCH_CONCURRENCY)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=FETCH_CONCURRENCY) as executor:
+        results = list(executor.map(lambda location: fetch_location(location, bucket),
+                                    locations))
+    elapsed = time.perf_counter() - start
+
+    readings = [reading for reading, _ in results if reading is not None]
+    throttled = sum(throttle_count for _, throttle_count in results)
+    requests_per_second = (len(locations) + throttled) / elapsed if elapsed else 0.0
+    logging.info("Fetched %d locations in %.2fs at %.2f requests/s, throttled %d times.",
+                 len(locations), elapsed, requests_per_second, throttled)
+    writes_skipped = insert_readings(readings) if readings else 0
+    return {
+        "statusCode": 200,
+        "message": f"{len(readings) - writes_skipped} readings successfully inserted.",
+        "failed_locations": len(locations) - len(readings),
+        "writes_skipped": writes_skipped,
+        "throttled_requests": throttled,
+        "requests_per_second": round(requests_per_second, 2)
+    }
 
 
 def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused-argument
     """
-    Uploads current air quality data for given location_id
+    Uploads current air quality data for given location_id, or for every
+    location in a batch when the event contains a "locations" list.
     Parameters:
         event: Dict containing the location_id
                e.g. {"location_id": 1, "latitude": 51.507351, "longitude": -0.127758}
+               or a batch of locations
+               e.g. {"locations": [{"location_id": 1, "latitude": 51.507351,
+                                    "longitude": -0.127758}, ...]},
+               optionally with its "requests_per_minute" share of the API limit
         context: Lambda runtime context
     Returns:
         Dict containing status message
     """
+    if "locations" in event:
+        return batch_handler(event["locations"],
+                             event.get("requests_per_minute", OWM_REQUESTS_PER_MINUTE))
     try:
         air_quality_reading = get_air_quality(
             event["latitude"], event["longitude"])
         air_quality_reading["location_id"] = event["location_id"]
-        insert_reading(air_quality_reading)
+        writes_skipped = insert_readings([air_quality_reading])
     except Exception as e:
         logging.error(
             "Error processing location_id %s: %s",
@@ -98,7 +289,9 @@ def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused
         raise e
     return {
         "statusCode": 200,
-        "message": "Reading successfully inserted."
+        "message": ("Reading unchanged, insert skipped." if writes_skipped
+                    else "Reading successfully inserted."),
+        "writes_skipped": writes_skipped
     }
 
 
@@ -1,6 +1,10 @@
-from unittest.mock import patch, Mock, call
+from datetime import datetime
+from unittest.mock import patch, Mock, MagicMock, call
 from requests import Session
-from extract import get_air_quality, lambda_handler
+from requests.exceptions import RequestException, HTTPError
+import psycopg2
+from extract import (get_air_quality, get_connection, get_session, lambda_handler,
+                     fetch_location, TokenBucket)
 
 
 @patch.object(Session, 'get')
@@ -12,35 +16,182 @@ def test_get_air_quality(mock_session, response_payload, expected_return):
     assert ret == expected_return
 
 
+@patch("extract.execute_values")
 @patch("extract.get_air_quality")
 @patch("psycopg2.connect")
-def test_lambda_handler(mock_connect, mock_get_air_quality, expected_return):
-    cursor = Mock()
+def test_lambda_handler(mock_connect, mock_get_air_quality, mock_execute_values,
+                        expected_return):
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = []
     mock_get_air_quality.return_value = expected_return
-    mock_connect.return_value.cursor.return_value.__enter__.return_value = cursor
-    cursor.fetchone.return_value = (53.5, 0.1)
     ret = lambda_handler(
         {"location_id": 47, "latitude": 53.5, "longitude": 0.1},
         "context"
     )
     cursor.execute.assert_called_once_with(
-        ("INSERT INTO air_quality_readings "
-         "(timestamp, location_id, air_quality_index,"
-         "carbon_monoxide, nitrogen_monoxide, ammonia, "
-         "nitrogen_dioxide, ozone, sulphur_dioxide, "
-         "pm2_5, pm10) "
-         "VALUES "
-         "(%(timestamp)s, %(location_id)s, %(air_quality_index)s,"
-         "%(carbon_monoxide)s, %(nitrogen_monoxide)s, %(ammonia)s, "
-         "%(nitrogen_dioxide)s, %(ozone)s, %(sulphur_dioxide)s, "
-         "%(pm2_5)s, %(pm10)s)"),
-        expected_return | {"location_id": 47}
-    )
-    assert cursor.execute.call_count == 1
+        ("SELECT location_id, last_timestamp FROM air_quality_last_seen "
+         "WHERE location_id IN %s;"), ((47,),))
+    insert_call, last_seen_call = mock_execute_values.call_args_list
+    assert insert_call.args[1] == (
+        "INSERT INTO air_quality_readings "
+        "(timestamp, location_id, air_quality_index,"
+        "carbon_monoxide, nitrogen_monoxide, ammonia, "
+        "nitrogen_dioxide, ozone, sulphur_dioxide, "
+        "pm2_5, pm10) "
+        "VALUES %s"
+        " ON CONFLICT (location_id, timestamp) DO NOTHING")
+    assert insert_call.args[2] == [expected_return | {"location_id": 47}]
+    assert insert_call.kwargs["template"] == (
+        "(%(timestamp)s, %(location_id)s, %(air_quality_index)s,"
+        "%(carbon_monoxide)s, %(nitrogen_monoxide)s, %(ammonia)s, "
+        "%(nitrogen_dioxide)s, %(ozone)s, %(sulphur_dioxide)s, "
+        "%(pm2_5)s, %(pm10)s)")
+    assert last_seen_call.args[2] == [(47, datetime(2025, 7, 31, 18, 41, 20))]
     mock_get_air_quality.assert_called_once_with(53.5, 0.1)
     mock_connect.return_value.commit.assert_called_once()
-    mock_connect.return_value.close.assert_called_once()
+    mock_connect.return_value.close.assert_not_called()
+    assert ret == {
+        "statusCode": 200,
+        "message": "Reading successfully inserted.",
+        "writes_skipped": 0
+    }
+
+
+@patch("extract.execute_values")
+@patch("extract.get_air_quality")
+@patch("psycopg2.connect")
+def test_lambda_handler_skips_unchanged_reading(mock_connect, mock_get_air_quality,
+                                                mock_execute_values, expected_return):
+    mock_connect.return_value.closed = 0
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = []
+    mock_get_air_quality.side_effect = lambda *_: dict(expected_return)
+    event = {"location_id": 47, "latitude": 53.5, "longitude": 0.1}
+    lambda_handler(event, "context")
+    ret = lambda_handler(event, "context")
+    assert mock_execute_values.call_count == 2
     assert ret == {
         "statusCode": 200,
-        "message": "Reading successfully inserted."
+        "message": "Reading unchanged, insert skipped.",
+        "writes_skipped": 1
     }
+
+
+@patch("extract.execute_values")
+@patch("extract.get_air_quality")
+@patch("psycopg2.connect")
+def test_lambda_handler_skips_cached_reading_without_the_database(mock_connect,
+                                                                  mock_get_air_quality,
+                                                                  mock_execute_values,
+                                                                  expected_return):
+    mock_connect.return_value.closed = 0
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = []
+    mock_get_air_quality.side_effect = lambda *_: dict(expected_return)
+    event = {"location_id": 47, "latitude": 53.5, "longitude": 0.1}
+    lambda_handler(event, "context")
+    cursor.execute.reset_mock()
+    ret = lambda_handler(event, "context")
+    mock_connect.assert_called_once()
+    cursor.execute.assert_not_called()
+    mock_connect.return_value.commit.assert_called_once()
+    assert ret["writes_skipped"] == 1
+
+
+@patch("extract.execute_values")
+@patch("extract.get_air_quality")
+@patch("psycopg2.connect")
+def test_lambda_handler_reads_last_seen_from_state_table(mock_connect, mock_get_air_quality,
+                                                         mock_execute_values, expected_return):
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(47, datetime(2025, 7, 31, 18, 41, 20))]
+    mock_get_air_quality.return_value = expected_return
+    ret = lambda_handler(
+        {"location_id": 47, "latitude": 53.5, "longitude": 0.1}, "context")
+    mock_execute_values.assert_not_called()
+    mock_connect.return_value.commit.assert_called_once()
+    assert ret["writes_skipped"] == 1
+
+
+@patch("extract.execute_values")
+@patch("extract.get_air_quality")
+@patch("psycopg2.connect")
+def test_lambda_handler_batch(mock_connect, mock_get_air_quality,
+                              mock_execute_values, expected_return):
+    def fake_get_air_quality(latitude, longitude):
+        if latitude == 51.0:
+            raise RequestException("timeout")
+        return dict(expected_return)
+    mock_get_air_quality.side_effect = fake_get_air_quality
+    locations = [{"location_id": i, "latitude": 50.0 + i, "longitude": 0.1}
+                 for i in range(3)]
+    mock_connect.return_value.cursor.return_value.__enter__.return_value \
+        .fetchall.return_value = [(2, datetime(2025, 7, 31, 18, 41, 20))]
+    ret = lambda_handler({"locations": locations}, "context")
+    mock_get_air_quality.assert_has_calls(
+        [call(50.0, 0.1), call(51.0, 0.1), call(52.0, 0.1)], any_order=True)
+    assert mock_execute_values.call_args_list[0].args[2] == [
+        expected_return | {"location_id": 0}]
+    mock_connect.return_value.commit.assert_called_once()
+    assert ret["message"] == "1 readings successfully inserted."
+    assert ret["failed_locations"] == 1
+    assert ret["writes_skipped"] == 1
+    assert ret["throttled_requests"] == 0
+    assert ret["requests_per_second"] > 0
+
+
+@patch("extract.insert_readings")
+@patch("extract.fetch_location")
+def test_batch_uses_its_share_of_the_rate_limit(mock_fetch_location, mock_insert_readings):
+    mock_fetch_location.return_value = (None, 0)
+    lambda_handler({"locations": [{"location_id": 1, "latitude": 50.0, "longitude": 0.1}],
+                    "requests_per_minute": 6}, "context")
+    bucket = mock_fetch_location.call_args.args[1]
+    assert bucket.rate == 0.1
+    assert bucket.capacity == 6
+    mock_insert_readings.assert_not_called()
+
+
+@patch("extract.time.sleep")
+@patch("extract.get_air_quality")
+def test_fetch_location_retries_throttled_requests(mock_get_air_quality, mock_sleep,
+                                                   expected_return):
+    throttled = Mock(status_code=429, headers={"Retry-After": "2"})
+    mock_get_air_quality.side_effect = [
+        HTTPError(response=throttled), dict(expected_return)]
+    bucket = TokenBucket(rate=1000, capacity=5)
+    reading, throttle_count = fetch_location(
+        {"location_id": 3, "latitude": 50.0, "longitude": 0.1}, bucket)
+    assert reading == expected_return | {"location_id": 3}
+    assert throttle_count == 1
+    mock_sleep.assert_called_once_with(2.0)
+
+
+@patch("psycopg2.connect")
+def test_get_connection_reuses_healthy_connection(mock_connect):
+    mock_connect.return_value.closed = 0
+    assert get_connection() is get_connection()
+    mock_connect.assert_called_once()
+
+
+@patch("psycopg2.connect")
+def test_get_connection_reconnects_when_unhealthy(mock_connect):
+    stale, fresh = MagicMock(closed=0), MagicMock(closed=0)
+    stale.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        psycopg2.OperationalError("server closed the connection")
+    mock_connect.side_effect = [stale, fresh]
+    get_connection()
+    assert get_connection() is fresh
+    stale.close.assert_called_once()
+
+
+def test_get_session_is_shared():
+    session = get_session()
+    assert get_session() is session
+    assert session.get_adapter("https://").poolmanager is not None
+
+
+def test_get_session_leaves_throttled_requests_to_fetch_location():
+    retry = get_session().get_adapter("https://").max_retries
+    assert not retry.is_retry("GET", 429, has_retry_after=True)
+    assert retry.is_retry("GET", 502)
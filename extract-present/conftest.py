@@ -0,0 +1,15 @@
+# pylint: skip-file
+import pytest
+import extract
+
+# The orchestrator has its own requirements and is tested on its own
+collect_ignore = ["orchestrator"]
+
+
+@pytest.fixture(autouse=True)
+def reset_clients():
+    extract._connection = None
+    extract._openmeteo = None
+    yield
+    extract._connection = None
+    extract._openmeteo = None
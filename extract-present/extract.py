@@ -4,43 +4,107 @@ from datetime import datetime, timezone
 from typing import Any
 import logging
 import openmeteo_requests
-from retry_requests import retry
 from dotenv import load_dotenv
 import psycopg2
+from psycopg2.extras import execute_values
 import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3 import Retry
 
 logging.basicConfig(
     format="%(levelname)s | %(asctime)s | %(message)s", level=logging.INFO)
 
 load_dotenv()
 
+WEATHER_API_URL = "https://api.open-meteo.com/v1/forecast"
+# The order of variables needs to match the order they are read back in
+CURRENT_VARIABLES = ["temperature_2m", "wind_speed_10m", "wind_direction_10m",
+                     "wind_gusts_10m", "rain", "snowfall"]
+# Number of coordinates sent in a single Open-Meteo request in batch mode
+LOCATIONS_PER_REQUEST = 100
+# Connection pool size and retry policy of the shared Open-Meteo client
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "5"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.2"))
+
+INSERT_COLUMNS = ("INSERT INTO weather_readings "
+                  "(timestamp, location_id, rainfall_last_15_mins, "
+                  "current_temperature, wind_speed, "
+                  "wind_gust_speed, wind_direction, "
+                  "snowfall_last_15_mins) "
+                  "VALUES ")
+INSERT_TEMPLATE = ("(%(timestamp)s, %(location_id)s, %(rainfall_last_15_mins)s, "
+                   "%(current_temperature)s, %(wind_speed)s, "
+                   "%(wind_gust_speed)s, %(wind_direction)s, "
+                   "%(snowfall_last_15_mins)s)")
+# Readings already stored for the same location and time are skipped
+ON_CONFLICT = " ON CONFLICT (location_id, timestamp) DO NOTHING"
+
+
+_connection = None
+_openmeteo = None
+
 
 def get_connection() -> psycopg2.extensions.connection:
-    """Get connection to RDS."""
-    return psycopg2.connect(
+    """
+    Get connection to RDS, reusing the connection from a previous warm
+    invocation when it is still healthy and reconnecting otherwise.
+    """
+    global _connection  # pylint: disable=global-statement
+    if _connection is not None and not _connection.closed:
+        try:
+            with _connection.cursor() as cur:
+                cur.execute("SELECT 1")
+            logging.info("Reusing existing database connection.")
+            return _connection
+        except psycopg2.Error as e:
+            logging.warning("Cached database connection is unhealthy: %s", str(e))
+            close_connection()
+    _connection = psycopg2.connect(
         host=os.getenv("DB_HOST"),
         user=os.getenv("DB_USER"),
         password=os.getenv("DB_PASSWORD"),
         dbname=os.getenv("DB_NAME"),
         port=os.getenv("DB_PORT")
     )
+    logging.info("Opened new database connection.")
+    return _connection
 
 
-def get_weather(latitude: float, longitude: float) -> dict:
-    """Get the current weather conditions from open-meteo.com"""
-    session = req.Session()
-    retry_session = retry(session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    url = "https://api.open-meteo.com/v1/forecast"
-    params = {
-        "latitude": latitude,
-        "longitude": longitude,
-        "current": ["temperature_2m", "wind_speed_10m", "wind_direction_10m",
-                    "wind_gusts_10m", "rain", "snowfall"],
-    }
-    api_responses = openmeteo.weather_api(url, params=params)
-    logging.info("Received weather reading from API.")
-    api_response = api_responses[0]
+def close_connection() -> None:
+    """Close and forget the cached connection."""
+    global _connection  # pylint: disable=global-statement
+    if _connection is not None:
+        try:
+            _connection.close()
+        except psycopg2.Error:
+            pass
+    _connection = None
+
+
+def get_openmeteo_client() -> openmeteo_requests.Client:
+    """
+    Get the Open-Meteo client, creating it on first use, so every batch request
+    goes over one keep-alive session which retries server errors.
+    """
+    global _openmeteo  # pylint: disable=global-statement
+    if _openmeteo is None:
+        session = req.Session()
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=Retry(total=HTTP_RETRIES,
+                              backoff_factor=HTTP_BACKOFF_FACTOR,
+                              status_forcelist=(500, 502, 504),
+                              allowed_methods=None))
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        _openmeteo = openmeteo_requests.Client(session=session)
+    return _openmeteo
+
+
+def process_current_weather(api_response: Any) -> dict:
+    """Convert the current weather of one Open-Meteo response into a reading."""
     # Process current data. The order of variables needs to be the same as requested.
     current_weather = api_response.Current()
     data = {}
@@ -55,39 +119,123 @@ def get_weather(latitude: float, longitude: float) -> dict:
     return data
 
 
+def get_weather(latitude: float, longitude: float) -> dict:
+    """Get the current weather conditions from open-meteo.com"""
+    openmeteo = get_openmeteo_client()
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "current": CURRENT_VARIABLES,
+    }
+    api_responses = openmeteo.weather_api(WEATHER_API_URL, params=params)
+    logging.info("Received weather reading from API.")
+    return process_current_weather(api_responses[0])
+
+
+def get_weather_batch(locations: list[dict]) -> list[dict]:
+    """
+    Get the current weather conditions for several locations in one request.
+    Open-Meteo returns one response per coordinate, in the order requested.
+    Parameters:
+        locations: List of dicts containing the location_id, latitude and longitude
+    Returns:
+        List of readings, each tagged with its location_id
+    """
+    openmeteo = get_openmeteo_client()
+    params = {
+        "latitude": [location["latitude"] for location in locations],
+        "longitude": [location["longitude"] for location in locations],
+        "current": CURRENT_VARIABLES,
+    }
+    api_responses = openmeteo.weather_api(WEATHER_API_URL, params=params)
+    if len(api_responses) != len(locations):
+        raise RuntimeError(
+            f"Expected {len(locations)} weather responses, "
+            f"received {len(api_responses)}.")
+    logging.info("Received %d weather readings from API.", len(api_responses))
+    readings = []
+    for location, api_response in zip(locations, api_responses):
+        reading = process_current_weather(api_response)
+        reading["location_id"] = location["location_id"]
+        readings.append(reading)
+    return readings
+
+
 def insert_reading(reading: dict) -> None:
     """Insert reading into the RDS."""
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                ("INSERT INTO weather_readings "
-                 "(timestamp, location_id, rainfall_last_15_mins, "
-                 "current_temperature, wind_speed, "
-                 "wind_gust_speed, wind_direction, "
-                 "snowfall_last_15_mins) "
-                 "VALUES "
-                 "(%(timestamp)s, %(location_id)s, %(rainfall_last_15_mins)s, "
-                 "%(current_temperature)s, %(wind_speed)s, "
-                 "%(wind_gust_speed)s, %(wind_direction)s, "
-                 "%(snowfall_last_15_mins)s)"),
-                reading)
+            cur.execute(INSERT_COLUMNS + INSERT_TEMPLATE + ON_CONFLICT, reading)
             conn.commit()
             logging.info("Weather reading successfully inserted into RDS.")
-    finally:
-        conn.close()
+    except Exception:
+        # Discard the connection so the next invocation starts afresh
+        close_connection()
+        raise
+
+
+def insert_readings(readings: list[dict]) -> None:
+    """Insert several readings into the RDS with a single multi-row insert."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            execute_values(cur, INSERT_COLUMNS + "%s" + ON_CONFLICT, readings,
+                           template=INSERT_TEMPLATE,
+                           page_size=len(readings))
+            conn.commit()
+            logging.info("%d weather readings successfully inserted into RDS.",
+                         len(readings))
+    except Exception:
+        # Discard the connection so the next invocation starts afresh
+        close_connection()
+        raise
+
+
+def batch_handler(locations: list[dict]) -> dict:
+    """
+    Fetch and insert the current weather for every location in `locations`.
+    A failed request is logged and its locations are reported as failed,
+    so the readings of the other requests are still inserted.
+    """
+    readings = []
+    for i in range(0, len(locations), LOCATIONS_PER_REQUEST):
+        batch = locations[i:i + LOCATIONS_PER_REQUEST]
+        try:
+            readings.extend(get_weather_batch(batch))
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            logging.error("Error processing location_ids %s: %s",
+                          [location["location_id"] for location in batch], str(e))
+    if readings:
+        insert_readings(readings)
+    return {
+        "statusCode": 200,
+        "message": f"{len(readings)} readings successfully inserted.",
+        "failed_locations": len(locations) - len(readings)
+    }
 
 
 def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused-argument
     """
-    Uploads current weather data for given location_id
+    Uploads current weather data for given location_id, or for every
+    location in a batch when the event contains a "locations" list.
     Parameters:
         event: Dict containing the location_id 
                e.g. {"location_id": 1, "latitude": 51.507351, "longitude": -0.127758}
+               or a batch of locations
+               e.g. {"locations": [{"location_id": 1, "latitude": 51.507351,
+                                    "longitude": -0.127758}, ...]}
         context: Lambda runtime context
     Returns:
         Dict containing status message
     """
+    if "locations" in event:
+        try:
+            return batch_handler(event["locations"])
+        except Exception as e:
+            logging.error("Error processing batch of %d locations: %s",
+                          len(event["locations"]), str(e))
+            raise e
     try:
         weather_reading = get_weather(event["latitude"], event["longitude"])
         weather_reading["location_id"] = event["location_id"]
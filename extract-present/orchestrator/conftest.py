@@ -0,0 +1,9 @@
+# pylint: skip-file
+import os
+import sys
+from pathlib import Path
+
+# The lambda client is created on import
+os.environ.setdefault("AWS_REGION", "eu-west-2")
+# The rate limiter is shared with the air quality lambdas
+sys.path.append(str(Path(__file__).resolve().parent.parent.parent / "shared"))
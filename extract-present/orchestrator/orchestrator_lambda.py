@@ -3,12 +3,21 @@ A Python script to invoke the lambdas for extracting and inserting all live data
 """
 import os
 import logging
+from array import array
+from datetime import datetime, timezone
 from typing import Any
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import json
+import math
+import time
 
 from dotenv import load_dotenv
+import aiohttp
 import boto3
 import psycopg2
+from psycopg2.extras import execute_values
+from owm_rate_limit import TokenBucket, make_bucket
 
 
 load_dotenv()
@@ -20,6 +29,44 @@ lambda_client = boto3.client("lambda", region_name=os.getenv("AWS_REGION"))
 
 LIVE_WEATHER_LAMBDA = "c18-climate-monitor-current-weather-lambda"
 LIVE_AIR_QUALITY_LAMBDA = "c18-climate-monitor-current-air-quality-lambda"
+# Number of locations sent to each live data lambda invocation
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "100"))
+# Maximum number of lambda invocations dispatched at once
+MAX_CONCURRENT_INVOKES = int(os.getenv("MAX_CONCURRENT_INVOKES", "10"))
+# Open-Meteo accepts up to this many coordinates in one request
+WEATHER_BATCH_SIZE = 100
+# OpenWeatherMap requests per minute shared by every live air quality shard,
+# which all run at once since they are invoked asynchronously, or made by
+# this lambda in collector mode
+OWM_REQUESTS_PER_MINUTE = float(os.getenv("OWM_REQUESTS_PER_MINUTE", "60"))
+
+# Collector mode fetches the live data inside this lambda instead of fanning out
+FAN_OUT_MODE = "fan-out"
+COLLECTOR_MODE = "collect"
+WEATHER_API_URL = "https://api.open-meteo.com/v1/forecast"
+AIR_QUALITY_API_URL = "http://api.openweathermap.org/data/2.5/air_pollution"
+CURRENT_WEATHER_VARIABLES = ("temperature_2m,wind_speed_10m,wind_direction_10m,"
+                             "wind_gusts_10m,rain,snowfall")
+# Maximum number of HTTP requests in flight at once in collector mode
+COLLECTOR_CONCURRENCY = int(os.getenv("COLLECTOR_CONCURRENCY", "20"))
+COLLECTOR_TIMEOUT_SECONDS = 30
+
+# As in the live air quality lambda, air quality readings whose timestamp has
+# already been stored for a location are not written again
+SKIP_UNCHANGED = os.getenv("SKIP_UNCHANGED", "true").lower() == "true"
+SELECT_LAST_SEEN = ("SELECT location_id, last_timestamp FROM air_quality_last_seen "
+                    "WHERE location_id IN %s;")
+UPSERT_LAST_SEEN = ("INSERT INTO air_quality_last_seen (location_id, last_timestamp) "
+                    "VALUES %s ON CONFLICT (location_id) "
+                    "DO UPDATE SET last_timestamp = EXCLUDED.last_timestamp;")
+
+# Kept between warm invocations and reloaded only when the registry version changes
+_location_registry = {
+    "version": None,
+    "locations": [],
+    "latitudes": array("d"),
+    "longitudes": array("d")
+}
 
 
 def get_connection() -> psycopg2.extensions.connection:
@@ -33,57 +80,361 @@ def get_connection() -> psycopg2.extensions.connection:
     )
 
 
+def get_location_registry() -> dict:
+    """
+    Return the cached locations, reloading them from the RDS only when the
+    location registry version has changed since they were last loaded.
+    The cache holds the location rows and compact latitude and longitude
+    arrays in the same order, ready for batched API calls.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("SELECT version FROM location_registry")
+            version = cur.fetchone()[0]
+            if version == _location_registry["version"]:
+                logging.info("Using cached locations (version %s)", version)
+                return _location_registry
+            cur.execute("SELECT * FROM locations ORDER BY location_id")
+            location_data = cur.fetchall()
+        logging.info("Location data (version %s) retrieved from RDS", version)
+    finally:
+        conn.close()
+    _location_registry["version"] = version
+    _location_registry["locations"] = location_data
+    _location_registry["latitudes"] = array(
+        "d", (location[2] for location in location_data))
+    _location_registry["longitudes"] = array(
+        "d", (location[3] for location in location_data))
+    return _location_registry
+
+
 def get_location_data() -> list[tuple]:
     """Return all data from the location table in the RDS"""
+    return get_location_registry()["locations"]
+
+
+def shard_locations(location_data: list[tuple], shard_size: int) -> list[list[dict]]:
+    """Split the locations into shards of at most `shard_size` location payloads."""
+    payloads = [
+        {
+            "location_id": location[0],
+            "latitude": location[2],
+            "longitude": location[3]
+        } for location in location_data]
+    return [payloads[i:i + shard_size] for i in range(0, len(payloads), shard_size)]
+
+
+def get_shard_payload(lambda_name: str, shard: list[dict], shard_count: int) -> dict:
+    """
+    The event for one shard. Air quality shards are each given an equal part of
+    OWM_REQUESTS_PER_MINUTE, so together they stay within the API limit.
+    """
+    payload = {"locations": shard}
+    if lambda_name == LIVE_AIR_QUALITY_LAMBDA:
+        payload["requests_per_minute"] = OWM_REQUESTS_PER_MINUTE / shard_count
+    return payload
+
+
+def invoke_shard(lambda_name: str, shard: list[dict], shard_count: int = 1) -> dict:
+    """
+    Invoke `lambda_name` asynchronously with every location in `shard`,
+    one of `shard_count` shards.
+    Returns:
+        Dict describing the invocation latency and outcome
+    """
+    start = time.perf_counter()
+    result = {"lambda": lambda_name, "locations": len(shard)}
+    try:
+        response = lambda_client.invoke(
+            FunctionName=lambda_name,
+            InvocationType="Event",
+            Payload=json.dumps(get_shard_payload(lambda_name, shard, shard_count))
+        )
+        result["status_code"] = response['ResponseMetadata']['HTTPStatusCode']
+        result["failed"] = result["status_code"] != 202
+    except Exception as e:  # pylint: disable=broad-exception-caught
+        result["status_code"] = None
+        result["failed"] = True
+        result["error"] = str(e)
+    result["latency"] = round(time.perf_counter() - start, 3)
+    return result
+
+
+def fan_out_live_data() -> dict:
+    """
+    Invoke the live weather and air quality lambdas once per shard of locations,
+    with at most MAX_CONCURRENT_INVOKES invocations in flight.
+    Returns:
+        Dict containing status message, per-shard results and dispatch timings
+    """
+    start = time.perf_counter()
+    location_data = get_location_data()
+    shards = shard_locations(location_data, SHARD_SIZE)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_INVOKES) as executor:
+        futures = [executor.submit(invoke_shard, lambda_name, shard, len(shards))
+                   for lambda_name in (LIVE_WEATHER_LAMBDA, LIVE_AIR_QUALITY_LAMBDA)
+                   for shard in shards]
+        results = [future.result() for future in futures]
+    dispatch_time = round(time.perf_counter() - start, 3)
+
+    failed = [result for result in results if result["failed"]]
+    for result in failed:
+        logging.error("Failed to invoke %s for %d locations: %s",
+                      result["lambda"], result["locations"],
+                      result.get("error", result["status_code"]))
+    latencies = [result["latency"] for result in results]
+    timings = {
+        "total": dispatch_time,
+        "max_shard_latency": max(latencies, default=0),
+        "mean_shard_latency": round(sum(latencies) / len(latencies), 3) if latencies else 0
+    }
+    logging.info("Dispatched %d shards for %d locations (%d failed). Timings: %s",
+                 len(results), len(location_data), len(failed), timings)
+    return {
+        "statusCode": 200,
+        "message": (f"Failed to invoke {len(failed)} of {len(results)} shards."
+                    if failed else "Successfully invoked all live data shards."),
+        "mode": FAN_OUT_MODE,
+        "shards": results,
+        "failed_shards": len(failed),
+        "timings": timings
+    }
+
+
+async def fetch_weather_batch(session: aiohttp.ClientSession,
+                              semaphore: asyncio.Semaphore,
+                              batch: list[tuple],
+                              coordinates: tuple[array, array]) -> list[tuple]:
+    """
+    Get the current weather for a batch of locations in one Open-Meteo request.
+    `coordinates` holds the latitudes and longitudes of the batch, in order.
+    """
+    latitudes, longitudes = coordinates
+    params = {
+        "latitude": ",".join(map(str, latitudes)),
+        "longitude": ",".join(map(str, longitudes)),
+        "current": CURRENT_WEATHER_VARIABLES,
+        "timeformat": "unixtime"
+    }
+    async with semaphore:
+        async with session.get(WEATHER_API_URL, params=params) as response:
+            response.raise_for_status()
+            results = await response.json()
+    # A single coordinate is returned as an object rather than a list
+    if isinstance(results, dict):
+        results = [results]
+    if len(results) != len(batch):
+        raise RuntimeError(
+            f"Expected {len(batch)} weather responses, received {len(results)}.")
+    rows = []
+    for location, result in zip(batch, results):
+        current = result["current"]
+        rows.append((
+            datetime.fromtimestamp(current["time"], timezone.utc),
+            location[0],
+            current["rain"],
+            current["temperature_2m"],
+            current["wind_speed_10m"],
+            current["wind_gusts_10m"],
+            current["wind_direction_10m"],
+            current["snowfall"]
+        ))
+    return rows
+
+
+async def fetch_air_quality(session: aiohttp.ClientSession,
+                            semaphore: asyncio.Semaphore,
+                            bucket: TokenBucket,
+                            location: tuple) -> tuple:
+    """
+    Get the current air quality for a location from openweathermap.org,
+    within the rate limit of `bucket`.
+    """
+    params = {
+        "lat": location[2],
+        "lon": location[3],
+        "appid": os.getenv("api_key", "")
+    }
+    # The bucket blocks while it waits, so it is waited on outside the event loop
+    await asyncio.to_thread(bucket.acquire)
+    async with semaphore:
+        async with session.get(AIR_QUALITY_API_URL, params=params) as response:
+            response.raise_for_status()
+            results = await response.json()
+    reading = results["list"][0]
+    return (
+        datetime.fromtimestamp(reading["dt"], timezone.utc),
+        location[0],
+        reading["main"]["aqi"],
+        reading["components"]["co"],
+        reading["components"]["no"],
+        reading["components"]["nh3"],
+        reading["components"]["no2"],
+        reading["components"]["o3"],
+        reading["components"]["so2"],
+        reading["components"]["pm2_5"],
+        reading["components"]["pm10"]
+    )
+
+
+async def timed_gather(tasks: list, timings: dict, stage: str) -> list:
+    """Await `tasks` together, recording the elapsed time under `stage`."""
+    start = time.perf_counter()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    timings[stage] = round(time.perf_counter() - start, 3)
+    return results
+
+
+async def fetch_live_data(registry: dict, timings: dict) -> tuple[list, list, int]:
+    """
+    Fetch the current weather and air quality for every location in the
+    registry concurrently, with at most COLLECTOR_CONCURRENCY requests in flight
+    and the air quality requests within OWM_REQUESTS_PER_MINUTE.
+    Returns:
+        Tuple of weather rows, air quality rows and the number of failed requests
+    """
+    location_data = registry["locations"]
+    semaphore = asyncio.Semaphore(COLLECTOR_CONCURRENCY)
+    bucket = make_bucket(OWM_REQUESTS_PER_MINUTE, COLLECTOR_CONCURRENCY)
+    timeout = aiohttp.ClientTimeout(total=COLLECTOR_TIMEOUT_SECONDS)
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        weather_tasks = [
+            fetch_weather_batch(session, semaphore,
+                                location_data[i:i + WEATHER_BATCH_SIZE],
+                                (registry["latitudes"][i:i + WEATHER_BATCH_SIZE],
+                                 registry["longitudes"][i:i + WEATHER_BATCH_SIZE]))
+            for i in range(0, len(location_data), WEATHER_BATCH_SIZE)]
+        aq_tasks = [fetch_air_quality(session, semaphore, bucket, location)
+                    for location in location_data]
+        weather_results, aq_results = await asyncio.gather(
+            timed_gather(weather_tasks, timings, "fetch_weather"),
+            timed_gather(aq_tasks, timings, "fetch_air_quality"))
+
+    failures = 0
+    weather_rows = []
+    for result in weather_results:
+        if isinstance(result, Exception):
+            logging.error("Error fetching weather batch: %s", str(result))
+            failures += 1
+        else:
+            weather_rows.extend(result)
+    aq_rows = []
+    for location, result in zip(location_data, aq_results):
+        if isinstance(result, Exception):
+            logging.error("Error fetching air quality for %s: %s",
+                          location[1], str(result))
+            failures += 1
+        else:
+            aq_rows.append(result)
+    return weather_rows, aq_rows, failures
+
+
+def get_new_air_quality_rows(cur, aq_rows: list[tuple]) -> list[tuple]:
+    """Returns the air quality rows newer than the last one stored for their location."""
+    cur.execute(SELECT_LAST_SEEN, (tuple(row[1] for row in aq_rows),))
+    last_seen = dict(cur.fetchall())
+    return [row for row in aq_rows
+            if row[1] not in last_seen or row[0].replace(tzinfo=None) > last_seen[row[1]]]
+
+
+def insert_live_data(weather_rows: list[tuple], aq_rows: list[tuple]) -> int:
+    """
+    Bulk insert the weather and air quality readings over one connection,
+    skipping air quality readings which have not changed since the last one
+    stored when SKIP_UNCHANGED is set. Returns the number of air quality writes skipped.
+    """
+    new_aq_rows = aq_rows
+    conn = get_connection()
     try:
-        conn = get_connection()
         with conn.cursor() as cur:
-            cur.execute("SELECT * FROM locations")
-            location_data = cur.fetchall()
-        logging.info("Location data retrieved from RDS")
+            if weather_rows:
+                execute_values(
+                    cur,
+                    """INSERT INTO weather_readings (
+                            timestamp, location_id, rainfall_last_15_mins,
+                            current_temperature, wind_speed, wind_gust_speed,
+                            wind_direction, snowfall_last_15_mins
+                        ) VALUES %s
+                        ON CONFLICT (location_id, timestamp) DO NOTHING""",
+                    weather_rows,
+                    page_size=len(weather_rows))
+            if aq_rows and SKIP_UNCHANGED:
+                new_aq_rows = get_new_air_quality_rows(cur, aq_rows)
+            if new_aq_rows:
+                execute_values(
+                    cur,
+                    """INSERT INTO air_quality_readings (
+                            timestamp, location_id, air_quality_index,
+                            carbon_monoxide, nitrogen_monoxide, ammonia,
+                            nitrogen_dioxide, ozone, sulphur_dioxide,
+                            pm2_5, pm10
+                        ) VALUES %s
+                        ON CONFLICT (location_id, timestamp) DO NOTHING""",
+                    new_aq_rows,
+                    page_size=len(new_aq_rows))
+            if SKIP_UNCHANGED and new_aq_rows:
+                execute_values(cur, UPSERT_LAST_SEEN,
+                               [(row[1], row[0].replace(tzinfo=None)) for row in new_aq_rows],
+                               page_size=len(new_aq_rows))
+        conn.commit()
     finally:
         conn.close()
-    return location_data
+    return len(aq_rows) - len(new_aq_rows)
+
+
+def collect_live_data() -> dict:
+    """
+    Fetch and insert the live data for every location within this lambda.
+    Returns:
+        Dict containing status message, row counts and per-stage timings in seconds
+    """
+    timings = {}
+    start = time.perf_counter()
+    registry = get_location_registry()
+    timings["load_locations"] = round(time.perf_counter() - start, 3)
+
+    weather_rows, aq_rows, failures = asyncio.run(
+        fetch_live_data(registry, timings))
+    location_count = len(registry["locations"])
+    requests = math.ceil(location_count / WEATHER_BATCH_SIZE) + location_count
+
+    insert_start = time.perf_counter()
+    aq_writes_skipped = insert_live_data(weather_rows, aq_rows)
+    timings["insert"] = round(time.perf_counter() - insert_start, 3)
+    timings["total"] = round(time.perf_counter() - start, 3)
+
+    logging.info("Collected %d weather and %d air quality readings, %d unchanged, "
+                 "with %d failed requests. Timings: %s",
+                 len(weather_rows), len(aq_rows), aq_writes_skipped, failures, timings)
+    return {
+        "statusCode": 200,
+        "message": (f"Inserted the live data, {failures} of {requests} requests failed."
+                    if failures else "Successfully inserted all live data."),
+        "mode": COLLECTOR_MODE,
+        "weather_readings": len(weather_rows),
+        "air_quality_readings": len(aq_rows) - aq_writes_skipped,
+        "air_quality_writes_skipped": aq_writes_skipped,
+        "failed_requests": failures,
+        "timings": timings
+    }
 
 
-def lambda_handler(event: Any = None, context: Any = None) -> None:  # pylint: disable=unused-argument
-    """Lambda function to invoke the live weather and air quality lambdas for every location"""
+def lambda_handler(event: Any = None,
+                   context: Any = None) -> dict:  # pylint: disable=unused-argument
+    """
+    Lambda function to load the live weather and air quality for every location.
+    In fan-out mode (the default) the live data lambdas are invoked for every shard
+    of locations, in collector mode the data is fetched and inserted by this lambda.
+    The mode is read from the event, e.g. {"mode": "collect"}, or the LIVE_DATA_MODE
+    environment variable. Returns the result of the mode which ran.
+    """
+    mode = (event or {}).get("mode", os.getenv("LIVE_DATA_MODE", FAN_OUT_MODE))
     try:
-        location_data = get_location_data()
-
-        for location in location_data:
-
-            payload = {
-                "location_id": location[0],
-                "latitude": location[2],
-                "longitude": location[3]
-            }
-
-            # Live weather data
-            weather_response = lambda_client.invoke(
-                FunctionName=LIVE_WEATHER_LAMBDA,
-                InvocationType="Event",
-                Payload=json.dumps(payload)
-            )
-            logging.info("Weather data for %s uploaded - Status code: %s", location[1],
-                         weather_response['ResponseMetadata']['HTTPStatusCode'])
-
-            # Live air quality data
-            aq_response = lambda_client.invoke(
-                FunctionName=LIVE_AIR_QUALITY_LAMBDA,
-                InvocationType="Event",
-                Payload=json.dumps(payload)
-            )
-            logging.info("Air quality data for %s uploaded - Status code: %s", location[1],
-                         aq_response['ResponseMetadata']['HTTPStatusCode'])
-
-            logging.info("Successfully inserted all live data.")
-
-        return {
-            "statusCode": 200,
-            "message": "Successfully inserted all live data."
-        }
+        if mode == COLLECTOR_MODE:
+            return collect_live_data()
 
+        return fan_out_live_data()
     except Exception as e:
         logging.error("Error inserting live data: %s", str(e))
         raise
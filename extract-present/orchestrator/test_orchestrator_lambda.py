@@ -0,0 +1,257 @@
+import json
+from array import array
+from datetime import datetime, timezone
+from unittest.mock import patch
+import pytest
+import orchestrator_lambda
+from orchestrator_lambda import (LIVE_AIR_QUALITY_LAMBDA, LIVE_WEATHER_LAMBDA,
+                                 WEATHER_API_URL, collect_live_data, fan_out_live_data,
+                                 insert_live_data, invoke_shard, shard_locations)
+
+
+def make_locations(count: int) -> list[tuple]:
+    return [(i, f"Location {i}", 50.0 + i / 100, -1.0) for i in range(1, count + 1)]
+
+
+def make_registry(count: int) -> dict:
+    locations = make_locations(count)
+    return {
+        "version": 1,
+        "locations": locations,
+        "latitudes": array("d", (location[2] for location in locations)),
+        "longitudes": array("d", (location[3] for location in locations))
+    }
+
+
+def weather_result() -> dict:
+    return {"current": {"time": 1753987500, "rain": 0.1, "temperature_2m": 18.5,
+                        "wind_speed_10m": 9.0, "wind_gusts_10m": 20.2,
+                        "wind_direction_10m": 270, "snowfall": 0.0}}
+
+
+def air_quality_result() -> dict:
+    return {"list": [{"dt": 1753987280, "main": {"aqi": 2},
+                      "components": {"co": 297.06, "no": 0, "nh3": 0.49, "no2": 0.12,
+                                     "o3": 89.44, "so2": 0.21, "pm2_5": 7.59,
+                                     "pm10": 12.05}}]}
+
+
+class FakeResponse:
+    def __init__(self, payload):
+        self.payload = payload
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def raise_for_status(self):
+        if isinstance(self.payload, Exception):
+            raise self.payload
+
+    async def json(self):
+        return self.payload
+
+
+class FakeSession:
+    """Answers each request with the response `respond(url, params)` gives."""
+
+    def __init__(self, respond):
+        self.respond = respond
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+    def get(self, url, params):
+        return FakeResponse(self.respond(url, params))
+
+
+@pytest.fixture
+def collector(monkeypatch):
+    """Runs the collector against `respond` for a registry of `count` locations."""
+    inserted = {}
+
+    def collect(count, respond):
+        monkeypatch.setattr(orchestrator_lambda, "get_location_registry",
+                            lambda: make_registry(count))
+        monkeypatch.setattr(orchestrator_lambda.aiohttp, "ClientSession",
+                            FakeSession(respond))
+        monkeypatch.setattr(orchestrator_lambda, "insert_live_data",
+                            lambda weather, aq: inserted.update(weather=weather, aq=aq) or 0)
+        return collect_live_data(), inserted
+
+    return collect
+
+
+@pytest.mark.parametrize("count, sizes", [
+    (0, []), (1, [1]), (3, [3]), (4, [3, 1]), (6, [3, 3]), (7, [3, 3, 1])])
+def test_shard_locations_at_shard_size_boundaries(count, sizes):
+    shards = shard_locations(make_locations(count), 3)
+    assert [len(shard) for shard in shards] == sizes
+    assert [location["location_id"] for shard in shards for location in shard] == \
+        list(range(1, count + 1))
+
+
+@patch("orchestrator_lambda.lambda_client")
+def test_invoke_error_is_a_failed_shard(mock_client):
+    mock_client.invoke.side_effect = RuntimeError("Rate exceeded")
+    result = invoke_shard(LIVE_WEATHER_LAMBDA, [{"location_id": 1}])
+    assert result["failed"] is True
+    assert result["status_code"] is None
+    assert result["error"] == "Rate exceeded"
+    assert result["locations"] == 1
+
+
+@patch("orchestrator_lambda.lambda_client")
+def test_unaccepted_invoke_is_a_failed_shard(mock_client):
+    mock_client.invoke.return_value = {"ResponseMetadata": {"HTTPStatusCode": 500}}
+    result = invoke_shard(LIVE_WEATHER_LAMBDA, [{"location_id": 1}])
+    assert result["failed"] is True
+    assert result["status_code"] == 500
+
+
+@patch("orchestrator_lambda.lambda_client")
+@patch("orchestrator_lambda.get_location_data")
+def test_fan_out_totals_add_up(mock_get_location_data, mock_client, monkeypatch):
+    monkeypatch.setattr(orchestrator_lambda, "SHARD_SIZE", 2)
+    mock_get_location_data.return_value = make_locations(5)
+
+    def invoke(FunctionName, InvocationType, Payload):
+        if FunctionName == LIVE_AIR_QUALITY_LAMBDA and \
+                json.loads(Payload)["locations"][0]["location_id"] == 3:
+            raise RuntimeError("Rate exceeded")
+        return {"ResponseMetadata": {"HTTPStatusCode": 202}}
+
+    mock_client.invoke.side_effect = invoke
+    ret = fan_out_live_data()
+    assert len(ret["shards"]) == 6
+    assert sum(shard["locations"] for shard in ret["shards"]) == 10
+    assert ret["failed_shards"] == 1
+    assert ret["message"] == "Failed to invoke 1 of 6 shards."
+    assert ret["timings"]["max_shard_latency"] >= ret["timings"]["mean_shard_latency"]
+
+
+@patch("orchestrator_lambda.lambda_client")
+@patch("orchestrator_lambda.get_location_data", return_value=[])
+def test_fan_out_without_locations(mock_get_location_data, mock_client):
+    ret = fan_out_live_data()
+    mock_client.invoke.assert_not_called()
+    assert ret["shards"] == [] and ret["failed_shards"] == 0
+    assert ret["timings"]["max_shard_latency"] == 0
+
+
+@patch("orchestrator_lambda.lambda_client")
+@patch("orchestrator_lambda.get_location_data")
+def test_air_quality_shards_split_the_requests_per_minute(mock_get_location_data,
+                                                          mock_client, monkeypatch):
+    monkeypatch.setattr(orchestrator_lambda, "SHARD_SIZE", 2)
+    monkeypatch.setattr(orchestrator_lambda, "OWM_REQUESTS_PER_MINUTE", 60)
+    mock_get_location_data.return_value = make_locations(5)
+    mock_client.invoke.return_value = {"ResponseMetadata": {"HTTPStatusCode": 202}}
+    fan_out_live_data()
+
+    payloads = {}
+    for invocation in mock_client.invoke.call_args_list:
+        payloads.setdefault(invocation.kwargs["FunctionName"], []).append(
+            json.loads(invocation.kwargs["Payload"]))
+    assert [payload["requests_per_minute"]
+            for payload in payloads[LIVE_AIR_QUALITY_LAMBDA]] == [20, 20, 20]
+    assert all("requests_per_minute" not in payload
+               for payload in payloads[LIVE_WEATHER_LAMBDA])
+
+
+def test_collector_inserts_every_location(collector, monkeypatch):
+    monkeypatch.setattr(orchestrator_lambda, "WEATHER_BATCH_SIZE", 2)
+
+    def respond(url, params):
+        if url == WEATHER_API_URL:
+            return [weather_result() for _ in params["latitude"].split(",")]
+        return air_quality_result()
+
+    ret, inserted = collector(3, respond)
+    assert [row[1] for row in inserted["weather"]] == [1, 2, 3]
+    assert [row[1] for row in inserted["aq"]] == [1, 2, 3]
+    assert ret["message"] == "Successfully inserted all live data."
+    assert ret["failed_requests"] == 0
+
+
+def test_collector_rejects_short_weather_responses(collector):
+    def respond(url, params):
+        if url == WEATHER_API_URL:
+            # One coordinate missing from the response
+            return [weather_result()]
+        return air_quality_result()
+
+    ret, inserted = collector(2, respond)
+    assert inserted["weather"] == []
+    assert len(inserted["aq"]) == 2
+    assert ret["failed_requests"] == 1
+
+
+def test_collector_counts_failed_requests(collector):
+    def respond(url, params):
+        if url == WEATHER_API_URL:
+            return [weather_result() for _ in params["latitude"].split(",")]
+        if params["lat"] == 50.02:
+            return RuntimeError("503 Service Unavailable")
+        return air_quality_result()
+
+    ret, inserted = collector(3, respond)
+    assert len(inserted["weather"]) == 3
+    assert [row[1] for row in inserted["aq"]] == [1, 3]
+    assert ret["failed_requests"] == 1
+    assert ret["message"] == "Inserted the live data, 1 of 4 requests failed."
+
+
+def test_collector_takes_a_token_for_each_air_quality_request(collector, monkeypatch):
+    buckets = []
+
+    class CountingBucket:
+        def __init__(self, requests_per_minute, burst):
+            self.requests_per_minute = requests_per_minute
+            self.acquired = 0
+            buckets.append(self)
+
+        def acquire(self):
+            self.acquired += 1
+
+    monkeypatch.setattr(orchestrator_lambda, "OWM_REQUESTS_PER_MINUTE", 30)
+    monkeypatch.setattr(orchestrator_lambda, "make_bucket", CountingBucket)
+
+    def respond(url, params):
+        if url == WEATHER_API_URL:
+            return [weather_result() for _ in params["latitude"].split(",")]
+        return air_quality_result()
+
+    collector(3, respond)
+    assert len(buckets) == 1
+    assert buckets[0].requests_per_minute == 30
+    assert buckets[0].acquired == 3
+
+
+@patch("orchestrator_lambda.execute_values")
+@patch("orchestrator_lambda.get_connection")
+def test_insert_live_data_skips_unchanged_air_quality(mock_get_connection, mock_execute_values):
+    stored = datetime(2025, 7, 31, 18, 41, 20, tzinfo=timezone.utc)
+    newer = datetime(2025, 7, 31, 19, 41, 20, tzinfo=timezone.utc)
+    cursor = mock_get_connection.return_value.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(1, stored.replace(tzinfo=None)),
+                                    (2, stored.replace(tzinfo=None))]
+    aq_rows = [(stored, 1) + (0,) * 9, (newer, 2) + (0,) * 9, (newer, 3) + (0,) * 9]
+
+    skipped = insert_live_data([], aq_rows)
+
+    assert skipped == 1
+    insert_call, last_seen_call = mock_execute_values.call_args_list
+    assert [row[1] for row in insert_call.args[2]] == [2, 3]
+    assert last_seen_call.args[1].startswith("INSERT INTO air_quality_last_seen")
+    assert last_seen_call.args[2] == [(2, newer.replace(tzinfo=None)),
+                                      (3, newer.replace(tzinfo=None))]
+    mock_get_connection.return_value.commit.assert_called_once()
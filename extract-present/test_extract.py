@@ -1,5 +1,8 @@
-from unittest.mock import patch, Mock, call
-from extract import get_weather, lambda_handler
+from unittest.mock import patch, Mock, MagicMock, call
+import psycopg2
+import pytest
+import extract
+from extract import get_connection, get_weather, get_weather_batch, lambda_handler
 
 
 @patch("openmeteo_requests.Client")
@@ -63,14 +66,119 @@ def test_lambda_handler(mock_connect, mock_get_weather):
          "(%(timestamp)s, %(location_id)s, %(rainfall_last_15_mins)s, "
          "%(current_temperature)s, %(wind_speed)s, "
          "%(wind_gust_speed)s, %(wind_direction)s, "
-         "%(snowfall_last_15_mins)s)"),
+         "%(snowfall_last_15_mins)s)"
+         " ON CONFLICT (location_id, timestamp) DO NOTHING"),
         weather_reading
     )
     assert cursor.execute.call_count == 1
     mock_get_weather.assert_called_once_with(53.5, 0.1)
     mock_connect.return_value.commit.assert_called_once()
-    mock_connect.return_value.close.assert_called_once()
+    mock_connect.return_value.close.assert_not_called()
     assert ret == {
         "statusCode": 200,
         "message": "Reading successfully inserted."
     }
+
+
+@patch("openmeteo_requests.Client")
+def test_get_weather_batch(api_mock):
+    responses = []
+    for i in range(2):
+        response_mock = Mock()
+        current_weather_mock = response_mock.Current.return_value
+        current_weather_mock.Time.return_value = 1753964100
+        current_weather_mock.Variables.return_value.Value.side_effect = [
+            float(i)] * 6
+        responses.append(response_mock)
+    openmeteo = Mock()
+    api_mock.return_value = openmeteo
+    openmeteo.weather_api.return_value = responses
+    ret = get_weather_batch([
+        {"location_id": 7, "latitude": 53.5, "longitude": 0.1},
+        {"location_id": 8, "latitude": 51.5, "longitude": -0.1},
+    ])
+    openmeteo.weather_api.assert_called_once_with(
+        "https://api.open-meteo.com/v1/forecast",
+        params={
+            "latitude": [53.5, 51.5],
+            "longitude": [0.1, -0.1],
+            "current": ["temperature_2m", "wind_speed_10m", "wind_direction_10m",
+                        "wind_gusts_10m", "rain", "snowfall"]
+        }
+    )
+    assert [reading["location_id"] for reading in ret] == [7, 8]
+    assert [reading["current_temperature"] for reading in ret] == [0.0, 1.0]
+
+
+@patch("extract.LOCATIONS_PER_REQUEST", 2)
+@patch("extract.execute_values")
+@patch("extract.get_weather_batch")
+@patch("psycopg2.connect")
+def test_lambda_handler_batch(mock_connect, mock_get_weather_batch, mock_execute_values):
+    locations = [{"location_id": i, "latitude": 50.0 + i, "longitude": 0.1}
+                 for i in range(3)]
+    mock_get_weather_batch.side_effect = lambda batch: [
+        {"location_id": location["location_id"]} for location in batch]
+    ret = lambda_handler({"locations": locations}, "context")
+    assert mock_get_weather_batch.call_args_list == [
+        call(locations[:2]), call(locations[2:])]
+    mock_execute_values.assert_called_once()
+    assert mock_execute_values.call_args.args[2] == [
+        {"location_id": 0}, {"location_id": 1}, {"location_id": 2}]
+    mock_connect.assert_called_once()
+    mock_connect.return_value.commit.assert_called_once()
+    assert ret == {
+        "statusCode": 200,
+        "message": "3 readings successfully inserted.",
+        "failed_locations": 0
+    }
+
+
+@patch("extract.LOCATIONS_PER_REQUEST", 2)
+@patch("extract.execute_values")
+@patch("extract.get_weather_batch")
+@patch("psycopg2.connect")
+def test_lambda_handler_batch_inserts_the_requests_which_succeeded(mock_connect,
+                                                                   mock_get_weather_batch,
+                                                                   mock_execute_values):
+    locations = [{"location_id": i, "latitude": 50.0 + i, "longitude": 0.1}
+                 for i in range(3)]
+    mock_get_weather_batch.side_effect = [
+        RuntimeError("Expected 2 weather responses, received 1."),
+        [{"location_id": 2}]]
+    ret = lambda_handler({"locations": locations}, "context")
+    assert mock_execute_values.call_args.args[2] == [{"location_id": 2}]
+    mock_connect.return_value.commit.assert_called_once()
+    assert ret == {
+        "statusCode": 200,
+        "message": "1 readings successfully inserted.",
+        "failed_locations": 2
+    }
+
+
+@patch("psycopg2.connect")
+def test_get_connection_reuses_healthy_connection(mock_connect):
+    mock_connect.return_value.closed = 0
+    first = get_connection()
+    second = get_connection()
+    assert first is second
+    mock_connect.assert_called_once()
+    cursor = mock_connect.return_value.cursor.return_value.__enter__.return_value
+    cursor.execute.assert_called_once_with("SELECT 1")
+
+
+@patch("psycopg2.connect")
+def test_get_connection_reconnects_when_unhealthy(mock_connect):
+    stale, fresh = MagicMock(closed=0), MagicMock(closed=0)
+    stale.cursor.return_value.__enter__.return_value.execute.side_effect = \
+        psycopg2.OperationalError("server closed the connection")
+    mock_connect.side_effect = [stale, fresh]
+    get_connection()
+    assert get_connection() is fresh
+    stale.close.assert_called_once()
+    assert mock_connect.call_count == 2
+
+
+def test_get_openmeteo_client_is_shared():
+    client = extract.get_openmeteo_client()
+    assert extract.get_openmeteo_client() is client
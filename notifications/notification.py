@@ -23,6 +23,44 @@ RAIN_THRESHOLD = 3
 WIND_THRESHOLD = 64
 AQI_THRESHOLD = 3
 
+UNSENT_FLOOD_WARNINGS_QUERY = """
+    SELECT
+        fw.flood_warnings_id,
+        fw.updated_at,
+        fw.location_description,
+        fw.message,
+        l.location_name,
+        u.email,
+        fs.severity_meaning
+    FROM flood_warnings fw
+    JOIN flood_area_assignment faa  USING (flood_area_id)
+    JOIN locations l USING (location_id )
+    JOIN location_assignment la USING (location_id)
+    JOIN users u USING (user_id )
+    JOIN flood_severity fs USING (severity_id)
+    WHERE la.subscribe_to_alerts = TRUE
+    AND fw.notifications_sent = FALSE;
+"""
+# Readings newer than the given time for locations with alert subscribers
+WEATHER_READINGS_QUERY = """
+    SELECT l.location_name, wr.rainfall_last_15_mins, wr.current_temperature, wr.wind_speed, u.email
+    FROM weather_readings wr
+    JOIN locations l USING (location_id)
+    JOIN location_assignment la USING (location_id)
+    JOIN users u USING (user_id )
+    WHERE wr."timestamp" > %s
+    AND la.subscribe_to_alerts = TRUE;
+"""
+AQI_READINGS_QUERY = """
+    SELECT l.location_name, aqr.air_quality_index, u.email
+    FROM air_quality_readings aqr
+    JOIN locations l USING (location_id)
+    JOIN location_assignment la USING (location_id)
+    JOIN users u USING (user_id )
+    WHERE aqr."timestamp" > %s
+    AND la.subscribe_to_alerts = TRUE;
+"""
+
 
 def get_connection() -> psycopg2.extensions.connection:
     """Get connection to RDS."""
@@ -35,30 +73,17 @@ def get_connection() -> psycopg2.extensions.connection:
     )
 
 
+def get_recent_readings_start() -> datetime:
+    """The start of the last 15 minutes as a naive UTC time, as readings are stored."""
+    return datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=15)
+
+
 def get_unsent_flood_warnings() -> pd.DataFrame:
     """Connect to the DB and retrieve all flood warnings that have not been sent yet"""
     try:
         with get_connection() as conn:
             logging.info("Connected to database.")
-            query = """
-            SELECT
-                fw.flood_warnings_id,
-                fw.updated_at,
-                fw.location_description,
-                fw.message,
-                l.location_name,
-                u.email,
-                fs.severity_meaning
-            FROM flood_warnings fw
-            JOIN flood_area_assignment faa  USING (flood_area_id)
-            JOIN locations l USING (location_id )
-            JOIN location_assignment la USING (location_id)
-            JOIN users u USING (user_id )
-            JOIN flood_severity fs USING (severity_id)
-            WHERE la.subscribe_to_alerts = TRUE
-            AND fw.notifications_sent = FALSE;
-            """
-        return pd.read_sql_query(query, conn)
+            return pd.read_sql_query(UNSENT_FLOOD_WARNINGS_QUERY, conn)
     except Exception as err:
         logging.error(str(err))
         raise
@@ -68,16 +93,8 @@ def get_weather_readings() -> pd.DataFrame:
     """Get most recent weather readings"""
     try:
         with get_connection() as conn:
-            query = f"""
-            SELECT l.location_name, wr.rainfall_last_15_mins, wr.current_temperature, wr.wind_speed, u.email
-            FROM weather_readings wr
-            JOIN locations l USING (location_id)
-            JOIN location_assignment la USING (location_id)
-            JOIN users u USING (user_id )
-            WHERE wr."timestamp" > '{datetime.now(timezone.utc) - timedelta(minutes=15)}'
-            AND la.subscribe_to_alerts = TRUE;
-            """
-        return pd.read_sql_query(query, conn)
+            return pd.read_sql_query(WEATHER_READINGS_QUERY, conn,
+                                     params=(get_recent_readings_start(),))
     except:
         raise RuntimeError("Unable to connect to RDS")
 
@@ -86,16 +103,8 @@ def get_aqi_readings() -> pd.DataFrame:
     """Get most recent Air Quality Index readings"""
     try:
         with get_connection() as conn:
-            query = f"""
-            SELECT l.location_name, aqr.air_quality_index, u.email
-            FROM air_quality_readings aqr
-            JOIN locations l USING (location_id)
-            JOIN location_assignment la USING (location_id)
-            JOIN users u USING (user_id )
-            WHERE aqr."timestamp" > '{datetime.now(timezone.utc) - timedelta(minutes=15)}'
-            AND la.subscribe_to_alerts = TRUE;
-            """
-        return pd.read_sql_query(query, conn)
+            return pd.read_sql_query(AQI_READINGS_QUERY, conn,
+                                     params=(get_recent_readings_start(),))
     except:
         raise RuntimeError("Unable to connect to RDS")
 
@@ -0,0 +1,6 @@
+# pylint: skip-file
+import sys
+from pathlib import Path
+
+# The Open-Meteo budget is shared with the location seeding script
+sys.path.append(str(Path(__file__).resolve().parents[1] / "shared"))
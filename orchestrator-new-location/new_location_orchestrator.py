@@ -1,22 +1,48 @@
 """Load data trigger lambdas to load data for new locations."""
 import os
-from datetime import date, timedelta
+from datetime import date
 from typing import Any
 import json
 import logging
 import boto3
+import psycopg2
 from dotenv import load_dotenv
+from open_meteo_budget import (FUTURE_PREDICTIONS_FIRST_DATE, FUTURE_PREDICTIONS_LAST_DATE,
+                               HISTORIC_WEATHER_FIRST_DATE, HISTORIC_WEATHER_LAST_DATE,
+                               HOURS_PER_DAY)
 
-HISTORIC_WEATHER_FIRST_DATE = date.fromisoformat('1940-01-01')
-HISTORIC_WEATHER_LAST_DATE = date.today() - timedelta(days=6)
 HISTORIC_WEATHER_BATCH_SIZE = 35*365
-FUTURE_PREDICTIONS_FIRST_DATE = date.today() + timedelta(days=1)
-FUTURE_PREDICTIONS_LAST_DATE = date.fromisoformat('2049-12-31')
-FUTURE_PREDICTIONS_BATCH_SIZE = 30*365
 HISTORIC_WEATHER_LAMBDA = "c18-climate-monitor-historic-weather-lambda"
 HISTORIC_AIR_QUALITY_LAMBDA = "c18-climate-monitor-historic-air-quality-lambda"
 FUTURE_PREDICTIONS_LAMBDA = "c18-climate-monitor-future-predictions-lambda"
 LOCATION_ASSIGNMENT_LAMBDA = "c18-climate-monitor-location-assignment-lambda"
+# Gaps closer together than this are fetched in one request, since reloading
+# the stored days in between is cheaper than another invocation
+GAP_MERGE_DAYS = 30
+
+# Days from first_date to last_date with fewer hourly readings stored than expected,
+# except days in a window the coverage ledger records as loaded, since the archive
+# has no more readings for them
+MISSING_DAYS_QUERY = """
+    SELECT series.day::DATE
+    FROM generate_series(%(first_date)s::DATE, %(last_date)s::DATE, INTERVAL '1 day') AS series(day)
+    LEFT JOIN (
+        SELECT timestamp::DATE AS day, COUNT(*) AS readings
+        FROM historical_weather_readings
+        WHERE location_id = %(location_id)s
+        AND timestamp >= %(first_date)s AND timestamp < %(last_date)s::DATE + 1
+        GROUP BY 1
+    ) AS counts ON counts.day = series.day::DATE
+    WHERE COALESCE(counts.readings, 0) < %(hours_per_day)s
+    AND NOT EXISTS (
+        SELECT 1
+        FROM backfill_coverage AS coverage
+        WHERE coverage.location_id = %(location_id)s
+        AND coverage.table_name = 'historical_weather_readings'
+        AND series.day::DATE BETWEEN coverage.start_date AND coverage.end_date
+    )
+    ORDER BY 1;
+"""
 
 load_dotenv()
 
@@ -45,34 +71,70 @@ def invoke_with_date_range(lambda_name: str,
                  response['ResponseMetadata']['HTTPStatusCode'])
 
 
-def date_batch_invoke(lambda_name: str,
-                      location: dict,
-                      first_date: date,
-                      last_date: date,
-                      batch_size: int,
-                      client: Any) -> None:
+def get_connection() -> psycopg2.extensions.connection:
+    """Get connection to RDS."""
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST"),
+        user=os.getenv("DB_USER"),
+        password=os.getenv("DB_PASSWORD"),
+        dbname=os.getenv("DB_NAME"),
+        port=os.getenv("DB_PORT")
+    )
+
+
+def find_missing_days(location_id: int, first_date: date, last_date: date) -> list[date]:
     """
-    Invoke `lambda_name` to cover the range from `first_date` to `last_date`.
-    Parameters:
-        lambda_name: Name of the lambda function to invoke.
-        location: Dict containing the location_id, latitude and longitude.
-            e.g. {"location_id": 1, "latitude": 51.507351, "longitude": -0.127758}
-        first_date: First date in the desired range.
-        last_date: Last date in the desired range.
-        batch_size: Number of days in a batch.
-        client: boto3 Lambda client
-    Returns:
-        None
+    Returns the days between `first_date` and `last_date` for which fewer
+    historical weather readings are stored for the location than hours in the day,
+    and which no window in the coverage ledger has loaded.
+    """
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(MISSING_DAYS_QUERY, {"location_id": location_id,
+                                             "first_date": first_date,
+                                             "last_date": last_date,
+                                             "hours_per_day": HOURS_PER_DAY})
+            return [row[0] for row in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+def group_into_ranges(days: list[date], max_days: int,
+                      merge_days: int = GAP_MERGE_DAYS) -> list[tuple[date, date]]:
+    """
+    Group sorted days into inclusive date ranges of at most `max_days` days,
+    joining days at most `merge_days` apart into one range.
+    """
+    ranges = []
+    for day in days:
+        if ranges:
+            start, end = ranges[-1]
+            if (day - end).days <= merge_days and (day - start).days < max_days:
+                ranges[-1] = (start, day)
+                continue
+        ranges.append((day, day))
+    return ranges
+
+
+def gap_batch_invoke(lambda_name: str,
+                     location: dict,
+                     first_date: date,
+                     last_date: date,
+                     batch_size: int,
+                     client: Any) -> int:
+    """
+    Invoke `lambda_name` only for the ranges between `first_date` and `last_date`
+    with missing historical weather for the location, in batches of at most
+    `batch_size` days. Returns the number of ranges invoked.
     """
-    start_date = first_date
-    end_date = first_date + timedelta(days=batch_size - 1)
-    while end_date < last_date:
-        invoke_with_date_range(lambda_name, location,
-                               start_date, end_date, client)
-        start_date += timedelta(days=batch_size)
-        end_date += timedelta(days=batch_size)
-    invoke_with_date_range(lambda_name, location,
-                           start_date, last_date, client)
+    missing_days = find_missing_days(location["location_id"], first_date, last_date)
+    ranges = group_into_ranges(missing_days, batch_size)
+    logging.info("Location %s is missing %d days of historical weather in %d ranges.",
+                 location["location_id"], len(missing_days), len(ranges))
+    for start, end in ranges:
+        invoke_with_date_range(lambda_name, location, start, end, client)
+    return len(ranges)
 
 
 def invoke(lambda_name: str, payload: dict, client: Any) -> None:
@@ -104,11 +166,13 @@ def lambda_handler(event: dict, context: Any) -> dict:  # pylint: disable=unused
     )
     lambda_client = boto3.client('lambda')
     try:
-        date_batch_invoke(HISTORIC_WEATHER_LAMBDA, event, HISTORIC_WEATHER_FIRST_DATE,
-                          HISTORIC_WEATHER_LAST_DATE, HISTORIC_WEATHER_BATCH_SIZE, lambda_client)
-        date_batch_invoke(FUTURE_PREDICTIONS_LAMBDA, event, FUTURE_PREDICTIONS_FIRST_DATE,
-                          FUTURE_PREDICTIONS_LAST_DATE, FUTURE_PREDICTIONS_BATCH_SIZE,
-                          lambda_client)
+        gap_batch_invoke(HISTORIC_WEATHER_LAMBDA, event, HISTORIC_WEATHER_FIRST_DATE,
+                         HISTORIC_WEATHER_LAST_DATE, HISTORIC_WEATHER_BATCH_SIZE,
+                         lambda_client)
+        # The future predictions lambda fetches the whole range in concurrent windows
+        invoke_with_date_range(FUTURE_PREDICTIONS_LAMBDA, event,
+                               FUTURE_PREDICTIONS_FIRST_DATE, FUTURE_PREDICTIONS_LAST_DATE,
+                               lambda_client)
         invoke(HISTORIC_AIR_QUALITY_LAMBDA, event, lambda_client)
         invoke(LOCATION_ASSIGNMENT_LAMBDA, event, lambda_client)
 
@@ -0,0 +1,68 @@
+import json
+from datetime import date, timedelta
+from unittest.mock import MagicMock, patch
+from new_location_orchestrator import (HISTORIC_WEATHER_LAMBDA, find_missing_days,
+                                       gap_batch_invoke, group_into_ranges)
+
+LOCATION = {"location_id": 1, "latitude": 51.5, "longitude": -0.1}
+
+
+def days(start: date, count: int) -> list[date]:
+    return [start + timedelta(days=i) for i in range(count)]
+
+
+def test_group_into_ranges_merges_days_at_most_merge_days_apart():
+    first = date(2000, 1, 1)
+    missing = [first, first + timedelta(days=3), first + timedelta(days=8)]
+    assert group_into_ranges(missing, max_days=100, merge_days=5) == [
+        (first, first + timedelta(days=8))]
+    assert group_into_ranges(missing, max_days=100, merge_days=4) == [
+        (first, first + timedelta(days=3)),
+        (first + timedelta(days=8), first + timedelta(days=8))]
+
+
+def test_group_into_ranges_caps_ranges_at_max_days():
+    first = date(2000, 1, 1)
+    assert group_into_ranges(days(first, 5), max_days=2) == [
+        (first, first + timedelta(days=1)),
+        (first + timedelta(days=2), first + timedelta(days=3)),
+        (first + timedelta(days=4), first + timedelta(days=4))]
+    assert group_into_ranges([], max_days=2) == []
+
+
+@patch("new_location_orchestrator.get_connection")
+def test_find_missing_days_skips_days_in_the_coverage_ledger(mock_get_connection):
+    conn = MagicMock()
+    mock_get_connection.return_value = conn
+    cursor = conn.cursor.return_value.__enter__.return_value
+    cursor.fetchall.return_value = [(date(2000, 1, 2),)]
+    missing = find_missing_days(1, date(2000, 1, 1), date(2000, 1, 31))
+    assert missing == [date(2000, 1, 2)]
+    query, parameters = cursor.execute.call_args.args
+    assert "FROM backfill_coverage" in query
+    assert parameters == {"location_id": 1, "first_date": date(2000, 1, 1),
+                          "last_date": date(2000, 1, 31), "hours_per_day": 24}
+    conn.close.assert_called_once()
+
+
+@patch("new_location_orchestrator.find_missing_days")
+def test_gap_batch_invoke_only_invokes_missing_ranges(mock_find_missing_days):
+    first = date(2000, 1, 1)
+    mock_find_missing_days.return_value = days(first, 3) + days(date(2001, 1, 1), 2)
+    client = MagicMock()
+    client.invoke.return_value = {"ResponseMetadata": {"HTTPStatusCode": 202}}
+    invoked = gap_batch_invoke(HISTORIC_WEATHER_LAMBDA, LOCATION, first,
+                               date(2001, 12, 31), 365, client)
+    assert invoked == 2
+    payloads = [json.loads(c.kwargs["Payload"]) for c in client.invoke.call_args_list]
+    assert [(p["start_date"], p["end_date"]) for p in payloads] == [
+        ("2000-01-01", "2000-01-03"), ("2001-01-01", "2001-01-02")]
+    assert all(p["location_id"] == 1 for p in payloads)
+
+
+@patch("new_location_orchestrator.find_missing_days", return_value=[])
+def test_gap_batch_invoke_skips_complete_locations(mock_find_missing_days):
+    client = MagicMock()
+    assert gap_batch_invoke(HISTORIC_WEATHER_LAMBDA, LOCATION, date(2000, 1, 1),
+                            date(2000, 12, 31), 365, client) == 0
+    client.invoke.assert_not_called()
@@ -0,0 +1,28 @@
+"""
+Open-Meteo API budget of loading a new location. The new location orchestrator
+requests these date ranges, and db/insert-location-data/main.py schedules the
+orchestrator so the calls they cost stay within the API limits.
+"""
+import os
+from datetime import date, timedelta
+
+# Date ranges loaded for a new location
+HISTORIC_WEATHER_FIRST_DATE = date.fromisoformat("1940-01-01")
+HISTORIC_WEATHER_LAST_DATE = date.today() - timedelta(days=6)
+FUTURE_PREDICTIONS_FIRST_DATE = date.today() + timedelta(days=1)
+FUTURE_PREDICTIONS_LAST_DATE = date.fromisoformat("2049-12-31")
+HOURS_PER_DAY = 24
+
+# Variables requested by the historic weather and future predictions lambdas
+HISTORIC_WEATHER_VARIABLES = 6
+FUTURE_PREDICTIONS_VARIABLES = 7
+
+# Open-Meteo counts a request as fractional API calls: one call per location for
+# every 14 days and every 10 variables requested. The hourly and daily limits apply
+# over rolling windows (seconds: calls). The per minute limit is left to the lambdas,
+# which spread a location's requests over several minutes. Only a share of each
+# limit is used, since the lambdas make their requests some time after being invoked.
+DAYS_PER_CALL = 14
+VARIABLES_PER_CALL = 10
+API_LIMITS = {60 * 60: 5000, 24 * 60 * 60: 10000}
+API_LIMIT_HEADROOM = float(os.getenv("API_LIMIT_HEADROOM", "0.9"))
@@ -0,0 +1,55 @@
+"""
+Rate limiting for the lambdas which share the OpenWeatherMap API key.
+Each lambda is given its own part of the key's requests per minute by terraform
+and builds its token bucket from it here.
+"""
+import time
+import threading
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket letting through `rate` requests per second
+    on average, in bursts of at most `capacity` requests.
+    """
+
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity,
+                                  self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def make_bucket(requests_per_minute: float, burst: int) -> TokenBucket:
+    """
+    A bucket for `requests_per_minute`, letting through bursts of up to `burst`
+    requests but never more than the requests allowed in a minute.
+    """
+    return TokenBucket(requests_per_minute / 60,
+                       max(1, min(burst, int(requests_per_minute))))
+
+
+def get_retry_after(response, bucket: TokenBucket) -> float:
+    """
+    Seconds to wait after a throttled response, from its Retry-After header if given,
+    otherwise the time the bucket takes to let through one request.
+    """
+    try:
+        return float(response.headers["Retry-After"])
+    except (KeyError, TypeError, ValueError):
+        return 1 / bucket.rate
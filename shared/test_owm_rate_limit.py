@@ -0,0 +1,29 @@
+from unittest.mock import patch, Mock
+from owm_rate_limit import TokenBucket, get_retry_after, make_bucket
+
+
+@patch("owm_rate_limit.time.sleep")
+@patch("owm_rate_limit.time.monotonic")
+def test_token_bucket_waits_once_burst_is_spent(mock_monotonic, mock_sleep):
+    mock_monotonic.return_value = 100.0
+    bucket = TokenBucket(rate=2, capacity=2)
+    bucket.acquire()
+    bucket.acquire()
+    mock_sleep.assert_not_called()
+    mock_sleep.side_effect = lambda seconds: setattr(
+        mock_monotonic, "return_value", mock_monotonic.return_value + seconds)
+    bucket.acquire()
+    mock_sleep.assert_called_once_with(0.5)
+
+
+def test_make_bucket_burst_is_capped_by_requests_per_minute():
+    assert make_bucket(60, 10).capacity == 10
+    assert make_bucket(6, 10).capacity == 6
+    assert make_bucket(0.5, 10).capacity == 1
+    assert make_bucket(6, 10).rate == 0.1
+
+
+def test_retry_after_falls_back_to_the_bucket_rate():
+    bucket = TokenBucket(rate=0.5, capacity=1)
+    assert get_retry_after(Mock(headers={"Retry-After": "3"}), bucket) == 3.0
+    assert get_retry_after(Mock(headers={}), bucket) == 2.0
@@ -16,6 +16,13 @@ provider "aws" {
   region = "eu-west-2"
 }
 
+locals {
+  # The OpenWeatherMap key's requests per minute, split between the live air quality
+  # shards and the historic air quality lambda, which share the key
+  open_weather_live_requests_per_minute     = floor(var.open_weather_requests_per_minute * var.open_weather_live_share)
+  open_weather_historic_requests_per_minute = var.open_weather_requests_per_minute - local.open_weather_live_requests_per_minute
+}
+
 resource "aws_security_group" "allow_5432" {
   name        = "c18-climate-monitor-rds-sg"
   description = "Allows all traffic on port 5432."
@@ -166,6 +173,15 @@ resource "aws_ecr_repository" "notifications" {
   }
 }
 
+resource "aws_ecr_repository" "partition_maintenance" {
+  name                 = "c18-climate-monitor-partition-maintenance-ecr"
+  image_tag_mutability = "MUTABLE"
+
+  image_scanning_configuration {
+    scan_on_push = true
+  }
+}
+
 resource "aws_ecr_repository" "dashboard" {
   name                 = "c18-climate-monitor-dashboard-ecr"
   image_tag_mutability = "MUTABLE"
@@ -254,17 +270,18 @@ resource "aws_lambda_function" "current_air_quality" {
   package_type  = "Image"
   image_uri     = "${aws_ecr_repository.current_air_quality.repository_url}:latest"
   memory_size   = 256
-  timeout       = 60
+  timeout       = 300
   architectures = ["x86_64"]
 
   environment {
     variables = {
-      DB_HOST     = aws_db_instance.climate.address
-      DB_PORT     = 5432
-      DB_USER     = "climate"
-      DB_PASSWORD = var.db_password
-      DB_NAME     = "postgres"
-      api_key     = var.open_weather_api_key
+      DB_HOST                 = aws_db_instance.climate.address
+      DB_PORT                 = 5432
+      DB_USER                 = "climate"
+      DB_PASSWORD             = var.db_password
+      DB_NAME                 = "postgres"
+      api_key                 = var.open_weather_api_key
+      OWM_REQUESTS_PER_MINUTE = local.open_weather_live_requests_per_minute
     }
   }
 
@@ -295,17 +312,21 @@ resource "aws_lambda_function" "historic_weather" {
   role          = aws_iam_role.lambda.arn
   package_type  = "Image"
   image_uri     = "${aws_ecr_repository.historic_weather.repository_url}:latest"
-  memory_size   = 3008
-  timeout       = 400
+  memory_size   = 512
+  timeout       = 900
   architectures = ["x86_64"]
 
+  # /tmp is only kept while a container stays warm, so the archive cache saves
+  # requests for ranges loaded again by the same container
   environment {
     variables = {
-      DB_HOST     = aws_db_instance.climate.address
-      DB_PORT     = 5432
-      DB_USER     = "climate"
-      DB_PASSWORD = var.db_password
-      DB_NAME     = "postgres"
+      DB_HOST                 = aws_db_instance.climate.address
+      DB_PORT                 = 5432
+      DB_USER                 = "climate"
+      DB_PASSWORD             = var.db_password
+      DB_NAME                 = "postgres"
+      ARCHIVE_CACHE_DIR       = "/tmp/archive-cache"
+      ARCHIVE_CACHE_MAX_BYTES = 400000000
     }
   }
 
@@ -340,14 +361,19 @@ resource "aws_lambda_function" "historic_air_quality" {
   timeout       = 400
   architectures = ["x86_64"]
 
+  # New location and daily refresh invocations are queued rather than run at once,
+  # so together they stay within the historic share of the OpenWeatherMap limit
+  reserved_concurrent_executions = 1
+
   environment {
     variables = {
-      DB_HOST     = aws_db_instance.climate.address
-      DB_PORT     = 5432
-      DB_USER     = "climate"
-      DB_PASSWORD = var.db_password
-      DB_NAME     = "postgres"
-      api_key     = var.open_weather_api_key
+      DB_HOST                 = aws_db_instance.climate.address
+      DB_PORT                 = 5432
+      DB_USER                 = "climate"
+      DB_PASSWORD             = var.db_password
+      DB_NAME                 = "postgres"
+      api_key                 = var.open_weather_api_key
+      OWM_REQUESTS_PER_MINUTE = local.open_weather_historic_requests_per_minute
     }
   }
 
@@ -460,7 +486,7 @@ resource "aws_lambda_function" "future_climate" {
   role          = aws_iam_role.lambda.arn
   package_type  = "Image"
   image_uri     = "${aws_ecr_repository.future_predictions.repository_url}:latest"
-  memory_size   = 3008
+  memory_size   = 512
   timeout       = 400
   architectures = ["x86_64"]
 
@@ -549,11 +575,14 @@ resource "aws_lambda_function" "current_reading_orchestrator" {
 
   environment {
     variables = {
-      DB_HOST     = aws_db_instance.climate.address
-      DB_PORT     = 5432
-      DB_USER     = "climate"
-      DB_PASSWORD = var.db_password
-      DB_NAME     = "postgres"
+      DB_HOST                 = aws_db_instance.climate.address
+      DB_PORT                 = 5432
+      DB_USER                 = "climate"
+      DB_PASSWORD             = var.db_password
+      DB_NAME                 = "postgres"
+      api_key                 = var.open_weather_api_key
+      LIVE_DATA_MODE          = "fan-out"
+      OWM_REQUESTS_PER_MINUTE = local.open_weather_live_requests_per_minute
     }
   }
 
@@ -596,6 +625,11 @@ resource "aws_lambda_function" "new_location_orchestrator" {
       MY_AWS_ACCESS_KEY_ID     = var.my_aws_access_key_id
       MY_AWS_SECRET_ACCESS_KEY = var.my_aws_secret_access_key
       MY_AWS_REGION            = "eu-west-2"
+      DB_HOST                  = aws_db_instance.climate.address
+      DB_PORT                  = 5432
+      DB_USER                  = "climate"
+      DB_PASSWORD              = var.db_password
+      DB_NAME                  = "postgres"
     }
   }
 
@@ -981,4 +1015,97 @@ resource "aws_scheduler_schedule" "notifications_scheduler" {
     arn      = aws_lambda_function.notifications.arn
     role_arn = aws_iam_role.lambda_scheduler.arn
   }
-}
\ No newline at end of file
+}
+
+
+resource "aws_cloudwatch_log_group" "partition_maintenance" {
+  name              = "/aws/lambda/${var.partition_maintenance_lambda_name}"
+  retention_in_days = 7
+
+  tags = {
+    Environment = "production"
+    Function    = var.partition_maintenance_lambda_name
+  }
+}
+
+resource "aws_lambda_function" "partition_maintenance" {
+  function_name = var.partition_maintenance_lambda_name
+  role          = aws_iam_role.lambda.arn
+  package_type  = "Image"
+  image_uri     = "${aws_ecr_repository.partition_maintenance.repository_url}:latest"
+  memory_size   = 128
+  timeout       = 60
+  architectures = ["x86_64"]
+
+  environment {
+    variables = {
+      DB_HOST               = aws_db_instance.climate.address
+      DB_PORT               = 5432
+      DB_USER               = "climate"
+      DB_PASSWORD           = var.db_password
+      DB_NAME               = "postgres"
+      PARTITION_YEARS_AHEAD = 1
+    }
+  }
+
+  logging_config {
+    log_format            = "JSON"
+    application_log_level = "INFO"
+    system_log_level      = "INFO"
+  }
+
+  depends_on = [
+    aws_iam_role_policy_attachment.lambda_basic_exec_role,
+    aws_cloudwatch_log_group.partition_maintenance
+  ]
+}
+
+resource "aws_scheduler_schedule" "partition_maintenance_scheduler" {
+  name = "c18-climate-monitor-partition-maintenance-scheduler"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression          = "cron(0 3 1 * ? *)"
+  schedule_expression_timezone = "Europe/London"
+
+  target {
+    arn      = aws_lambda_function.partition_maintenance.arn
+    role_arn = aws_iam_role.lambda_scheduler.arn
+  }
+}
+
+resource "aws_scheduler_schedule" "historic_weather_top_up_scheduler" {
+  name = "c18-climate-monitor-historic-weather-top-up-scheduler"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression          = "cron(0 4 * * ? *)"
+  schedule_expression_timezone = "Europe/London"
+
+  target {
+    arn      = aws_lambda_function.historic_weather.arn
+    role_arn = aws_iam_role.lambda_scheduler.arn
+    input    = jsonencode({ mode = "top-up" })
+  }
+}
+
+resource "aws_scheduler_schedule" "historic_air_quality_refresh_scheduler" {
+  name = "c18-climate-monitor-historic-air-quality-refresh-scheduler"
+
+  flexible_time_window {
+    mode = "OFF"
+  }
+
+  schedule_expression          = "cron(30 4 * * ? *)"
+  schedule_expression_timezone = "Europe/London"
+
+  target {
+    arn      = aws_lambda_function.historic_air_quality.arn
+    role_arn = aws_iam_role.lambda_scheduler.arn
+    input    = jsonencode({ mode = "incremental" })
+  }
+}
@@ -3,6 +3,18 @@ variable "open_weather_api_key" {
   sensitive = true
 }
 
+variable "open_weather_requests_per_minute" {
+  type        = number
+  default     = 60
+  description = "OpenWeatherMap requests per minute allowed for the API key, shared by every lambda using it"
+}
+
+variable "open_weather_live_share" {
+  type        = number
+  default     = 0.5
+  description = "Share of the OpenWeatherMap requests per minute given to the live air quality shards, the rest goes to the historic air quality lambda"
+}
+
 variable "current_weather_lambda_name" {
   type    = string
   default = "c18-climate-monitor-current-weather-lambda"
@@ -69,4 +81,9 @@ variable "db_password" {
 variable "daily_summary_lambda_name" {
   type    = string
   default = "c18-climate-monitor-daily-summary-lambda"
-}
\ No newline at end of file
+}
+
+variable "partition_maintenance_lambda_name" {
+  type    = string
+  default = "c18-climate-monitor-partition-maintenance-lambda"
+}